@@ -0,0 +1,83 @@
+#! python
+# -*- coding: utf-8 -*-
+# Benchmark for building email messages in worker processes (the processes setting) vs. in the deliver threads.
+#   Builds the same set of emails, each with large inline and appended attachments, from several deliver threads at
+#   once, first with no process pool and then with one of each size given. Run from the repository root:
+#
+#   python benchmarks/bench_build_message.py --emails 40 --attachment-mb 2 --threads 4 --processes 2 4
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import config
+from vizalert import emailaction
+from vizalert import log
+from vizalert import pipeline
+
+
+def make_emails(tempdir, count, attachment_mb):
+    """Emails that each have an inline image and an appended PDF of attachment_mb megabytes"""
+    imagepath = os.path.join(tempdir, 'image.png')
+    pdfpath = os.path.join(tempdir, 'appended.pdf')
+    for path in [imagepath, pdfpath]:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(attachment_mb * 1024 * 1024))
+
+    return [emailaction.Email('from@example.com', 'user{}@example.com'.format(i), 'Subject {}'.format(i),
+                              '<p>Body {}</p><img src="VIZ_IMAGE()">'.format(i), None, None,
+                              [{'imagepath': imagepath}], [{'imagepath': pdfpath}])
+            for i in range(count)]
+
+
+def build_all(emails, threads):
+    """Build every email from a pool of threads, as the deliver stage does, returning the seconds taken"""
+    started_at = time.time()
+    with ThreadPoolExecutor(threads) as executor:
+        for recipients, message in executor.map(
+                lambda email: pipeline.run_cpu_bound(emailaction.build_message, email), emails):
+            pass
+    return time.time() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--emails', type=int, default=40)
+    parser.add_argument('--attachment-mb', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='deliver threads building messages at once')
+    parser.add_argument('--processes', type=int, nargs='+', default=[2, 4])
+    args = parser.parse_args()
+
+    log.logger = logging.getLogger()
+    log.logger.setLevel(logging.WARNING)
+    tempdir = tempfile.mkdtemp()
+    config.configs = {'log.level': logging.WARNING, 'temp.dir': tempdir + os.sep}
+    try:
+        emails = make_emails(tempdir, args.emails, args.attachment_mb)
+        print('{} emails with 2 x {} MB attachments, {} threads, {} CPUs'.format(
+            args.emails, args.attachment_mb, args.threads, os.cpu_count()))
+
+        baseline_s = build_all(emails, args.threads)
+        print('processes 0: {:.2f}s'.format(baseline_s))
+
+        for process_count in args.processes:
+            pipeline.start_process_pool(process_count)
+            try:
+                build_all(emails[:process_count], args.threads)  # start the workers before timing
+                elapsed_s = build_all(emails, args.threads)
+            finally:
+                pipeline.stop_process_pool()
+            print('processes {}: {:.2f}s ({:.2f}x)'.format(process_count, elapsed_s, baseline_s / elapsed_s))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#! python
+# -*- coding: utf-8 -*-
+# Benchmark for grouping consolidated email lines with triggerdata.group_rows, against the neighbour comparison
+#   perform_actions did before: walking the sorted rows, building this row's and the next row's recipients and
+#   subject, and starting a new email wherever they differ. Both are run over the same sorted trigger data, and must
+#   produce the same groups. Run from the repository root:
+#
+#   python benchmarks/bench_group_rows.py --rows 10000 100000
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import triggerdata
+
+FIELDNAMES = ['Email Action *', 'Email Subject *', 'Email To *', 'Email From ~', 'Email CC ~', 'Email Body *']
+
+
+def make_trigger_data(rowcount, recipients):
+    """Trigger data sorted as get_unique_vizdata sorts it, with rows spread over recipients emails"""
+    rows = []
+    for i in range(rowcount):
+        recipient = i % recipients
+        rows.append(['1', 'Subject {}'.format(recipient), 'user{}@example.com'.format(recipient),
+                     'from@example.com', 'cc{}@example.com'.format(recipient % 7), 'Line {}'.format(i)])
+    rows.sort(key=lambda row: (row[1], row[2], row[3], row[4]))
+
+    trigger_data = triggerdata.TriggerData(FIELDNAMES)
+    for row in rows:
+        trigger_data.append(row)
+    return trigger_data
+
+
+def with_next(rows):
+    """Yields each of rows along with the row after it, or None for the last one, as perform_actions used to"""
+    iterator = iter(rows)
+    row = next(iterator, None)
+    while row is not None:
+        next_row = next(iterator, None)
+        yield row, next_row
+        row = next_row
+
+
+def group_by_neighbours(rows):
+    """The grouping done by the old perform_actions loop, without building the emails"""
+    group = []
+    for row, next_row in with_next(rows):
+        group.append(row)
+        if next_row is None:
+            yield group
+            break
+
+        this_row_recipients = [row['Email Subject *'], row['Email To *'], row['Email From ~'], row['Email CC ~']]
+        next_row_recipients = [next_row['Email Subject *'], next_row['Email To *'], next_row['Email From ~'],
+                               next_row['Email CC ~']]
+        if this_row_recipients != next_row_recipients or not next_row['Email Action *']:
+            yield group
+            group = []
+
+
+def group_key(row):
+    """The key get_email_group_key builds for these fields"""
+    return row['Email Subject *'], row['Email To *'], row['Email From ~'], row['Email CC ~']
+
+
+def time_grouping(function, repeats):
+    """Best of repeats runs, returning (seconds, groups)"""
+    best_s = None
+    for repeat in range(repeats):
+        started_at = time.time()
+        groups = [[row.index for row in group] for group in function()]
+        elapsed_s = time.time() - started_at
+        best_s = elapsed_s if best_s is None else min(best_s, elapsed_s)
+    return best_s, groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--recipients', type=int, default=500, help='number of distinct emails the rows make up')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for rowcount in args.rows:
+        trigger_data = make_trigger_data(rowcount, args.recipients)
+        old_s, old_groups = time_grouping(lambda: group_by_neighbours(trigger_data), args.repeats)
+        new_s, new_groups = time_grouping(lambda: triggerdata.group_rows(trigger_data, group_key), args.repeats)
+        if old_groups != new_groups:
+            raise AssertionError('group_rows grouped {} rows differently'.format(rowcount))
+        print('{} rows, {} emails: neighbour comparison {:.3f}s, group_rows {:.3f}s ({:.2f}x)'.format(
+            rowcount, len(new_groups), old_s, new_s, old_s / new_s))
+
+
+if __name__ == '__main__':
+    main()
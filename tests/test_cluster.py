@@ -0,0 +1,152 @@
+#! python
+# -*- coding: utf-8 -*-
+# Runs several VizAlerts nodes sharing one schedule.state.dir against a stub Tableau Server, checking that between
+#   them they run every alert exactly once
+
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from vizalert import cluster
+
+SOURCE_VIZ = 'VizAlertsConfig/ScheduledTriggerViews'
+
+SOURCE_FIELDS = [
+    'action_enabled_email', 'action_enabled_sms', 'alert_type', 'allowed_from_address',
+    'allowed_recipient_addresses', 'allowed_recipient_numbers', 'customized_view_id', 'data_retrieval_tries',
+    'force_refresh', 'from_number', 'is_test', 'is_triggered_by_refresh', 'notify_subscriber_on_failure',
+    'owner_email', 'owner_friendly_name', 'owner_sysname', 'phone_country_code', 'priority', 'project_id',
+    'project_name', 'ran_last_at', 'run_next_at', 'schedule_frequency', 'schedule_id', 'schedule_name',
+    'schedule_type', 'site_id', 'site_name', 'subscriber_domain', 'subscriber_email', 'subscriber_license',
+    'subscriber_sysname', 'subscriber_user_id', 'subscription_id', 'timeout_s', 'view_id', 'view_name',
+    'view_owner_id', 'view_url_suffix', 'viz_data_maxrows', 'viz_png_height', 'viz_png_width', 'workbook_id',
+    'workbook_repository_url']
+
+
+def source_row(subscription_id):
+    """A test alert, which runs the first time it's seen"""
+    row = dict((field, '1') for field in SOURCE_FIELDS)
+    row.update({
+        'alert_type': 'simple', 'allowed_from_address': '.*', 'allowed_recipient_addresses': '.*',
+        'allowed_recipient_numbers': '.*', 'customized_view_id': '', 'force_refresh': 'false', 'is_test': 'true',
+        'is_triggered_by_refresh': 'false', 'notify_subscriber_on_failure': 'false',
+        'ran_last_at': '2020-01-01 00:00:00', 'run_next_at': '2020-01-01 00:00:00', 'site_name': 'Default',
+        'subscriber_email': 'user@example.com', 'subscriber_license': 'Interactor',
+        'subscription_id': str(subscription_id), 'view_url_suffix': 'wb/view{}'.format(subscription_id)})
+    return ','.join([row[field] for field in SOURCE_FIELDS])
+
+
+class StubServer(object):
+    """Serves trusted tickets, the source viz, and empty trigger data for every other view, counting the exports
+        of each view"""
+
+    def __init__(self, subscription_ids):
+        self.source_csv = ','.join(SOURCE_FIELDS) + '\n' + \
+            ''.join([source_row(subscription_id) + '\n' for subscription_id in subscription_ids])
+        self.exports = collections.Counter()
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body):
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.reply('TICKET')
+
+            def do_GET(self):
+                view = urllib.parse.urlparse(self.path).path.split('/views/', 1)[1]
+                if view == SOURCE_VIZ:
+                    return self.reply(stub.source_csv)
+                with stub.lock:
+                    stub.exports[view] += 1
+                self.reply('Field\n')  # no rows, so the alert has nothing to send
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.subscription_ids = list(range(1, 31))
+        self.server = StubServer(self.subscription_ids)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+
+    def write_config(self, node_id, node_count):
+        with open(os.path.join(REPO_DIR, 'config', 'vizalerts.yaml')) as f:
+            configs = yaml.safe_load(f)
+        for key, dirname in [('log.dir', 'logs'), ('temp.dir', 'temp'), ('schedule.state.dir', 'ops')]:
+            configs[key] = os.path.join(self.tempdir, dirname) + os.sep
+        configs.update({
+            'server': '127.0.0.1:{}'.format(self.server.server.server_port),
+            'log.level': 'INFO',
+            'cluster.node_id': node_id,
+            'cluster.node_count': node_count})
+        path = os.path.join(self.tempdir, 'node{}.yaml'.format(node_id))
+        with open(path, 'w') as f:
+            yaml.safe_dump(configs, f)
+        return path
+
+    def run_nodes(self, node_count):
+        """Run every node at once, each in its own process"""
+        processes = [subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'vizalerts.py'),
+                                       '-c', self.write_config(node_id, node_count)],
+                                      cwd=self.tempdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                     for node_id in range(1, node_count + 1)]
+        for process in processes:
+            output = process.communicate(timeout=120)[0]
+            self.assertEqual(process.returncode, 0, output.decode('utf-8', 'replace'))
+
+    def test_each_alert_runs_once(self):
+        node_count = 3
+        self.run_nodes(node_count)
+
+        expected = dict(('wb/view{}'.format(subscription_id), 1) for subscription_id in self.subscription_ids)
+        self.assertEqual(dict(self.server.exports), expected)
+
+        # and every node had some of them to run
+        ring = cluster.HashRing(node_count)
+        self.assertEqual(set([ring.get_node(subscription_id) for subscription_id in self.subscription_ids]),
+                         set(range(1, node_count + 1)))
+
+        # test alerts only run the first time they're seen, so running again runs nothing
+        self.run_nodes(node_count)
+        self.assertEqual(dict(self.server.exports), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
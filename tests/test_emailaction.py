@@ -0,0 +1,162 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests of sending email over pooled SMTP connections, against a stub SMTP server
+
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import config
+from vizalert import emailaction
+from vizalert import log
+
+
+class StubSmtpServer(object):
+    """Accepts every message, counting connections and keeping each message's recipients. Can be told to drop
+        every open connection, as a server does to connections left idle too long"""
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = []  # list of recipient lists
+        self.open_sockets = []
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode('ascii'))
+
+            def handle(self):
+                with stub.lock:
+                    stub.connections += 1
+                    stub.open_sockets.append(self.request)
+                self.reply('220 stub ESMTP')
+                recipients = []
+                while True:
+                    line = self.rfile.readline().decode('ascii').rstrip('\r\n')
+                    if not line:
+                        return  # dropped
+                    command = line.split(' ', 1)[0].upper()
+                    if command in ('EHLO', 'HELO'):
+                        self.reply('250 stub')
+                    elif command == 'MAIL':
+                        recipients = []
+                        self.reply('250 OK')
+                    elif command == 'RCPT':
+                        recipients.append(line.split(':', 1)[1].strip('<> '))
+                        self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 go ahead')
+                        while self.rfile.readline() not in (b'.\r\n', b''):
+                            pass
+                        with stub.lock:
+                            stub.messages.append(recipients)
+                        self.reply('250 OK')
+                    elif command == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('250 OK')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def drop_connections(self):
+        with self.lock:
+            open_sockets = self.open_sockets
+            self.open_sockets = []
+        for sock in open_sockets:
+            try:
+                sock.shutdown(2)
+            except OSError:
+                pass
+        time.sleep(0.1)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SmtpPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        log.logger = logging.getLogger()
+        self.smtp = StubSmtpServer()
+        self.saved_configs = config.configs
+        config.configs = {
+            'smtp.serv': '127.0.0.1',
+            'smtp.port': self.smtp.server.server_address[1],
+            'smtp.ssl': False,
+            'smtp.user': None,
+            'smtp.password': None}
+
+    def tearDown(self):
+        emailaction.smtp_pool = None
+        config.configs = self.saved_configs
+        self.smtp.stop()
+
+    def send(self, toaddrs):
+        return emailaction.send_email(emailaction.Email('vizalerts@example.com', toaddrs, 'Test', 'Body'))
+
+    def test_without_pool(self):
+        self.send('a@example.com')
+        self.send('b@example.com')
+        self.assertEqual(self.smtp.messages, [['a@example.com'], ['b@example.com']])
+        self.assertEqual(self.smtp.connections, 2)
+
+    def test_connection_is_reused(self):
+        emailaction.smtp_pool = emailaction.SmtpPool(2, 60)
+        for address in ['a@example.com', 'b@example.com', 'c@example.com']:
+            self.send(address)
+        self.assertEqual(self.smtp.messages, [['a@example.com'], ['b@example.com'], ['c@example.com']])
+        self.assertEqual(self.smtp.connections, 1)
+
+    def test_reconnects_when_server_drops_idle_connection(self):
+        emailaction.smtp_pool = emailaction.SmtpPool(2, 60)
+        self.send('a@example.com')
+        self.smtp.drop_connections()
+
+        self.send('b@example.com')
+        self.assertEqual(self.smtp.messages, [['a@example.com'], ['b@example.com']])
+        self.assertEqual(self.smtp.connections, 2)
+
+    def test_idle_connection_expires(self):
+        emailaction.smtp_pool = emailaction.SmtpPool(2, 0.2)
+        self.send('a@example.com')
+        time.sleep(0.3)
+
+        self.send('b@example.com')
+        self.assertEqual(self.smtp.connections, 2)
+
+    def test_concurrent_senders_share_pool(self):
+        emailaction.smtp_pool = emailaction.SmtpPool(3, 60)
+
+        def send_several(index):
+            for message in range(5):
+                self.send('user{}@example.com'.format(index))
+
+        threads = [threading.Thread(target=send_several, args=(index,)) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.smtp.messages), 15)
+        self.assertLessEqual(self.smtp.connections, 3)
+        emailaction.smtp_pool.close()
+        self.assertEqual(emailaction.smtp_pool.idle, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests of the processing stages, run with stand-ins for alerts and their delivery tasks
+
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import log
+from vizalert import pipeline
+
+
+class FakeHistory(object):
+
+    def expected(self, alert):
+        return 1
+
+
+class FakeTask(object):
+    """A delivery task that takes send_s seconds to send"""
+
+    def __init__(self, alert, index, send_s):
+        self.alert = alert
+        self.task_uuid = '{}-{}'.format(alert.view_name, index)
+        self.send_s = send_s
+
+    def execute_task(self):
+        time.sleep(self.send_s)
+        with self.alert.lock:
+            self.alert.delivered.append(self.task_uuid)
+
+
+class FakeAlert(object):
+    """An alert that builds task_count tasks, each taking send_s seconds to deliver, after build_s seconds"""
+
+    def __init__(self, name, task_count, send_s, build_s=0):
+        self.view_name = name
+        self.subscription_id = name
+        self.view_id = name
+        self.customized_view_id = ''
+        self.site_name = 'Default'
+        self.owner_sysname = 'owner'
+        self.priority = 1
+        self.run_next_at = ''
+        self.alert_uuid = name
+        self.task_count = task_count
+        self.send_s = send_s
+        self.build_s = build_s
+        self.task_queue = None
+        self.tasks = []
+        self.delivered = []
+        self.abandoned = False
+        self.error_list = []
+        self.failures = 0
+        self.stage_timings = {}
+        self.processing_started_at = None
+        self.processing_finished_at = None
+        self.lock = threading.Lock()
+
+    def fetch_trigger_data(self):
+        return True
+
+    def parse_trigger_data(self):
+        return True
+
+    def render_content_refs(self):
+        pass
+
+    def perform_actions(self):
+        time.sleep(self.build_s)
+        for index in range(self.task_count):
+            task = FakeTask(self, index, self.send_s)
+            self.tasks.append(task)
+            self.task_queue.put(task)
+
+    def alert_failure(self):
+        self.failures += 1
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        log.logger = logging.getLogger()
+
+    def run_alerts(self, alerts, deliver_thread_count=1, queue_size=1, deadline_s=1):
+        alert_pipeline = pipeline.AlertPipeline(1, 1, deliver_thread_count, queue_size, deadline_s)
+        alert_pipeline.run(alerts, FakeHistory())
+
+    def test_waiting_to_deliver_does_not_count_against_build_deadline(self):
+        # building waits on the one slow deliver thread for far longer than the deadline, but each task is quick
+        alert = FakeAlert('large', 8, 0.3)
+        self.run_alerts([alert])
+
+        self.assertFalse(alert.abandoned)
+        self.assertEqual(alert.failures, 0)
+        self.assertEqual(len(alert.delivered), 8)
+
+    def test_slow_build_is_abandoned(self):
+        alert = FakeAlert('stuck', 1, 0, build_s=1.5)
+        self.run_alerts([alert])
+
+        self.assertTrue(alert.abandoned)
+        self.assertEqual(alert.failures, 1)
+        self.assertEqual(alert.delivered, [])
+
+    def test_no_deadline(self):
+        alert = FakeAlert('slow', 1, 0, build_s=1.5)
+        self.run_alerts([alert], deadline_s=0)
+
+        self.assertFalse(alert.abandoned)
+        self.assertEqual(alert.failures, 0)
+        self.assertEqual(len(alert.delivered), 1)
+
+    def test_one_failure_notice_for_abandoned_tasks(self):
+        # two deliver threads, both stalled on every task
+        alert = FakeAlert('stalled', 4, 1.5)
+        self.run_alerts([alert], deliver_thread_count=2, queue_size=4)
+
+        self.assertEqual(alert.failures, 1)
+        self.assertEqual(len(alert.error_list), 1)
+        self.assertTrue(alert.error_list[0].startswith('4 tasks from alert stalled were abandoned'), alert.error_list)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests of the order alerts are processed in
+
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import log
+from vizalert import scheduler
+
+
+class FakeAlert(object):
+
+    def __init__(self, site_name, owner_sysname, name, priority=1):
+        self.site_name = site_name
+        self.owner_sysname = owner_sysname
+        self.name = name
+        self.priority = priority
+        self.run_next_at = ''
+
+
+class FakeHistory(object):
+
+    def expected(self, alert):
+        return 60
+
+
+def make_alerts(site_name, owner_sysname, count):
+    return [FakeAlert(site_name, owner_sysname, '{}{}'.format(site_name, index)) for index in range(count)]
+
+
+class FairSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        log.logger = logging.getLogger()
+
+    def order(self, alerts, **weights):
+        return [alert.name for alert in scheduler.FairScheduler(alerts, FakeHistory(), **weights).order()]
+
+    def test_shares_take_turns(self):
+        alerts = make_alerts('A', 'owner', 4) + make_alerts('B', 'owner', 2)
+        self.assertEqual(self.order(alerts), ['A0', 'B0', 'A1', 'B1', 'A2', 'A3'])
+
+    def test_site_weight(self):
+        alerts = make_alerts('A', 'owner', 2) + make_alerts('B', 'owner', 6)
+        self.assertEqual(self.order(alerts, site_weights={'B': 3}),
+                         ['A0', 'B0', 'B1', 'B2', 'A1', 'B3', 'B4', 'B5'])
+
+    def test_owner_weight_multiplies_site_weight(self):
+        alerts = make_alerts('A', 'alice', 3) + make_alerts('A', 'bob', 3)
+        scheduled = scheduler.FairScheduler(alerts, FakeHistory(), site_weights={'A': 2}, owner_weights={'bob': 0.5})
+        self.assertEqual(scheduled.weight(('A', 'alice')), 2)
+        self.assertEqual(scheduled.weight(('A', 'bob')), 1)
+        self.assertEqual(scheduled.weight(('B', 'bob')), 0.5)
+
+    def test_priority_within_share(self):
+        alerts = [FakeAlert('A', 'owner', 'low', priority=2), FakeAlert('A', 'owner', 'high', priority=1)]
+        self.assertEqual(self.order(alerts), ['high', 'low'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests of the schedule state stores
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import log
+from vizalert import state
+
+
+def record(subscription_id, ran_last_at):
+    return {'site_name': 'Default', 'subscription_id': str(subscription_id), 'view_id': '1',
+            'customized_view_id': '', 'ran_last_at': ran_last_at, 'run_next_at': '2020-01-02 00:00:00',
+            'schedule_id': '1'}
+
+
+class SqliteMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        log.logger = logging.getLogger()
+        self.tempdir = tempfile.mkdtemp()
+        self.sqlite_path = os.path.join(self.tempdir, 'vizalerts_state.db')
+        self.tsv_path = os.path.join(self.tempdir, 'vizalerts.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_tsv(self, records):
+        state.TsvStateStore(self.tsv_path).save(dict((int(r['subscription_id']), r) for r in records))
+
+    def test_migrates_tsv_into_new_database(self):
+        self.write_tsv([record(1, '2020-01-01 00:00:00'), record(2, '2020-01-01 00:00:00')])
+
+        store = state.SqliteStateStore(self.sqlite_path, self.tsv_path)
+        self.assertEqual(store.load(), {1: record(1, '2020-01-01 00:00:00'), 2: record(2, '2020-01-01 00:00:00')})
+        store.close()
+        self.assertFalse(os.path.exists(self.tsv_path))
+        self.assertTrue(os.path.exists(self.tsv_path + '.migrated'))
+
+    def test_migration_keeps_existing_rows(self):
+        store = state.SqliteStateStore(self.sqlite_path)
+        store.load()
+        store.save({1: record(1, '2020-03-01 00:00:00'), 3: record(3, '2020-03-01 00:00:00')})
+        store.close()
+
+        # an old TSV file turns up again, with older state for one subscription and without another
+        self.write_tsv([record(1, '2020-01-01 00:00:00'), record(2, '2020-01-01 00:00:00')])
+
+        store = state.SqliteStateStore(self.sqlite_path, self.tsv_path)
+        self.assertEqual(store.load(), {1: record(1, '2020-03-01 00:00:00'),
+                                        2: record(2, '2020-01-01 00:00:00'),
+                                        3: record(3, '2020-03-01 00:00:00')})
+        store.close()
+        self.assertFalse(os.path.exists(self.tsv_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
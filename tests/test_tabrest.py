@@ -0,0 +1,276 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests of the REST API export backend against a stub Tableau Server REST API
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from vizalert import config
+from vizalert import log
+from vizalert import tabhttp
+from vizalert import tabrest
+from vizalert import throttle
+
+SITE_ID = 'site-1'
+VIEW_ID = 'view-1'
+
+EXPORTS = {
+    'data': ('text/csv', b'Region,Sales\r\nWest,10\r\n'),
+    'image': ('image/png', b'\x89PNG stub'),
+    'pdf': ('application/pdf', b'%PDF-1.4 stub')}
+
+
+class StubRestApi(object):
+    """Signs users in, looks up users and views, and exports the one view. Records every request, and can be told
+        to expire every session. As on Tableau Server, signing in with a personal access token ends the sessions
+        that token signed in before"""
+
+    def __init__(self):
+        self.requests = []  # (method, path, query dict, X-Tableau-Auth, JSON body)
+        self.signins = 0
+        self.valid_tokens = set()
+        self.token_sessions = {}  # personal access token name: session token signed in with it
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, content_type='application/json'):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def record(self, body=None):
+                url = urllib.parse.urlparse(self.path)
+                with stub.lock:
+                    stub.requests.append((self.command, url.path, dict(urllib.parse.parse_qsl(url.query)),
+                                          self.headers.get('X-Tableau-Auth'), body))
+                return url.path, dict(urllib.parse.parse_qsl(url.query))
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                path, query = self.record(body)
+                credentials = body['credentials']
+                user_id = credentials.get('user', {}).get('id', 'admin-id')
+                with stub.lock:
+                    stub.signins += 1
+                    token = 'token-{}-{}'.format(user_id, stub.signins)
+                    stub.valid_tokens.add(token)
+                    if 'personalAccessTokenName' in credentials:
+                        stub.valid_tokens.discard(stub.token_sessions.get(credentials['personalAccessTokenName']))
+                        stub.token_sessions[credentials['personalAccessTokenName']] = token
+                self.reply(200, {'credentials': {'token': token, 'site': {'id': SITE_ID}, 'user': {'id': user_id}}})
+
+            def do_GET(self):
+                path, query = self.record()
+                if self.headers.get('X-Tableau-Auth') not in stub.valid_tokens:
+                    return self.reply(401, {'error': {'code': '401002'}})
+                if path.endswith('/users'):
+                    name = query['filter'].split(':eq:', 1)[1]
+                    return self.reply(200, {'users': {'user': [{'id': 'user-' + name, 'name': name}]}})
+                if path.endswith('/views'):
+                    return self.reply(200, {'views': {'view': [
+                        {'id': 'other-view', 'contentUrl': 'other/sheets/Overview'},
+                        {'id': VIEW_ID, 'contentUrl': 'Superstore/sheets/Overview'}]}})
+                endpoint = path.rsplit('/', 1)[1]
+                if path.startswith('/api/3.4/sites/{}/views/{}/'.format(SITE_ID, VIEW_ID)) and endpoint in EXPORTS:
+                    content_type, body = EXPORTS[endpoint]
+                    return self.reply(200, body, content_type)
+                self.reply(404, {'error': {'code': '404000'}})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def expire_sessions(self):
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def exports(self):
+        return [request for request in self.requests if request[1].rsplit('/', 1)[1] in EXPORTS]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RestExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.api = StubRestApi()
+
+        log.logger = logging.getLogger()
+        self.saved_configs = config.configs
+        config.configs = {
+            'server': '127.0.0.1:{}'.format(self.api.server.server_port),
+            'server.ssl': False,
+            'server.user': 'admin',
+            'rest.api_version': '3.4',
+            'rest.token_name': None,
+            'rest.token_secret': None,
+            'rest.password': 'secret',
+            'temp.dir': self.tempdir + os.sep}
+
+        tabhttp.export_limiter = throttle.AdaptiveLimiter('export', 1, 4, 60)
+        tabhttp.site_limiter = throttle.KeyedLimiter('export.site', 4)
+        tabhttp.workbook_limiter = throttle.KeyedLimiter('export.workbook', 2)
+        tabhttp.session_pool = tabhttp.SessionPool(2, True, False)
+        tabrest.sessions = tabrest.RestSessions()
+
+    def tearDown(self):
+        config.configs = self.saved_configs
+        tabhttp.session_pool = None
+        self.api.stop()
+        shutil.rmtree(self.tempdir)
+
+    def export(self, view_url_suffix, format, force_refresh=False, user='alice'):
+        return tabrest.export_view(view_url_suffix, 'Default', 10, 2, force_refresh, format, 800, 600, user, None)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_sign_in_then_as_subscriber(self):
+        self.export('Superstore/Overview', tabhttp.Format.CSV)
+
+        signins = [request[4]['credentials'] for request in self.api.requests if request[0] == 'POST']
+        self.assertEqual(len(signins), 2)
+        self.assertEqual(signins[0]['name'], 'admin')
+        self.assertEqual(signins[0]['password'], 'secret')
+        self.assertEqual(signins[0]['site'], {'contentUrl': ''})
+        self.assertNotIn('user', signins[0])
+        self.assertEqual(signins[1]['user'], {'id': 'user-alice'})
+
+        # the export was made with the subscriber's token
+        self.assertTrue(self.api.exports()[0][3].startswith('token-user-alice-'))
+
+    def test_sessions_are_reused(self):
+        self.export('Superstore/Overview', tabhttp.Format.CSV)
+        self.export('Superstore/Overview', tabhttp.Format.PNG)
+        self.assertEqual(self.api.signins, 2)
+        self.assertEqual(len(self.api.exports()), 2)
+
+    def test_concurrent_subscribers(self):
+        errors = []
+
+        def export_as(user):
+            try:
+                for format in [tabhttp.Format.CSV, tabhttp.Format.PNG, tabhttp.Format.PDF] * 2:
+                    self.export('Superstore/Overview', format, user=user)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=export_as, args=(user,)) for user in ['alice', 'bob']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.api.signins, 3)  # server.user, then each subscriber once
+        exports = self.api.exports()
+        self.assertEqual(len(exports), 12)
+        self.assertEqual(len([export for export in exports if export[3].startswith('token-user-alice-')]), 6)
+        self.assertEqual(len([export for export in exports if export[3].startswith('token-user-bob-')]), 6)
+
+    def test_signs_in_again_after_401(self):
+        self.export('Superstore/Overview', tabhttp.Format.CSV)
+        self.api.expire_sessions()
+
+        path = self.export('Superstore/Overview', tabhttp.Format.CSV)
+        self.assertEqual(self.read(path), b'Region,Sales\nWest,10\n')
+        self.assertEqual(self.api.signins, 3)
+        exports = self.api.exports()
+        self.assertEqual(len(exports), 3)
+        self.assertNotEqual(exports[1][3], exports[2][3])  # rejected, then retried with a new token
+
+    def test_export_each_format(self):
+        expected = [(tabhttp.Format.CSV, 'data', b'Region,Sales\nWest,10\n'),
+                    (tabhttp.Format.PNG, 'image', EXPORTS['image'][1]),
+                    (tabhttp.Format.PDF, 'pdf', EXPORTS['pdf'][1])]
+        for format, endpoint, content in expected:
+            path = self.export('Superstore/Overview', format)
+            self.assertTrue(path.endswith('.' + format))
+            self.assertEqual(self.read(path), content)
+            self.assertEqual(self.api.exports()[-1][1],
+                             '/api/3.4/sites/{}/views/{}/{}'.format(SITE_ID, VIEW_ID, endpoint))
+
+    def test_export_parameters(self):
+        self.export('Superstore/Overview?Region=West&:size=300,200', tabhttp.Format.PNG, force_refresh=True)
+        self.assertEqual(self.api.exports()[-1][2],
+                         {'vf_Region': 'West', 'vizWidth': '300', 'vizHeight': '200', 'resolution': 'high',
+                          'maxAge': '1'})
+
+    def test_twb_is_not_supported(self):
+        with self.assertRaises(UserWarning):
+            self.export('Superstore/Overview', tabhttp.Format.TWB)
+        self.assertEqual(self.api.requests, [])
+
+    def test_unknown_view(self):
+        with self.assertRaises(UserWarning):
+            self.export('Superstore/Missing', tabhttp.Format.CSV)
+        self.assertEqual(self.api.exports(), [])
+
+
+class RestConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        log.logger = logging.getLogger()
+        self.saved_configs = config.configs
+
+    def tearDown(self):
+        config.configs = self.saved_configs
+        shutil.rmtree(self.tempdir)
+
+    def validate(self, settings):
+        with open(os.path.join(REPO_DIR, 'config', 'vizalerts.yaml')) as f:
+            configs = yaml.safe_load(f)
+        for key in ['schedule.state.dir', 'log.dir', 'temp.dir']:
+            configs[key] = self.tempdir + os.sep
+        configs['export.backend'] = 'rest'
+        configs.update(settings)
+        path = os.path.join(self.tempdir, 'vizalerts.yaml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(configs, f)
+        config.validate_conf(path)
+
+    def test_password(self):
+        self.validate({'rest.password': 'secret'})
+        self.assertEqual(config.configs['rest.password'], 'secret')
+
+    def test_password_required(self):
+        with self.assertRaises(SystemExit):
+            self.validate({})
+
+    def test_personal_access_token_refused(self):
+        with self.assertRaises(SystemExit):
+            self.validate({'rest.token_name': 'vizalerts', 'rest.token_secret': 'secret', 'rest.password': 'secret'})
+
+
+if __name__ == '__main__':
+    unittest.main()
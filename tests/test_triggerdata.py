@@ -0,0 +1,76 @@
+#! python
+# -*- coding: utf-8 -*-
+# Tests that trigger data gives the same rows whether it's held in memory or streamed from disk
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vizalert import triggerdata
+
+# some rows are short, so their last fields are missing (None), and some are duplicates
+TRIGGER_CSV = '''Email Action *,Email To *,Email Subject *,Sort Order ~,Note
+1,b@example.com,Hello,2,x
+1,a@example.com,Hello,1,
+1,a@example.com,Hello,1
+1,a@example.com,Hello,1
+0,c@example.com,Ignored,1,y
+1,a@example.com,Hello
+1,a@example.com,Hello,3,z
+1,b@example.com,Hello,2,x
+1,a@example.com
+'''
+
+FIELDNAMES = ['Email Action *', 'Email To *', 'Email Subject *', 'Sort Order ~', 'Note']
+SORT_FIELDNAMES = ['Email Subject *', 'Email To *', 'Sort Order ~']
+
+
+def unique_rows_in_memory(trigger_data):
+    """What VizAlert.get_unique_vizdata does with trigger data held in memory"""
+    indices = trigger_data.indices_where('Email Action *', '1')
+    indices = trigger_data.distinct_indices(indices, FIELDNAMES)
+    indices = trigger_data.sorted_indices(indices, SORT_FIELDNAMES)
+    return [dict((fieldname, row[fieldname]) for fieldname in FIELDNAMES) for row in trigger_data.rows_at(indices)]
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'trigger.csv')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(TRIGGER_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_streamed_rows_match_rows_in_memory(self):
+        in_memory = triggerdata.read_csv(self.path)
+        streamed = triggerdata.read_csv(self.path, streaming_rows=2)
+        self.assertFalse(in_memory.streamed)
+        self.assertTrue(streamed.streamed)
+        self.assertEqual(len(in_memory), len(streamed))
+
+        expected = unique_rows_in_memory(in_memory)
+        # a buffer of 2 rows makes the external sorts merge several runs
+        actual = list(triggerdata.stream_unique_rows(streamed, 'Email Action *', FIELDNAMES, SORT_FIELDNAMES, 2,
+                                                     self.tempdir))
+        self.assertEqual(actual, expected)
+
+        # missing fields are None in both, and are kept apart from fields that are present but empty
+        self.assertEqual([(row['Email To *'], row['Email Subject *'], row['Sort Order ~'], row['Note'])
+                          for row in actual],
+                         [('a@example.com', None, None, None),
+                          ('a@example.com', 'Hello', None, None),
+                          ('a@example.com', 'Hello', '1', ''),
+                          ('a@example.com', 'Hello', '1', None),
+                          ('a@example.com', 'Hello', '3', 'z'),
+                          ('b@example.com', 'Hello', '2', 'x')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+#! python
+# -*- coding: utf-8 -*-
+# Caches of results shared by all VizAlerts in a run
+
+import threading
+from collections import OrderedDict
+
+# import local modules
+from . import stats
+
+
+class LRUCache(object):
+    """Remembers the most recently used results, up to size of them, counting hits and misses in the stats as
+        name.hits and name.misses"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Returns the result for key, calling compute() to get it if it isn't cached"""
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                stats.increment('{}.hits'.format(self.name))
+                return self.results[key]
+
+        result = compute()
+        stats.increment('{}.misses'.format(self.name))
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+        return result
@@ -0,0 +1,35 @@
+#! python
+# -*- coding: utf-8 -*-
+# Splits subscriptions across cooperating VizAlerts instances, so each alert is only processed by one of them
+
+import hashlib
+from bisect import bisect
+
+# number of points each node gets on the hash ring. More points spread subscriptions more evenly
+VIRTUAL_NODES = 100
+
+
+class HashRing(object):
+    """Consistent hash ring mapping subscription ids to node ids 1..node_count.
+        Every instance builds the same ring, so they all agree on which node owns each subscription, and changing
+        node_count only moves the subscriptions of the nodes added or removed"""
+
+    def __init__(self, node_count):
+        self.node_count = node_count
+        points = []
+        for node_id in range(1, node_count + 1):
+            for vnode in range(VIRTUAL_NODES):
+                points.append((hash_key('node{}-{}'.format(node_id, vnode)), node_id))
+        points.sort()
+        self.point_hashes = [point[0] for point in points]
+        self.point_nodes = [point[1] for point in points]
+
+    def get_node(self, subscription_id):
+        """Returns the id of the node that owns a subscription"""
+        index = bisect(self.point_hashes, hash_key(str(subscription_id))) % len(self.point_hashes)
+        return self.point_nodes[index]
+
+
+def hash_key(key):
+    """Stable hash of a string--Python's own hash() is salted per process, so it can't be shared between hosts"""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
@@ -9,6 +9,8 @@ import sys
 import tabUtil
 from . import config
 from . import log
+from . import scheduler
+from . import state
 
 configs = []
 
@@ -50,11 +52,115 @@ required_conf_keys = \
 
 # yaml configuration values that we accept, but are not required
 optional_conf_keys = \
-    ['data.coldelimiter']
+    ['cluster.node_count',
+    'cluster.node_id',
+    'daemon.interval_seconds',
+    'data.coldelimiter',
+    'data.sort_buffer_rows',
+    'data.streaming_rows',
+    'deliver.threads',
+    'export.concurrency.ceiling',
+    'export.concurrency.floor',
+    'export.backend',
+    'export.latency_target_seconds',
+    'export.site_limit',
+    'export.workbook_limit',
+    'history.retention_days',
+    'http.keepalive',
+    'http.ntlm.cache_size',
+    'http.ntlm.idle_timeout_seconds',
+    'http.pool_size',
+    'pipeline.deadline_seconds',
+    'pipeline.queue_size',
+    'processes',
+    'render.threads',
+    'rest.api_version',
+    'rest.password',
+    'rest.token_name',  # not supported, but recognized so we can say why
+    'rest.token_secret',
+    'schedule.state.backend',
+    'scheduler.default_duration_seconds',
+    'scheduler.order',
+    'scheduler.owner_weights',
+    'scheduler.site_weights',
+    'smtp.idle_timeout_seconds',
+    'smtp.pool_size',
+    'trusted.prefetch.max_age_seconds',
+    'trusted.prefetch.pool_size']
 
 # default delimiter for CSV exports
 DEFAULT_COL_DELIMITER = ','
 
+# by default, trigger data with more than this many rows is streamed from disk rather than held in memory,
+#   and is sorted on disk this many rows at a time
+DEFAULT_DATA_STREAMING_ROWS = 100000
+DEFAULT_DATA_SORT_BUFFER_ROWS = 50000
+
+# by default, a single VizAlerts instance processes all subscriptions
+DEFAULT_CLUSTER_NODE_COUNT = 1
+DEFAULT_CLUSTER_NODE_ID = 1
+
+# default number of seconds between alert checks when running with --daemon
+DEFAULT_DAEMON_INTERVAL_SECONDS = 60
+
+# default sizes of the render and deliver worker pools, and of the queue feeding each processing stage
+DEFAULT_RENDER_THREADS = 2
+DEFAULT_DELIVER_THREADS = 2
+DEFAULT_PIPELINE_QUEUE_SIZE = 100
+
+# default bounds on the number of exports run on Tableau Server at once, and the time an export should take
+#   before we assume the server is struggling and back off
+DEFAULT_EXPORT_CONCURRENCY_FLOOR = 1
+DEFAULT_EXPORT_CONCURRENCY_CEILING = 8
+DEFAULT_EXPORT_LATENCY_TARGET_SECONDS = 60
+
+# default number of exports run at once for any one site, and for any one workbook
+DEFAULT_EXPORT_SITE_LIMIT = 4
+DEFAULT_EXPORT_WORKBOOK_LIMIT = 2
+
+# default number of seconds any one stage may spend on an alert or message before giving up on it (0 means no limit)
+DEFAULT_PIPELINE_DEADLINE_SECONDS = 1800
+
+# by default, requests to Tableau Server share up to this many keep-alive sessions
+DEFAULT_HTTP_POOL_SIZE = 8
+DEFAULT_HTTP_KEEPALIVE = True
+
+# by default, up to this many idle SMTP connections are kept for the next message, for this many seconds.
+#   SMTP servers should wait at least five minutes before dropping an idle connection (RFC 5321)
+DEFAULT_SMTP_POOL_SIZE = 2
+DEFAULT_SMTP_IDLE_TIMEOUT_SECONDS = 240
+
+# by default, up to this many sessions authenticated as AD users are kept for their next export, for this many seconds
+DEFAULT_HTTP_NTLM_CACHE_SIZE = 32
+DEFAULT_HTTP_NTLM_IDLE_TIMEOUT_SECONDS = 300
+
+# by default, trusted tickets aren't prefetched. Prefetched tickets are thrown away after this many seconds,
+#   well within Tableau Server's default ticket timeout of three minutes
+DEFAULT_TRUSTED_PREFETCH_POOL_SIZE = 0
+DEFAULT_TRUSTED_PREFETCH_MAX_AGE_SECONDS = 120
+
+# export backends, set with export.backend: a trusted ticket for each export (tabhttp), or the REST API (tabrest)
+EXPORT_BACKEND_TRUSTED = 'trusted'
+EXPORT_BACKEND_REST = 'rest'
+EXPORT_BACKENDS = [EXPORT_BACKEND_TRUSTED, EXPORT_BACKEND_REST]
+
+# by default, views are exported with a trusted ticket for each export. The REST API backend uses this API version
+DEFAULT_EXPORT_BACKEND = EXPORT_BACKEND_TRUSTED
+DEFAULT_REST_API_VERSION = '3.4'
+
+# default number of days to keep the execution history of alerts for
+DEFAULT_HISTORY_RETENTION_DAYS = 90
+
+# by default, schedule state is kept in a SQLite database
+DEFAULT_SCHEDULE_STATE_BACKEND = state.BACKEND_SQLITE
+
+# by default, alerts sharing a priority are ordered longest first, and those never run before are assumed to take this long
+DEFAULT_SCHEDULER_ORDER = scheduler.ORDER_LONGEST_FIRST
+DEFAULT_SCHEDULER_DEFAULT_DURATION_SECONDS = 60
+
+# default number of worker processes for CPU-bound work (0 means do it in the calling thread)
+DEFAULT_PROCESSES = 0
+
 
 def validate_conf(configfile):
     """Import config values and do some basic validations"""
@@ -163,10 +269,159 @@ def validate_conf(configfile):
             sys.exit(1)
     else:
         localconfigs['data.coldelimiter'] = DEFAULT_COL_DELIMITER
-    
+
+    # validate trigger data streaming settings
+    set_int(localconfigs, 'data.streaming_rows', DEFAULT_DATA_STREAMING_ROWS, 0)
+    set_int(localconfigs, 'data.sort_buffer_rows', DEFAULT_DATA_SORT_BUFFER_ROWS)
+
+    # validate daemon.interval_seconds
+    set_int(localconfigs, 'daemon.interval_seconds', DEFAULT_DAEMON_INTERVAL_SECONDS)
+
+    # validate processing stage settings
+    set_int(localconfigs, 'render.threads', DEFAULT_RENDER_THREADS)
+    set_int(localconfigs, 'deliver.threads', DEFAULT_DELIVER_THREADS)
+    set_int(localconfigs, 'pipeline.queue_size', DEFAULT_PIPELINE_QUEUE_SIZE)
+    set_int(localconfigs, 'pipeline.deadline_seconds', DEFAULT_PIPELINE_DEADLINE_SECONDS, 0)
+    set_int(localconfigs, 'processes', DEFAULT_PROCESSES, 0)
+
+    # validate export concurrency settings
+    set_int(localconfigs, 'export.concurrency.floor', DEFAULT_EXPORT_CONCURRENCY_FLOOR)
+    set_int(localconfigs, 'export.concurrency.ceiling', DEFAULT_EXPORT_CONCURRENCY_CEILING)
+    set_int(localconfigs, 'export.latency_target_seconds', DEFAULT_EXPORT_LATENCY_TARGET_SECONDS)
+    set_int(localconfigs, 'export.site_limit', DEFAULT_EXPORT_SITE_LIMIT)
+    set_int(localconfigs, 'export.workbook_limit', DEFAULT_EXPORT_WORKBOOK_LIMIT)
+    if localconfigs['export.concurrency.floor'] > localconfigs['export.concurrency.ceiling']:
+        errormessage = 'Configuration value export.concurrency.floor cannot be greater than export.concurrency.ceiling.'
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+
+    # validate HTTP session settings
+    set_int(localconfigs, 'http.pool_size', DEFAULT_HTTP_POOL_SIZE)
+    set_bool(localconfigs, 'http.keepalive', DEFAULT_HTTP_KEEPALIVE)
+    set_int(localconfigs, 'http.ntlm.cache_size', DEFAULT_HTTP_NTLM_CACHE_SIZE, 0)
+    set_int(localconfigs, 'http.ntlm.idle_timeout_seconds', DEFAULT_HTTP_NTLM_IDLE_TIMEOUT_SECONDS)
+
+    # validate SMTP connection settings
+    set_int(localconfigs, 'smtp.pool_size', DEFAULT_SMTP_POOL_SIZE, 0)
+    set_int(localconfigs, 'smtp.idle_timeout_seconds', DEFAULT_SMTP_IDLE_TIMEOUT_SECONDS)
+
+    # validate trusted ticket prefetch settings
+    set_int(localconfigs, 'trusted.prefetch.pool_size', DEFAULT_TRUSTED_PREFETCH_POOL_SIZE, 0)
+    set_int(localconfigs, 'trusted.prefetch.max_age_seconds', DEFAULT_TRUSTED_PREFETCH_MAX_AGE_SECONDS)
+
+    # validate export backend settings
+    if 'export.backend' not in list(localconfigs.keys()) or localconfigs['export.backend'] is None:
+        localconfigs['export.backend'] = DEFAULT_EXPORT_BACKEND
+    elif localconfigs['export.backend'] not in EXPORT_BACKENDS:
+        errormessage = 'Configuration value export.backend must be one of {}.'.format(', '.join(EXPORT_BACKENDS))
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+    if 'rest.api_version' not in list(localconfigs.keys()) or localconfigs['rest.api_version'] is None:
+        localconfigs['rest.api_version'] = DEFAULT_REST_API_VERSION
+    localconfigs['rest.api_version'] = str(localconfigs['rest.api_version'])
+    for key in ['rest.token_name', 'rest.token_secret', 'rest.password']:
+        if key not in list(localconfigs.keys()):
+            localconfigs[key] = None
+    if localconfigs['rest.token_name'] or localconfigs['rest.token_secret']:
+        # every subscriber needs a session of their own, and a personal access token only allows one at a time
+        errormessage = 'Personal access tokens (rest.token_name, rest.token_secret) are not supported, since they ' \
+                       'only allow one session at a time. Use rest.password instead.'
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+    if localconfigs['export.backend'] == EXPORT_BACKEND_REST:
+        if localconfigs['rest.password']:
+            localconfigs['rest.password'] = get_password_from_file(localconfigs['rest.password'])
+        else:
+            errormessage = 'Configuration value rest.password is required when export.backend is rest.'
+            print(errormessage)
+            log.logger.error(errormessage)
+            sys.exit(1)
+
+    # validate schedule.state.backend
+    if 'schedule.state.backend' not in list(localconfigs.keys()) or localconfigs['schedule.state.backend'] is None:
+        localconfigs['schedule.state.backend'] = DEFAULT_SCHEDULE_STATE_BACKEND
+    elif localconfigs['schedule.state.backend'] not in state.BACKENDS:
+        errormessage = 'Configuration value schedule.state.backend must be one of {}.'.format(', '.join(state.BACKENDS))
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+
+    # validate scheduler settings
+    set_int(localconfigs, 'scheduler.default_duration_seconds', DEFAULT_SCHEDULER_DEFAULT_DURATION_SECONDS, 0)
+    if 'scheduler.order' not in list(localconfigs.keys()) or localconfigs['scheduler.order'] is None:
+        localconfigs['scheduler.order'] = DEFAULT_SCHEDULER_ORDER
+    elif localconfigs['scheduler.order'] not in scheduler.ORDERS:
+        errormessage = 'Configuration value scheduler.order must be one of {}.'.format(', '.join(scheduler.ORDERS))
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+    set_weights(localconfigs, 'scheduler.site_weights')
+    set_weights(localconfigs, 'scheduler.owner_weights')
+
+    # validate history.retention_days
+    set_int(localconfigs, 'history.retention_days', DEFAULT_HISTORY_RETENTION_DAYS)
+
+    # validate cluster settings
+    set_int(localconfigs, 'cluster.node_count', DEFAULT_CLUSTER_NODE_COUNT)
+    set_int(localconfigs, 'cluster.node_id', DEFAULT_CLUSTER_NODE_ID)
+    if localconfigs['cluster.node_id'] > localconfigs['cluster.node_count']:
+        errormessage = 'Configuration value cluster.node_id cannot be greater than cluster.node_count.'
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+
     config.configs = localconfigs
 
 
+def get_state_path(filename, node_filename):
+    """Path to a state file in schedule.state.dir. When subscriptions are split between several nodes,
+        each node keeps its own, named for its node id"""
+    if config.configs['cluster.node_count'] > 1:
+        filename = node_filename.format(config.configs['cluster.node_id'])
+    return config.configs['schedule.state.dir'] + filename
+
+
+def set_int(localconfigs, key, default, minimum=1):
+    """Ensures an optional config value is a whole number no less than minimum,
+        setting it to the default if it was not provided"""
+    if key not in list(localconfigs.keys()) or localconfigs[key] is None:
+        localconfigs[key] = default
+    elif type(localconfigs[key]) is not int or localconfigs[key] < minimum:
+        errormessage = 'Configuration value {} must be a whole number of at least {}.'.format(key, minimum)
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+
+
+def set_bool(localconfigs, key, default):
+    """Ensures an optional config value is true or false, setting it to the default if it was not provided"""
+    if key not in list(localconfigs.keys()) or localconfigs[key] is None:
+        localconfigs[key] = default
+    elif type(localconfigs[key]) is not bool:
+        errormessage = 'Configuration value {} must be true or false.'.format(key)
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+
+
+def set_weights(localconfigs, key):
+    """Ensures an optional config value maps names to positive numbers, setting it to an empty mapping if it was
+        not provided"""
+    if key not in list(localconfigs.keys()) or localconfigs[key] is None:
+        localconfigs[key] = {}
+    elif type(localconfigs[key]) is not dict or \
+            not all([type(weight) in (int, float) and weight > 0 for weight in list(localconfigs[key].values())]):
+        errormessage = 'Configuration value {} must map names to numbers greater than 0.'.format(key)
+        print(errormessage)
+        log.logger.error(errormessage)
+        sys.exit(1)
+    else:
+        localconfigs[key] = dict((str(name), weight) for name, weight in list(localconfigs[key].items()))
+
+
 def get_password_from_file(password):
     """If password is actually a valid path to a text file, returns contents of text file found.
         Otherwise returns the input string again"""
@@ -5,6 +5,8 @@
 import smtplib
 import re
 import os.path
+import threading
+import time
 from email.encoders import encode_base64
 
 # added for MIME handling
@@ -23,13 +25,25 @@ from email.mime.multipart import MIMEMultipart
 from socket import error as SocketError
 
 # import local modules
+from . import cache
 from . import config
 from . import log
+from . import pipeline
+from . import stats
 from . import vizalert
 
 # regular expression used to split recipient address strings into separate email addresses
 EMAIL_RECIP_SPLIT_REGEX = '[\t\n\s;,]'
 
+# number of (address, allow-list pattern) validation results remembered across all alerts
+ADDRESS_CACHE_SIZE = 10000
+
+# validation results shared by every alert
+address_cache = cache.LRUCache('address_validation', ADDRESS_CACHE_SIZE)
+
+# open SMTP connections kept for the next message, if enabled with smtp.pool_size. None means connect for each one
+smtp_pool = None
+
 
 class Email(object):
     """Represents an email to be sent"""
@@ -48,6 +62,92 @@ class Email(object):
         # REVISIT: Should add other methods in this module to this class? Validation, at least.
 
 
+def connect_smtp():
+    """Open a connection to the SMTP server, starting TLS and logging in if configured"""
+    server = smtplib.SMTP(config.configs['smtp.serv'], config.configs['smtp.port'])
+    stats.increment('smtp.connections.new')
+    if config.configs['smtp.ssl']:
+        server.ehlo()
+        server.starttls()
+    if config.configs['smtp.user']:
+        server.login(str(config.configs['smtp.user']), str(config.configs['smtp.password']))
+    return server
+
+
+def close_smtp(server):
+    """Close an SMTP connection, ignoring any error, since it may already have been dropped"""
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+class SmtpPool(object):
+    """Open, logged in SMTP connections, kept between messages and between daemon cycles, so each message doesn't
+        need a new connection, TLS handshake and login. A connection is only used by one thread at a time, so
+        there are as many as there are threads sending at once. Up to size idle connections are kept, and any
+        idle for longer than idle_timeout_s are closed, as the server will likely have dropped them"""
+
+    def __init__(self, size, idle_timeout_s):
+        self.size = size
+        self.idle_timeout_s = idle_timeout_s
+        self.idle = []  # list of (time last used, connection), most recently used last
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take the most recently used idle connection, or open a new one if there isn't one.
+            Returns the connection, and whether it was reused"""
+        server = None
+        with self.lock:
+            now = time.time()
+            expired = [idle_server for used_at, idle_server in self.idle if now - used_at >= self.idle_timeout_s]
+            self.idle = [(used_at, idle_server) for used_at, idle_server in self.idle
+                         if now - used_at < self.idle_timeout_s]
+            if self.idle:
+                server = self.idle.pop()[1]
+
+        for expired_server in expired:
+            close_smtp(expired_server)
+        if server:
+            return server, True
+        return connect_smtp(), False
+
+    def release(self, server):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((time.time(), server))
+                return
+        close_smtp(server)
+
+    def sendmail(self, fromaddr, toaddrs, message):
+        """Send a message over a pooled connection. If the server has closed an idle connection, the message is
+            sent again over a new one"""
+        server, reused = self.acquire()
+        try:
+            try:
+                server.sendmail(fromaddr, toaddrs, message)
+            except smtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                log.logger.debug('SMTP server closed an idle connection, reconnecting')
+                close_smtp(server)
+                server = connect_smtp()
+                server.sendmail(fromaddr, toaddrs, message)
+        except Exception:
+            # the connection may be part way through a message, so don't reuse it
+            close_smtp(server)
+            raise
+        self.release(server)
+
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for used_at, server in idle:
+            close_smtp(server)
+
+
 def send_email(email_instance):
     """Generic function to send an email. The presumption is that all arguments have been validated prior to the call
         to this function.
@@ -63,7 +163,7 @@ def send_email(email_instance):
                             imagepath key that points to the file to be attached.
         appendattachments   Appended (non-inline attachments). See inlineattachments for details on structure.
 
-    Nothing is returned by this function unless there is an exception.
+    Returns the size of the message sent, in bytes.
 
     """
     try:
@@ -75,81 +175,19 @@ def send_email(email_instance):
                                                           email_instance.appendattachments))
         log.logger.debug('email body: {}'.format(email_instance.content))
 
-        # using mixed type because there can be inline and non-inline attachments
-        msg = MIMEMultipart('mixed')
-        msg.set_charset('UTF-8')
-        msg['From'] = Header(email_instance.fromaddr)
-        msg['Subject'] = Header(email_instance.subject, 'utf-8')
-
-        log.logger.debug('TO ADDRESS: {}'.format(email_instance.toaddrs))
-
-        # Process direct recipients
-        toaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.toaddrs)) if len(address) > 0]
-        msg['To'] = Header(', '.join(toaddrs))
-        allrecips = toaddrs
-
-        log.logger.debug('CC ADDRESS: {}'.format(email_instance.ccaddrs))
-
-        # Process indirect recipients
-        if email_instance.ccaddrs:
-            ccaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.ccaddrs)) if len(address) > 0]
-            msg['CC'] = Header(', '.join(ccaddrs))
-            allrecips.extend(ccaddrs)
-
-        log.logger.debug('BCC ADDRESS: {}'.format(email_instance.bccaddrs))
-
-        if email_instance.bccaddrs:
-            bccaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.bccaddrs)) if len(address) > 0]
-            # don't add to header, they are blind carbon-copied
-            allrecips.extend(bccaddrs)
-
-        # Create a section for the body and inline attachments
-        msgalternative = MIMEMultipart('related')
-        msg.attach(msgalternative)
-        msgalternative.attach(MIMEText(email_instance.content, 'html', 'utf-8'))
-
-        # Add inline attachments
-        if email_instance.inlineattachments != None:
-            for vizref in email_instance.inlineattachments:
-                msgalternative.attach(mimify_file(vizref['imagepath'], inline=True))
-
-        # Add appended attachments from Email Attachments field and prevent dup custom filenames
-        #  MC: Feels like this code should be in VizAlert class? Or module? Not sure, leaving it here for now
-        appendedfilenames = []
-        if email_instance.appendattachments != None:
-            appendattachments = vizalert.merge_pdf_attachments(email_instance.appendattachments)
-            for vizref in appendattachments:
-                # if there is no |filename= option set then use the exported imagepath
-                if 'filename' not in vizref:
-                    msg.attach(mimify_file(vizref['imagepath'], inline=False))
-                else:
-                    # we need to make sure the custom filename is unique, if so then
-                    # use the custom filename
-                    if vizref['filename'] not in appendedfilenames:
-                        appendedfilenames.append(vizref['filename'])
-                        msg.attach(mimify_file(vizref['imagepath'], inline=False, overridename=vizref['filename']))
-                    # use the exported imagepath
-                    else:
-                        msg.attach(mimify_file(vizref['imagepath'], inline=False))
-                        log.logger.info('Warning: attempted to attach duplicate filename ' + vizref[
-                            'filename'] + ', using unique auto-generated name instead.')
-
-
-        server = smtplib.SMTP(config.configs['smtp.serv'], config.configs['smtp.port'])
-        if config.configs['smtp.ssl']:
-            server.ehlo()
-            server.starttls()
-        if config.configs['smtp.user']:
-            server.login(str(config.configs['smtp.user']), str(config.configs['smtp.password']))
-
-        # from http://wordeology.com/computer/how-to-send-good-unicode-email-with-python.html
-        io = StringIO()
-        g = Generator(io, False)  # second argument means "should I mangle From?"
-        g.flatten(msg)
-
-        server.sendmail(email_instance.fromaddr, [addr for addr in allrecips],
-                        io.getvalue())
-        server.quit()
+        # building the message is CPU-heavy for large attachments, so it may be done in a worker process
+        allrecips, message = pipeline.run_cpu_bound(build_message, email_instance)
+
+        stats.increment('smtp.messages')
+        if smtp_pool:
+            smtp_pool.sendmail(email_instance.fromaddr, allrecips, message)
+        else:
+            server = connect_smtp()
+            try:
+                server.sendmail(email_instance.fromaddr, allrecips, message)
+            finally:
+                close_smtp(server)
+        return len(message.encode('utf-8'))
     except smtplib.SMTPConnectError as e:
         log.logger.error('Email failed to send; there was an issue connecting to the SMTP server: {}'.format(e))
         raise e
@@ -167,8 +205,81 @@ def send_email(email_instance):
         raise e
 
 
+def build_message(email_instance):
+    """Builds the MIME message for an Email, including encoding and merging its attachments.
+        Returns a tuple of the list of all recipient addresses and the flattened message text.
+        This is module-level so it can be run in a worker process (see pipeline.run_cpu_bound)"""
+
+    # using mixed type because there can be inline and non-inline attachments
+    msg = MIMEMultipart('mixed')
+    msg.set_charset('UTF-8')
+    msg['From'] = Header(email_instance.fromaddr)
+    msg['Subject'] = Header(email_instance.subject, 'utf-8')
+
+    log.logger.debug('TO ADDRESS: {}'.format(email_instance.toaddrs))
+
+    # Process direct recipients
+    toaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.toaddrs)) if len(address) > 0]
+    msg['To'] = Header(', '.join(toaddrs))
+    allrecips = toaddrs
+
+    log.logger.debug('CC ADDRESS: {}'.format(email_instance.ccaddrs))
+
+    # Process indirect recipients
+    if email_instance.ccaddrs:
+        ccaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.ccaddrs)) if len(address) > 0]
+        msg['CC'] = Header(', '.join(ccaddrs))
+        allrecips.extend(ccaddrs)
+
+    log.logger.debug('BCC ADDRESS: {}'.format(email_instance.bccaddrs))
+
+    if email_instance.bccaddrs:
+        bccaddrs = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, email_instance.bccaddrs)) if len(address) > 0]
+        # don't add to header, they are blind carbon-copied
+        allrecips.extend(bccaddrs)
+
+    # Create a section for the body and inline attachments
+    msgalternative = MIMEMultipart('related')
+    msg.attach(msgalternative)
+    msgalternative.attach(MIMEText(email_instance.content, 'html', 'utf-8'))
+
+    # Add inline attachments
+    if email_instance.inlineattachments != None:
+        for vizref in email_instance.inlineattachments:
+            msgalternative.attach(mimify_file(vizref['imagepath'], inline=True))
+
+    # Add appended attachments from Email Attachments field and prevent dup custom filenames
+    #  MC: Feels like this code should be in VizAlert class? Or module? Not sure, leaving it here for now
+    appendedfilenames = []
+    if email_instance.appendattachments != None:
+        appendattachments = vizalert.merge_pdf_attachments(email_instance.appendattachments)
+        for vizref in appendattachments:
+            # if there is no |filename= option set then use the exported imagepath
+            if 'filename' not in vizref:
+                msg.attach(mimify_file(vizref['imagepath'], inline=False))
+            else:
+                # we need to make sure the custom filename is unique, if so then
+                # use the custom filename
+                if vizref['filename'] not in appendedfilenames:
+                    appendedfilenames.append(vizref['filename'])
+                    msg.attach(mimify_file(vizref['imagepath'], inline=False, overridename=vizref['filename']))
+                # use the exported imagepath
+                else:
+                    msg.attach(mimify_file(vizref['imagepath'], inline=False))
+                    log.logger.info('Warning: attempted to attach duplicate filename ' + vizref[
+                        'filename'] + ', using unique auto-generated name instead.')
+
+    # from http://wordeology.com/computer/how-to-send-good-unicode-email-with-python.html
+    io = StringIO()
+    g = Generator(io, False)  # second argument means "should I mangle From?"
+    g.flatten(msg)
+
+    return allrecips, io.getvalue()
+
+
 def addresses_are_invalid(emailaddresses, emptystringok, regex_eval=None):
-    """Validates all email addresses found in a given string, optionally that conform to the regex_eval"""
+    """Validates all email addresses found in a given string, optionally that conform to the compiled
+        regex_eval pattern"""
     log.logger.debug('Validating email field value: {}'.format(emailaddresses))
     address_list = [address for address in filter(None, re.split(EMAIL_RECIP_SPLIT_REGEX, emailaddresses)) if len(address) > 0]
     for address in address_list:
@@ -186,28 +297,35 @@ def addresses_are_invalid(emailaddresses, emptystringok, regex_eval=None):
 
 
 def address_is_invalid(address, regex_eval=None):
-    """Checks for a syntactically invalid email address."""
+    """Checks for a syntactically invalid email address, optionally that it conforms to the compiled
+        regex_eval pattern. Results are cached"""
+    return address_cache.get((address, regex_eval), lambda: check_address(address, regex_eval))
+
+
+def check_address(address, regex_eval=None):
+    """Returns an error message if address is invalid, or None. Failures are only logged at debug level,
+        since they're reported per row by validate_addresses"""
     # (most code derived from from http://zeth.net/archive/2008/05/03/email-syntax-check)
 
     # Email address must not be empty
     if address is None or len(address) == 0 or address == '':
         errormessage = 'Address is empty'
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     # Validate address according to admin regex
     if regex_eval:
-        log.logger.debug("testing address {} against regex {}".format(address, regex_eval))
-        if not re.match(regex_eval, address, re.IGNORECASE):
-            errormessage = 'Address must match regex pattern set by the administrator: {}'.format(regex_eval)
-            log.logger.error(errormessage)
+        log.logger.debug("testing address {} against regex {}".format(address, regex_eval.pattern))
+        if not regex_eval.match(address):
+            errormessage = 'Address must match regex pattern set by the administrator: {}'.format(regex_eval.pattern)
+            log.logger.debug(errormessage)
             return errormessage
 
     # Email address must be 6 characters in total.
     # This is not an RFC defined rule but is easy
     if len(address) < 6:
         errormessage = 'Address is too short: {}'.format(address)
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     # Unicode in addresses not yet supported
@@ -215,7 +333,7 @@ def address_is_invalid(address, regex_eval=None):
         address.encode(encoding='ascii', errors='strict')
     except Exception as e:
         errormessage = 'Address must contain only ASCII characers: {}'.format(address)
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     # Split up email address into parts.
@@ -228,7 +346,7 @@ def address_is_invalid(address, regex_eval=None):
                                                                                                      toplevel))
     except ValueError:
         errormessage = 'Address has too few parts'
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     for i in '-_.%+.':
@@ -241,19 +359,19 @@ def address_is_invalid(address, regex_eval=None):
     # check for length
     if len(localpart) > 64:
         errormessage = 'Localpart of address exceeds max length (65 characters)'
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     if len(address) > 254:
         errormessage = 'Address exceeds max length (254 characters)'
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
     if localpart.isalnum() and host.isalnum():
         return None  # Email address is fine.
     else:
         errormessage = 'Address has funny characters'
-        log.logger.error(errormessage)
+        log.logger.debug(errormessage)
         return errormessage
 
 
@@ -314,43 +432,50 @@ def validate_addresses(vizdata,
                        email_cc_actionfield,
                        email_bcc_actionfield):
     """Loops through the viz data for an Advanced Alert and returns a list of dicts
-        containing any errors found in recipients"""
+        containing any errors found in recipients. Each distinct field value is only validated once"""
 
     errorlist = []
     rownum = 2  # account for field header in CSV
+    value_results = {}  # (field value, emptystringok, pattern): result of addresses_are_invalid
+
+    def validate(emailaddresses, emptystringok, regex_eval):
+        key = (emailaddresses, emptystringok, regex_eval)
+        if key not in value_results:
+            value_results[key] = addresses_are_invalid(emailaddresses, emptystringok, regex_eval)
+        return value_results[key]
+
+    to_fieldname = email_to_actionfield.field_name if email_to_actionfield.field_name else email_to_actionfield.name
+    from_fieldname = email_from_actionfield.field_name if email_from_actionfield.field_name \
+        else email_from_actionfield.name
 
     for row in vizdata:
         if len(row) > 0:
-            if email_action_actionfield.get_value_from_dict(row) == '1':\
+            if email_action_actionfield.get_value_from_dict(row) == '1':
 
-                email_to = email_to_actionfield.get_value_from_dict(row)
-                log.logger.debug('Validating "To" addresses: {}'.format(email_to))
-                result = addresses_are_invalid(email_to, False, allowed_recipient_addresses)  # empty string not acceptable as a To address
+                # empty string not acceptable as a To address
+                result = validate(email_to_actionfield.get_value_from_dict(row), False, allowed_recipient_addresses)
                 if result:
-                    errorlist.append(
-                        {'Row': rownum, 'Field': (email_to_actionfield.field_name if email_to_actionfield.field_name else email_to_actionfield.name),
-                        'Value': result['address'], 'Error': result['errormessage']})
-                
-                email_from = email_from_actionfield.get_value_from_dict(row)
-                log.logger.debug('Validating "From" addresses: {}'.format(email_from))
-                result = addresses_are_invalid(email_from, False, allowed_from_address)  # empty string not acceptable as a From address
+                    errorlist.append({'Row': rownum, 'Field': to_fieldname, 'Value': result['address'],
+                                      'Error': result['errormessage']})
+
+                # empty string not acceptable as a From address
+                result = validate(email_from_actionfield.get_value_from_dict(row), False, allowed_from_address)
                 if result:
-                    errorlist.append({'Row': rownum, 'Field': (email_from_actionfield.field_name if email_from_actionfield.field_name else email_from_actionfield.name),
-                        'Value': result['address'], 'Error': result['errormessage']})
+                    errorlist.append({'Row': rownum, 'Field': from_fieldname, 'Value': result['address'],
+                                      'Error': result['errormessage']})
 
                 # REVISIT THIS!
                 if email_cc_actionfield.field_name:
-                    log.logger.debug('Validating "CC" addresses')
-                    result = addresses_are_invalid(row[email_cc_actionfield.field_name], True, allowed_recipient_addresses)
+                    result = validate(row[email_cc_actionfield.field_name], True, allowed_recipient_addresses)
                     if result:
                         errorlist.append({'Row': rownum, 'Field': email_cc_actionfield.field_name, 'Value': result['address'],
                                           'Error': result['errormessage']})
                 if email_bcc_actionfield.field_name:
-                    log.logger.debug('Validating "BCC" addresses')
-                    result = addresses_are_invalid(row[email_bcc_actionfield.field_name], True, allowed_recipient_addresses)
+                    result = validate(row[email_bcc_actionfield.field_name], True, allowed_recipient_addresses)
                     if result:
                         errorlist.append({'Row': rownum, 'Field': email_bcc_actionfield.field_name, 'Value': result['address'],
                                           'Error': result['errormessage']})
         rownum += 1
 
+    log.logger.debug('Validated {} distinct email field values'.format(len(value_results)))
     return errorlist
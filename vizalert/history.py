@@ -0,0 +1,268 @@
+#! python
+# -*- coding: utf-8 -*-
+# Execution history of VizAlerts and their tasks, kept in a SQLite database in schedule.state.dir
+#   Can also be run to report on the history: python -m vizalert.history --help
+
+import argparse
+import codecs
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+# import local modules
+from . import config
+from . import log
+
+# names of the history database, and of the database for one node of several
+HISTORY_FILENAME = 'vizalerts_history.db'
+HISTORY_NODE_FILENAME = 'vizalerts_node{}_history.db'
+
+# names of the flat files expected durations were kept in before the execution history, imported on first use
+DURATIONS_FILENAME = 'vizalerts.durations'
+DURATIONS_NODE_FILENAME = 'vizalerts_node{}.durations'
+
+# expected durations are the average of this many of a subscription's most recent runs
+RECENT_RUNS = 5
+
+# outcomes of an alert or task
+OUTCOME_SUCCEEDED = 'succeeded'
+OUTCOME_NOT_TRIGGERED = 'not_triggered'  # the alert ran, but its trigger data had no rows
+OUTCOME_FAILED = 'failed'
+OUTCOME_ABANDONED = 'abandoned'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS alert_run ('
+    'alert_run_id INTEGER PRIMARY KEY, subscription_id INTEGER, site_name TEXT, view_name TEXT, '
+    'view_url_suffix TEXT, alert_type TEXT, started_at REAL, duration_s REAL, fetch_s REAL, parse_s REAL, '
+    'render_s REAL, build_s REAL, trigger_data_rowcount INTEGER, trigger_data_size_b INTEGER, '
+    'export_retries INTEGER, task_count INTEGER, outcome TEXT, errors TEXT)',
+    'CREATE INDEX IF NOT EXISTS alert_run_subscription ON alert_run (subscription_id, started_at)',
+    'CREATE INDEX IF NOT EXISTS alert_run_started ON alert_run (started_at)',
+    'CREATE TABLE IF NOT EXISTS task_run ('
+    'task_run_id INTEGER PRIMARY KEY, alert_run_id INTEGER, task_uuid TEXT, task_type TEXT, thread_name TEXT, '
+    'started_at REAL, send_s REAL, output_size_b INTEGER, outcome TEXT, errors TEXT)',
+    'CREATE INDEX IF NOT EXISTS task_run_alert_run ON task_run (alert_run_id)',
+    'CREATE TABLE IF NOT EXISTS imported_duration (subscription_id INTEGER PRIMARY KEY, duration_s REAL)']
+
+
+def get_alert_outcome(alert):
+    if alert.abandoned:
+        return OUTCOME_ABANDONED
+    if alert.error_list or [task for task in alert.tasks if task.task_succeeded is False]:
+        return OUTCOME_FAILED
+    if not alert.trigger_data:
+        return OUTCOME_NOT_TRIGGERED
+    return OUTCOME_SUCCEEDED
+
+
+def get_task_outcome(task):
+    if task.task_succeeded:
+        return OUTCOME_SUCCEEDED
+    if task.task_succeeded is False:
+        return OUTCOME_FAILED
+    return OUTCOME_ABANDONED  # never finished
+
+
+def get_timestamp(value):
+    """Seconds since the epoch for a datetime, or None"""
+    if value is None:
+        return None
+    return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+
+
+def get_percentile(values, percentile):
+    """Nearest-rank percentile of a list of numbers"""
+    values = sorted(values)
+    rank = int(round(percentile / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class ExecutionHistory(object):
+    """Per-alert and per-task timings, sizes and outcomes from every run. Also gives the expected duration of each
+        subscription, from its recent runs, for scheduling. Durations from an existing durations file are imported
+        the first time the database is used, and stand in for subscriptions until they have runs of their own"""
+
+    def __init__(self, path, default_s=None, durations_path=None):
+        self.path = path
+        self.default_s = default_s
+        self.durations = {}  # subscription_id: expected seconds
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+        if durations_path and os.path.exists(durations_path):
+            self.migrate(durations_path)
+
+    def migrate(self, durations_path):
+        """Import expected durations from a durations file, then delete the file so it isn't imported again"""
+        durations = []
+        with codecs.open(durations_path, encoding='utf-8', mode='r') as fr:
+            for line in fr:
+                fields = line.rstrip().split('\t')
+                if len(fields) == 2 and fields[0].isdigit():
+                    durations.append((int(fields[0]), float(fields[1])))
+        log.logger.info('Migrating durations of {} subscriptions from {} to {}'.format(
+            len(durations), durations_path, self.path))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO imported_duration (subscription_id, duration_s) '
+                                        'VALUES (?, ?)', durations)
+        os.remove(durations_path)
+
+    def close(self):
+        self.connection.close()
+
+    def load(self):
+        """Load the expected duration of each subscription"""
+        self.durations = dict(self.connection.execute('SELECT subscription_id, duration_s FROM imported_duration'))
+        cursor = self.connection.execute(
+            'SELECT subscription_id, AVG(duration_s) FROM ('
+            '  SELECT subscription_id, duration_s, '
+            '  ROW_NUMBER() OVER (PARTITION BY subscription_id ORDER BY started_at DESC) AS recency'
+            '  FROM alert_run WHERE outcome != ?) '
+            'WHERE recency <= ? GROUP BY subscription_id',
+            (OUTCOME_ABANDONED, RECENT_RUNS))
+        self.durations.update(cursor.fetchall())
+        log.logger.debug('Loaded expected durations of {} subscriptions from {}'.format(
+            len(self.durations), self.path))
+
+    def expected(self, alert):
+        """Expected seconds to process an alert, or the default if it has never been run"""
+        return self.durations.get(alert.subscription_id, self.default_s)
+
+    def record_runs(self, alerts, retention_days):
+        """Add a run of alerts and their tasks to the history, and drop anything older than retention_days"""
+        with self.connection:
+            for alert in alerts:
+                if not alert.processing_started_at:
+                    continue  # never got picked up
+
+                cursor = self.connection.execute(
+                    'INSERT INTO alert_run (subscription_id, site_name, view_name, view_url_suffix, alert_type, '
+                    'started_at, duration_s, fetch_s, parse_s, render_s, build_s, trigger_data_rowcount, '
+                    'trigger_data_size_b, export_retries, task_count, outcome, errors) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (alert.subscription_id, alert.site_name, alert.view_name, alert.view_url_suffix,
+                     alert.alert_type, alert.processing_started_at,
+                     alert.processing_finished_at - alert.processing_started_at,
+                     alert.stage_timings.get('fetch'), alert.stage_timings.get('parse'),
+                     alert.stage_timings.get('render'), alert.stage_timings.get('build'),
+                     alert.trigger_data_rowcount, alert.trigger_data_size_b, alert.export_retries, len(alert.tasks),
+                     get_alert_outcome(alert), '\n'.join(alert.error_list)))
+                alert_run_id = cursor.lastrowid
+
+                task_rows = []
+                for task in alert.tasks:
+                    send_s = None
+                    if task.task_started_at and task.task_completed_at:
+                        send_s = (task.task_completed_at - task.task_started_at).total_seconds()
+                    task_rows.append((alert_run_id, task.task_uuid, task.task_type, task.task_thread_id,
+                                      get_timestamp(task.task_started_at), send_s, task.task_output_size_b,
+                                      get_task_outcome(task), '\n'.join(task.error_list)))
+                self.connection.executemany(
+                    'INSERT INTO task_run (alert_run_id, task_uuid, task_type, thread_name, started_at, send_s, '
+                    'output_size_b, outcome, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    task_rows)
+
+            cutoff = time.time() - retention_days * 86400
+            self.connection.execute(
+                'DELETE FROM task_run WHERE alert_run_id IN (SELECT alert_run_id FROM alert_run WHERE started_at < ?)',
+                (cutoff,))
+            self.connection.execute('DELETE FROM alert_run WHERE started_at < ?', (cutoff,))
+
+    def slowest(self, days, limit):
+        """The slowest alert runs of the last few days, slowest first"""
+        return self.connection.execute(
+            'SELECT started_at, subscription_id, view_name, duration_s, fetch_s, parse_s, render_s, build_s, '
+            'trigger_data_rowcount, task_count, outcome FROM alert_run WHERE started_at >= ? '
+            'ORDER BY duration_s DESC LIMIT ?',
+            (time.time() - days * 86400, limit)).fetchall()
+
+    def percentiles(self, days, percentile, limit):
+        """The percentile duration of each subscription's runs over the last few days, slowest first"""
+        durations = {}
+        view_names = {}
+        cursor = self.connection.execute(
+            'SELECT subscription_id, view_name, duration_s FROM alert_run WHERE started_at >= ?',
+            (time.time() - days * 86400,))
+        for subscription_id, view_name, duration_s in cursor:
+            durations.setdefault(subscription_id, []).append(duration_s)
+            view_names[subscription_id] = view_name
+
+        results = [(subscription_id, view_names[subscription_id], len(subscription_durations),
+                    get_percentile(subscription_durations, percentile))
+                   for subscription_id, subscription_durations in list(durations.items())]
+        results.sort(key=lambda result: result[3], reverse=True)
+        return results[:limit]
+
+    def trend(self, days, subscription_id=None):
+        """Number of runs, failures and average duration for each of the last few days"""
+        query = 'SELECT DATE(started_at, \'unixepoch\', \'localtime\') AS day, COUNT(*), ' \
+                'SUM(CASE WHEN outcome IN (?, ?) THEN 1 ELSE 0 END), AVG(duration_s), MAX(duration_s), ' \
+                'SUM(export_retries) FROM alert_run WHERE started_at >= ?'
+        parameters = [OUTCOME_FAILED, OUTCOME_ABANDONED, time.time() - days * 86400]
+        if subscription_id is not None:
+            query += ' AND subscription_id = ?'
+            parameters.append(subscription_id)
+        query += ' GROUP BY day ORDER BY day'
+        return self.connection.execute(query, parameters).fetchall()
+
+
+def main():
+    """Report on the execution history"""
+    parser = argparse.ArgumentParser(description='Report on the VizAlerts execution history.')
+    parser.add_argument('-c', '--configpath', default='.\\config\\vizalerts.yaml',
+                        help='Path to .yml configuration file')
+    parser.add_argument('--days', type=int, default=7, help='Number of days of history to report on')
+    subparsers = parser.add_subparsers(dest='report')
+    subparsers.required = True
+
+    slowest_parser = subparsers.add_parser('slowest', help='Slowest alert runs')
+    slowest_parser.add_argument('--limit', type=int, default=20)
+
+    percentile_parser = subparsers.add_parser('p95', help='95th percentile duration of each subscription')
+    percentile_parser.add_argument('--limit', type=int, default=20)
+
+    trend_parser = subparsers.add_parser('trend', help='Runs, failures and durations by day')
+    trend_parser.add_argument('--subscription', type=int, help='Only report on this subscription_id')
+
+    args = parser.parse_args()
+
+    log.logger = logging.getLogger()
+    config.validate_conf(args.configpath)
+    history = ExecutionHistory(config.get_state_path(HISTORY_FILENAME, HISTORY_NODE_FILENAME))
+
+    try:
+        if args.report == 'slowest':
+            print('started_at\tsubscription_id\tview_name\tduration_s\tfetch_s\tparse_s\trender_s\tbuild_s\t'
+                  'rows\ttasks\toutcome')
+            for row in history.slowest(args.days, args.limit):
+                started_at = datetime.datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S')
+                print('\t'.join([started_at] + [format_value(value) for value in row[1:]]))
+        elif args.report == 'p95':
+            print('subscription_id\tview_name\truns\tp95_s')
+            for row in history.percentiles(args.days, 95, args.limit):
+                print('\t'.join([format_value(value) for value in row]))
+        elif args.report == 'trend':
+            print('day\truns\tfailures\tavg_s\tmax_s\tretries')
+            for row in history.trend(args.days, args.subscription):
+                print('\t'.join([format_value(value) for value in row]))
+    finally:
+        history.close()
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    if value is None:
+        return ''
+    return str(value)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
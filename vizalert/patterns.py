@@ -0,0 +1,36 @@
+#! python
+# -*- coding: utf-8 -*-
+# Compiled regular expressions shared by all VizAlerts in a run
+
+import re
+import threading
+
+# import local modules
+from . import stats
+
+
+class PatternRegistry(object):
+    """Compiles each distinct regex pattern once, however many alerts and addresses it is used for.
+        Python's own re cache only holds a few hundred patterns, which a large set of alerts can easily exceed"""
+
+    def __init__(self):
+        self.patterns = {}  # (pattern string, flags): compiled pattern
+        self.lock = threading.Lock()
+
+    def get(self, pattern, flags=0):
+        """Returns the compiled pattern, or None if pattern is empty. Raises re.error if it's invalid"""
+        if not pattern:
+            return None
+
+        key = (pattern, flags)
+        with self.lock:
+            compiled = self.patterns.get(key)
+        if compiled is not None:
+            stats.increment('patterns.hits')
+            return compiled
+
+        compiled = re.compile(pattern, flags)
+        stats.increment('patterns.misses')
+        with self.lock:
+            self.patterns[key] = compiled
+        return compiled
@@ -0,0 +1,390 @@
+#! python
+# -*- coding: utf-8 -*-
+# Staged processing of VizAlerts, where each stage has its own bounded pool of worker threads and queue.
+#   fetch trigger data -> parse/validate -> render content refs -> build messages -> deliver
+
+import logging
+import threading
+import time
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor
+
+# import local modules
+from . import config
+from . import log
+from . import scheduler
+
+# placed on a stage's queue to tell one of its workers to exit
+STOP = object()
+
+# pool of worker processes for CPU-bound work, if enabled with the processes setting
+process_pool = None
+
+
+def start_process_pool(process_count):
+    """Start the worker processes used by run_cpu_bound"""
+    global process_pool
+    log.logger.info('Starting {} worker processes for CPU-bound work'.format(process_count))
+    process_pool = ProcessPoolExecutor(process_count, initializer=init_worker_process,
+                                       initargs=(config.configs, config.configs['log.level']))
+
+
+def stop_process_pool():
+    global process_pool
+    if process_pool:
+        process_pool.shutdown()
+        process_pool = None
+
+
+def init_worker_process(configs, log_level):
+    """Set up module state in a new worker process, which may not have inherited any (e.g., on Windows)"""
+    config.configs = configs
+
+    # log to the console only, since writing to the parent's rotating log file from several processes isn't safe
+    log.logger = logging.getLogger()
+    for handler in list(log.logger.handlers):
+        log.logger.removeHandler(handler)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(log.min_formatter))
+    log.logger.addHandler(console_handler)
+    log.logger.setLevel(log_level)
+
+
+def run_cpu_bound(function, *args):
+    """Run function in a worker process if the process pool is enabled, otherwise in the calling thread.
+        function must be defined at module level, and its arguments and return value must be picklable"""
+    if process_pool is None:
+        return function(*args)
+    return process_pool.submit(function, *args).result()
+
+
+class Stage(object):
+    """A named pool of worker threads, each taking items from a shared, bounded queue and passing them to handler.
+        If deadline_s is set (not None or 0), a watchdog abandons any item that takes longer than that to handle: on_abandon is
+        called to report it, and a replacement worker is started so the stage keeps its full capacity.
+        (Python threads can't be killed, so the hung worker is left to finish or hang on its own.)
+        Time a handler spends waiting on the next stage, between pause_deadline and resume_deadline, doesn't count"""
+
+    def __init__(self, name, thread_count, handler, queue_size=0, deadline_s=None, on_abandon=None):
+        self.name = name
+        self.thread_count = thread_count
+        self.handler = handler
+        self.queue = Queue(queue_size)
+        self.deadline_s = deadline_s
+        self.on_abandon = on_abandon
+        self.workers = []
+        self.watchdog = None
+        self.workers_started = 0
+        self.in_flight = {}  # worker thread name: (item, time handling started)
+        self.paused = {}  # worker thread name: time its deadline clock was stopped
+        self.abandoned_workers = set()
+        self.closed = False
+        self.lock = threading.Condition()
+
+    def start(self):
+        with self.lock:
+            for index in range(self.thread_count):
+                self.start_worker()
+
+        if self.deadline_s:
+            self.watchdog = threading.Thread(target=self.watch, name='{}_watchdog'.format(self.name))
+            self.watchdog.daemon = True
+            self.watchdog.start()
+
+    def start_worker(self):
+        """Start one worker thread. Must be called holding self.lock"""
+        self.workers_started += 1
+        thread_name = '{}_{}'.format(self.name, self.workers_started)  # start thread names at 1
+        worker = threading.Thread(target=self.work, name=thread_name)
+        worker.daemon = True  # so an abandoned worker can't stop the process from exiting
+        log.logger.debug('Starting thread with name: {}'.format(thread_name))
+        worker.start()
+        self.workers.append(worker)
+
+    def put(self, item):
+        """Queue an item for this stage, blocking while the queue is full"""
+        self.queue.put(item)
+
+    def pause_deadline(self):
+        """Stop the deadline clock for the calling worker's item, while it waits on something outside this stage"""
+        thread_name = threading.current_thread().name
+        with self.lock:
+            if thread_name in self.in_flight:
+                self.paused[thread_name] = time.time()
+
+    def resume_deadline(self):
+        """Restart the deadline clock for the calling worker's item, leaving out the time it was stopped"""
+        thread_name = threading.current_thread().name
+        with self.lock:
+            paused_at = self.paused.pop(thread_name, None)
+            if paused_at is not None and thread_name in self.in_flight:
+                item, started_at = self.in_flight[thread_name]
+                self.in_flight[thread_name] = (item, started_at + time.time() - paused_at)
+                self.lock.notify_all()
+
+    def close(self):
+        """Tell the workers to exit once all queued items are handled, and wait for them to do so"""
+        with self.lock:
+            live_worker_count = len(self.workers) - len(self.abandoned_workers)
+
+        # abandoned workers are replaced one for one, so there is always a live worker to take each STOP
+        for index in range(live_worker_count):
+            self.queue.put(STOP)
+        self.queue.join()
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            live_workers = [worker for worker in self.workers if worker.name not in self.abandoned_workers]
+
+        for worker in live_workers:
+            worker.join()
+        if self.watchdog:
+            self.watchdog.join()  # so everything it abandoned has been reported
+        log.logger.debug('All {} threads have completed'.format(self.name))
+
+    def work(self):
+        thread_name = threading.current_thread().name
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                self.queue.task_done()
+                return
+
+            with self.lock:
+                self.in_flight[thread_name] = (item, time.time())
+                self.lock.notify_all()
+
+            try:
+                self.handler(item)
+            except Exception as e:
+                # handlers deal with their own failures, so this shouldn't happen
+                log.logger.exception('Unhandled error in {} stage: {}'.format(self.name, e))
+
+            with self.lock:
+                if thread_name in self.abandoned_workers:
+                    # the watchdog has already accounted for this item and replaced us
+                    log.logger.warning('Thread {} finished an item after it was abandoned, exiting'.format(
+                        thread_name))
+                    return
+                del self.in_flight[thread_name]
+            self.queue.task_done()
+
+    def watch(self):
+        """Abandon and report items that run past the deadline, sleeping until the next one could expire"""
+        while True:
+            expired = []
+            with self.lock:
+                if self.closed:
+                    return
+
+                now = time.time()
+                next_deadline = None
+                for thread_name, (item, started_at) in list(self.in_flight.items()):
+                    if thread_name in self.paused:
+                        continue  # resume_deadline will wake us
+                    deadline = started_at + self.deadline_s
+                    if deadline <= now:
+                        del self.in_flight[thread_name]
+                        self.abandoned_workers.add(thread_name)
+                        self.queue.task_done()
+                        self.start_worker()
+                        expired.append((thread_name, item, now - started_at))
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+
+                if not expired:
+                    if next_deadline is None:
+                        self.lock.wait()
+                    else:
+                        self.lock.wait(next_deadline - now)
+
+            # report outside the lock, since reporting can mean sending email
+            for thread_name, item, elapsed_s in expired:
+                log.logger.error('Thread {} in the {} stage exceeded the deadline of {} seconds after {:.0f} seconds, '
+                                 'abandoning its work'.format(thread_name, self.name, self.deadline_s, elapsed_s))
+                if self.on_abandon:
+                    try:
+                        self.on_abandon(item, elapsed_s)
+                    except Exception as e:
+                        log.logger.exception('Unable to report abandoned work in {} stage: {}'.format(self.name, e))
+
+
+class TaskSink(object):
+    """Takes the place of an alert's task_queue, passing each task straight on to the deliver stage.
+        Tasks from an alert that has been abandoned are dropped. While the deliver queue is full, the build
+        stage's deadline clock is stopped, so a large alert isn't abandoned just for waiting its turn to send"""
+
+    def __init__(self, alert, build_stage, deliver_stage):
+        self.alert = alert
+        self.build_stage = build_stage
+        self.deliver_stage = deliver_stage
+
+    def put(self, task):
+        if self.alert.abandoned:
+            log.logger.debug('Dropping task {} from abandoned alert {}'.format(task.task_uuid, self.alert.view_name))
+            return
+        self.build_stage.pause_deadline()
+        try:
+            self.deliver_stage.put(task)
+        finally:
+            self.build_stage.resume_deadline()
+
+
+class AlertPipeline(object):
+    """Runs a set of VizAlerts through each processing stage. Tableau Server load is bounded by the fetch and
+        render stages, and SMTP / SMS provider load by the deliver stage, regardless of how many alerts there are"""
+
+    def __init__(self, alert_thread_count, render_thread_count, deliver_thread_count, queue_size, deadline_s=None):
+        self.fetch_stage = Stage('fetch', alert_thread_count, self.fetch, queue_size,
+                                 deadline_s, self.abandon_alert)
+        self.parse_stage = Stage('parse', alert_thread_count, self.parse, queue_size,
+                                 deadline_s, self.abandon_alert)
+        self.render_stage = Stage('render', render_thread_count, self.render, queue_size,
+                                  deadline_s, self.abandon_alert)
+        self.build_stage = Stage('build', alert_thread_count, self.build, queue_size,
+                                 deadline_s, self.abandon_alert)
+        self.deliver_stage = Stage('deliver', deliver_thread_count, self.deliver, queue_size,
+                                   deadline_s, self.abandon_task)
+
+        # in order--each stage only feeds the one after it
+        self.stages = [self.fetch_stage, self.parse_stage, self.render_stage, self.build_stage, self.deliver_stage]
+
+        self.abandoned_tasks = {}  # alert: list of (task, seconds it ran before it was abandoned)
+        self.lock = threading.Lock()
+
+    def run(self, alerts, history, order=scheduler.ORDER_LONGEST_FIRST, site_weights=None, owner_weights=None):
+        """Process all alerts, sharing the workers fairly between sites and owners, returning once every stage
+            has finished. history gives the time each alert is expected to take"""
+        self.scheduler = scheduler.FairScheduler(alerts, history, order, site_weights, owner_weights)
+
+        for stage in self.stages:
+            stage.start()
+
+        for alert in self.scheduler.order():
+            log.logger.debug('Queueing subscription id {} for processing'.format(alert.subscription_id))
+            self.fetch_stage.put(alert)
+
+        # once a stage has drained, nothing more can arrive at the next one, so close them in order
+        for stage in self.stages:
+            stage.close()
+
+        self.report_abandoned_tasks()
+        self.scheduler.report_waits()
+
+    def run_alert_step(self, alert, stage_name, step, next_stage):
+        """Run one stage's step for an alert, passing it on to the next stage if the step says to continue"""
+        started_at = time.time()
+        try:
+            proceed = step()
+        except Exception as e:
+            proceed = False
+            errormessage = 'Unable to process alert {}, error: {}'.format(alert.view_name, e.args[0])
+            log.logger.error(errormessage)
+            alert.error_list.append(errormessage)
+            alert.alert_failure()
+        alert.stage_timings[stage_name] = time.time() - started_at
+        self.scheduler.record_finish(alert)
+
+        if proceed and not alert.abandoned:
+            next_stage.put(alert)
+
+    def abandon_alert(self, alert, elapsed_s):
+        """Report an alert that a stage gave up on, and make sure it goes no further"""
+        alert.abandoned = True
+        errormessage = 'Processing of alert {} was abandoned after {:.0f} seconds'.format(alert.view_name, elapsed_s)
+        log.logger.error(errormessage)
+        alert.error_list.append(errormessage)
+        alert.alert_failure()
+
+    def abandon_task(self, task, elapsed_s):
+        """Note a task that the deliver stage gave up on. They're reported once the run is done, with one failure
+            notice for each alert, since a stalled SMTP server or SMS provider can hold up a great many tasks"""
+        log.logger.error('Task {} from alert {} was abandoned after {:.0f} seconds'.format(
+            task.task_uuid, task.alert.view_name, elapsed_s))
+        with self.lock:
+            self.abandoned_tasks.setdefault(task.alert, []).append((task, elapsed_s))
+
+    def report_abandoned_tasks(self):
+        """Send one failure notice for each alert that had tasks abandoned by the deliver stage"""
+        with self.lock:
+            abandoned_tasks = list(self.abandoned_tasks.items())
+            self.abandoned_tasks = {}
+
+        for alert, tasks in abandoned_tasks:
+            errormessage = '{} tasks from alert {} were abandoned after running longer than {} seconds: {}'.format(
+                len(tasks), alert.view_name, self.deliver_stage.deadline_s,
+                ', '.join([str(task.task_uuid) for task, elapsed_s in tasks]))
+            log.logger.error(errormessage)
+            alert.error_list.append(errormessage)
+            alert.alert_failure()
+
+    def fetch(self, alert):
+        self.scheduler.record_start(alert)
+        log.logger.debug('Thread {} is processing subscription_id {}, view_id {}, '
+                         'site_name {}, customized_view_id {}, '
+                         'view_name {}'.format(
+                            threading.current_thread().name,
+                            alert.subscription_id,
+                            alert.view_id,
+                            alert.site_name,
+                            alert.customized_view_id,
+                            alert.view_name))
+
+        self.run_alert_step(alert, 'fetch', alert.fetch_trigger_data, self.parse_stage)
+
+    def parse(self, alert):
+        self.run_alert_step(alert, 'parse', alert.parse_trigger_data, self.render_stage)
+
+    def render(self, alert):
+        def render_step():
+            alert.render_content_refs()
+            return True
+        self.run_alert_step(alert, 'render', render_step, self.build_stage)
+
+    def build(self, alert):
+        # tasks go to the deliver stage as soon as each is built, so sending overlaps building the rest.
+        #   If the deliver queue is full, building waits for it, without that wait counting against the deadline
+        alert.task_queue = TaskSink(alert, self.build_stage, self.deliver_stage)
+
+        started_at = time.time()
+        try:
+            alert.perform_actions()
+        except Exception as e:
+            errormessage = 'Unable to process alert {}, error: {}'.format(alert.view_name, e.args[0])
+            log.logger.error(errormessage)
+            alert.error_list.append(errormessage)
+            alert.alert_failure()
+            return
+        finally:
+            alert.stage_timings['build'] = time.time() - started_at
+            self.scheduler.record_finish(alert)
+
+        log.logger.debug('Built {} alert tasks for alert {}'.format(
+            len(alert.tasks),
+            alert.alert_uuid))
+
+    def deliver(self, task):
+        log.logger.debug('Thread {} is processing task_id {}, from subscription_id {}, view_id {}, '
+                         'site_name {}, customized_view_id {}, '
+                         'view_name {}'.format(
+                            threading.current_thread().name,
+                            task.task_uuid,
+                            task.alert.subscription_id,
+                            task.alert.view_id,
+                            task.alert.site_name,
+                            task.alert.customized_view_id,
+                            task.alert.view_name))
+
+        # process the task
+        try:
+            task.execute_task()
+        except Exception as e:
+            errormessage = 'Unable to process task {} from alert {}, error: {}'.format(
+                                                                                task.task_uuid,
+                                                                                task.alert.view_name,
+                                                                                e.args[0])
+            log.logger.error(errormessage)
+            task.alert.error_list.append(errormessage)
+            task.alert.alert_failure()
+        self.scheduler.record_finish(task.alert)
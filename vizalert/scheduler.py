@@ -0,0 +1,105 @@
+#! python
+# -*- coding: utf-8 -*-
+# Decides the order VizAlerts are processed in, sharing the workers fairly between sites and owners
+
+import heapq
+import threading
+import time
+
+# import local modules
+from . import log
+
+# ways to order alerts that share a priority, set with scheduler.order
+ORDER_LONGEST_FIRST = 'longest_first'  # longest expected duration first, so the run finishes as early as possible
+ORDER_DEADLINE = 'deadline'  # earliest run_next_at first, so alerts are done before they are next due
+ORDERS = [ORDER_LONGEST_FIRST, ORDER_DEADLINE]
+
+
+def share_key(alert):
+    """The share an alert's processing time is charged to"""
+    return alert.site_name, alert.owner_sysname
+
+
+class FairScheduler(object):
+    """Weighted fair queuing over alerts, with one share per site and owner.
+
+        Each alert is given a virtual start time: the expected duration of the alerts ahead of it in its own share,
+        divided by the share's weight. A share's weight is its site's weight times its owner's weight, from
+        site_weights and owner_weights, with 1 for any not listed, so a share of weight 2 gets through twice as
+        much work as a share of weight 1 while both have alerts waiting. Alerts are dispatched in order of start time, so a share with a great many
+        alerts can't hold up every other share until all of its own alerts are done. Within a share, alerts are
+        taken in priority order, and alerts that would start at the same time are taken in the configured order"""
+
+    def __init__(self, alerts, history, order=ORDER_LONGEST_FIRST, site_weights=None, owner_weights=None):
+        """history provides expected(alert), the number of seconds an alert is expected to take"""
+        self.alerts = alerts
+        self.history = history
+        self.order_by = order
+        self.site_weights = site_weights or {}
+        self.owner_weights = owner_weights or {}
+        self.started_at = None
+        self.waits = {}  # share key: list of seconds each alert waited to be picked up
+        self.lock = threading.Lock()
+
+    def weight(self, key):
+        """The weight of a share"""
+        site_name, owner_sysname = key
+        return self.site_weights.get(site_name, 1) * self.owner_weights.get(owner_sysname, 1)
+
+    def order_key(self, alert):
+        if self.order_by == ORDER_DEADLINE:
+            # run_next_at is formatted as YYYY-MM-DD HH:MM:SS, so it sorts chronologically as a string
+            return alert.run_next_at or '9999'
+        return -self.history.expected(alert)
+
+    def order(self):
+        """Returns the alerts in the order they should be processed, and starts the clock for wait times"""
+        shares = {}
+        for alert in sorted(self.alerts, key=lambda alert: (alert.priority, self.order_key(alert))):
+            shares.setdefault(share_key(alert), []).append(alert)
+
+        heap = []
+        sequence = 0  # keeps the sort stable, and stops it from ever comparing two alerts
+        for key, share_alerts in list(shares.items()):
+            weight = float(self.weight(key))
+            start = 0.0
+            for alert in share_alerts:
+                heap.append((start, self.order_key(alert), sequence, alert))
+                start += self.history.expected(alert) / weight
+                sequence += 1
+        heapq.heapify(heap)
+
+        log.logger.debug('Scheduling {} alerts across {} shares, ordered by {}'.format(
+            len(heap), len(shares), self.order_by))
+        self.started_at = time.time()
+        return [heapq.heappop(heap)[3] for index in range(len(heap))]
+
+    def record_start(self, alert):
+        """Note that processing has begun on an alert, recording how long it waited"""
+        now = time.time()
+        with self.lock:
+            self.waits.setdefault(share_key(alert), []).append(now - self.started_at)
+        alert.processing_started_at = now
+        alert.processing_finished_at = now
+
+    def record_finish(self, alert):
+        """Note that a stage has finished some work for an alert. The last of these marks the end of its processing"""
+        now = time.time()
+        with self.lock:
+            if alert.processing_started_at and now > alert.processing_finished_at:
+                alert.processing_finished_at = now
+
+    def report_waits(self):
+        """Log how long each share's alerts waited to be picked up, longest waits first"""
+        with self.lock:
+            waits = list(self.waits.items())
+
+        for (site_name, owner_sysname), share_waits in sorted(waits, key=lambda share: max(share[1]), reverse=True):
+            log.logger.info('Share site {}, owner {} (weight {}): {} alerts, waited {:.1f}s on average, '
+                            '{:.1f}s at most'.format(
+                site_name,
+                owner_sysname,
+                self.weight((site_name, owner_sysname)),
+                len(share_waits),
+                sum(share_waits) / len(share_waits),
+                max(share_waits)))
@@ -186,7 +186,7 @@ def validate_smsnumbers(vizdata, sms_to_fieldname, allowed_recipient_numbers, is
 
 
 def smsnumbers_are_invalid(sms_numbers, emptystringok, iso2countrycode, regex_eval=None):
-    """Validates all SMS numbers found in a given string, optionally that conform to the regex_eval"""
+    """Validates all SMS numbers found in a given string, optionally that conform to the compiled regex_eval pattern"""
     
     log.logger.debug('Validating SMS field value: {}'.format(sms_numbers))
 
@@ -225,9 +225,10 @@ def smsnumber_is_invalid(smsnumber, iso2countrycode, regex_eval=None):
 
         # looks valid, but it must be permitted by regex pattern if so specified
         if regex_eval:
-            log.logger.debug("testing smsnumber {} against regex {}".format(e164_number, regex_eval))
-            if not re.match(regex_eval, e164_number):
-                errormessage = 'SMS number must match regex pattern set by the administrator: {}'.format(regex_eval)
+            log.logger.debug("testing smsnumber {} against regex {}".format(e164_number, regex_eval.pattern))
+            if not regex_eval.match(e164_number):
+                errormessage = 'SMS number must match regex pattern set by the administrator: {}'.format(
+                    regex_eval.pattern)
                 log.logger.error(errormessage)
                 return errormessage
     except Exception as e:
@@ -0,0 +1,130 @@
+#! python
+# -*- coding: utf-8 -*-
+# Storage for the schedule state of each subscription, used to tell which alerts are due to run
+
+import codecs
+import os
+import sqlite3
+
+# import local modules
+from . import log
+
+# state backends, set with schedule.state.backend
+BACKEND_SQLITE = 'sqlite'
+BACKEND_TSV = 'tsv'
+BACKENDS = [BACKEND_SQLITE, BACKEND_TSV]
+
+# what we keep for each subscription, in the column order of the TSV file
+STATE_FIELDS = ['site_name', 'subscription_id', 'view_id', 'customized_view_id', 'ran_last_at', 'run_next_at',
+                'schedule_id']
+
+
+def get_record(alert):
+    """The state to keep for an alert, as strings, so it compares equal to what was loaded for it"""
+    return dict((field, str(getattr(alert, field))) for field in STATE_FIELDS)
+
+
+def get_store(backend, sqlite_path, tsv_path):
+    """Open the state store for the configured backend"""
+    if backend == BACKEND_TSV:
+        return TsvStateStore(tsv_path)
+    return SqliteStateStore(sqlite_path, tsv_path)
+
+
+class TsvStateStore(object):
+    """State kept in a tab-separated file, rewritten in full each time it's saved"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Returns a dict of subscription_id: state record"""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        with codecs.open(self.path, encoding='utf-8', mode='r') as fr:
+            fr.readline()  # skip the header
+            for line in fr:
+                values = line.rstrip('\r\n').split('\t')
+                if len(values) != len(STATE_FIELDS):
+                    continue
+                record = dict(list(zip(STATE_FIELDS, values)))
+                records[int(record['subscription_id'])] = record
+        return records
+
+    def save(self, records):
+        """Replace the stored state with records. The new file is written out in full before it replaces the old
+            one, so a crash part way through can't leave it corrupted"""
+        temppath = self.path + '.tmp'
+        with codecs.open(temppath, encoding='utf-8', mode='w') as fw:
+            fw.write('\t'.join(STATE_FIELDS) + '\n')
+            for subscription_id, record in list(records.items()):
+                fw.write('\t'.join([record[field] for field in STATE_FIELDS]) + '\n')
+        os.replace(temppath, self.path)
+
+    def close(self):
+        pass
+
+
+class SqliteStateStore(object):
+    """State kept in a SQLite database, keyed by subscription_id. Saving only touches the rows that changed,
+        in a single transaction. State from an existing TSV file is imported the first time the database is used"""
+
+    def __init__(self, path, tsv_path=None):
+        self.path = path
+        self.loaded = {}
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')  # safe in WAL mode, and much faster than FULL
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS subscription_state ('
+                'subscription_id INTEGER PRIMARY KEY, site_name TEXT, view_id TEXT, customized_view_id TEXT, '
+                'ran_last_at TEXT, run_next_at TEXT, schedule_id TEXT)')
+
+        if tsv_path and os.path.exists(tsv_path):
+            self.migrate(tsv_path)
+
+    def migrate(self, tsv_path):
+        """Import state from a TSV file, then rename the file so it isn't imported again. Only subscriptions the
+            database doesn't already have are imported, so a TSV file that turns up again can't overwrite or
+            remove newer state"""
+        records = TsvStateStore(tsv_path).load()
+        log.logger.info('Migrating state of {} subscriptions from {} to {}'.format(len(records), tsv_path, self.path))
+        with self.connection:
+            cursor = self.connection.executemany(
+                'INSERT OR IGNORE INTO subscription_state ({}) VALUES ({})'.format(
+                    ', '.join(STATE_FIELDS), ', '.join([':' + field for field in STATE_FIELDS])),
+                list(records.values()))
+        log.logger.debug('Imported state of {} subscriptions not already in {}'.format(cursor.rowcount, self.path))
+        os.replace(tsv_path, tsv_path + '.migrated')
+
+    def load(self):
+        """Returns a dict of subscription_id: state record"""
+        cursor = self.connection.execute('SELECT {} FROM subscription_state'.format(', '.join(STATE_FIELDS)))
+        self.loaded = {}
+        for row in cursor:
+            record = dict(list(zip(STATE_FIELDS, row)))
+            record['subscription_id'] = str(record['subscription_id'])
+            self.loaded[row[1]] = record
+        return dict(self.loaded)
+
+    def save(self, records):
+        """Replace the stored state with records, writing only what differs from what was last loaded"""
+        changed = [record for subscription_id, record in list(records.items())
+                   if self.loaded.get(subscription_id) != record]
+        removed = [(subscription_id,) for subscription_id in self.loaded if subscription_id not in records]
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO subscription_state ({}) VALUES ({})'.format(
+                    ', '.join(STATE_FIELDS), ', '.join([':' + field for field in STATE_FIELDS])),
+                changed)
+            self.connection.executemany('DELETE FROM subscription_state WHERE subscription_id = ?', removed)
+
+        log.logger.debug('Saved state: {} subscriptions changed, {} removed'.format(len(changed), len(removed)))
+        self.loaded = dict(records)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,46 @@
+#! python
+# -*- coding: utf-8 -*-
+# Counters and timings collected while processing alerts, reported at the end of each run
+
+import threading
+
+# import local modules
+from . import log
+
+lock = threading.Lock()
+counts = {}  # name: number of times it happened
+timings = {}  # name: [number of times, total seconds, most seconds]
+values = {}  # name: latest value
+
+
+def increment(name, amount=1):
+    with lock:
+        counts[name] = counts.get(name, 0) + amount
+
+
+def record_time(name, seconds):
+    with lock:
+        timing = timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+
+def set_value(name, value):
+    with lock:
+        values[name] = value
+
+
+def report():
+    """Log everything collected since the last report, then start over"""
+    with lock:
+        for name, count in sorted(counts.items()):
+            log.logger.info('Stat {}: {}'.format(name, count))
+        for name, (count, total_s, max_s) in sorted(timings.items()):
+            log.logger.info('Stat {}: {} times, {:.3f}s on average, {:.3f}s at most'.format(
+                name, count, total_s / count, max_s))
+        for name, value in sorted(values.items()):
+            log.logger.info('Stat {}: {}'.format(name, value))
+        counts.clear()
+        timings.clear()
+        values.clear()
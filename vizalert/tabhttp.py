@@ -3,20 +3,44 @@
 # This is a utility module to provide a single interface for interacting with Tableau Server over http.
 
 import os
-import urllib.request, urllib.parse, urllib.error
-import urllib.request, urllib.error, urllib.parse
 import requests
 import time
 import datetime
 import html
 import codecs
 import re
-import ssl
 import threading
+import functools
+import http.cookiejar
+from collections import deque, OrderedDict
+from queue import LifoQueue, Empty
 from . import config
 from . import log
+from . import stats
 from requests_ntlm import HttpNtlmAuth
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+# limits the number of exports running on Tableau Server at once, adapting to how well it's coping
+export_limiter = None
+
+# fixed limits on the number of exports running at once for each site, and for each workbook
+site_limiter = None
+workbook_limiter = None
+
+# how many retries the last export in each thread needed
+last_export = threading.local()
+
+# keep-alive sessions shared by all exports
+session_pool = None
+
+# sessions already authenticated as AD users, if enabled with http.ntlm.cache_size
+ntlm_sessions = None
+
+# keeps trusted tickets ready for exports, if enabled with trusted.prefetch.pool_size
+ticket_prefetcher = None
 
 
 class Format(object):
@@ -26,6 +50,220 @@ class Format(object):
     TWB = 'twb'
 
 
+class CountingHTTPConnection(HTTPConnection):
+    """Counts each new connection made, including reconnections after the server has closed an idle one"""
+
+    def _new_conn(self):
+        stats.increment('http.connections.new')
+        return super(CountingHTTPConnection, self)._new_conn()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        stats.increment('http.connections.new')
+        return super(CountingHTTPSConnection, self)._new_conn()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter whose connections are counted, so they can be compared to the number of requests"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                                   'https': CountingHTTPSConnectionPool}
+
+
+class RejectAllCookies(http.cookiejar.DefaultCookiePolicy):
+    """Keeps a Session from storing cookies. The session cookie Tableau Server sets when a trusted ticket is redeemed
+        belongs to that ticket's user, and must not be sent with the next user's requests. Cookies set during a
+        request's redirects are still followed, as requests keeps those separately"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def create_session(keepalive=True, verify=True):
+    """A Session whose connections are counted, and that never keeps cookies between requests"""
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.cookies.set_policy(RejectAllCookies())
+    session.verify = verify
+    if not keepalive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+class SessionPool(object):
+    """A thread-safe pool of requests Sessions, so requests to Tableau Server reuse open keep-alive connections
+        instead of making a new TCP connection and TLS handshake for each one. A Session is only used by one thread
+        at a time, and there are never more than size of them; when all are in use, the next thread waits"""
+
+    def __init__(self, size, keepalive=True, verify=True):
+        self.size = size
+        self.keepalive = keepalive
+        self.verify = verify  # set once for every session: False, or the path to a CA bundle
+        self.idle = LifoQueue()  # the most recently used session is the likeliest to have a live connection
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a session from the pool, creating one if there's room, or waiting for one if not"""
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            log.logger.debug('Creating HTTP session {} of {}'.format(self.created, self.size))
+            return create_session(self.keepalive, self.verify)
+        return self.idle.get()
+
+    def release(self, session):
+        self.idle.put(session)
+
+    def request(self, method, url, **kwargs):
+        """Make a request with a pooled session, counting it in http.requests. Any request not matched by a count in
+            http.connections.new reused an open connection"""
+        session = self.acquire()
+        try:
+            stats.increment('http.requests')
+            return session.request(method, url, **kwargs)
+        finally:
+            self.release(session)
+
+
+class CountingHttpNtlmAuth(HttpNtlmAuth):
+    """Counts each NTLM handshake, which takes several round trips, in http.ntlm.handshakes"""
+
+    def retry_using_http_NTLM_auth(self, *args, **kwargs):
+        stats.increment('http.ntlm.handshakes')
+        return super(CountingHttpNtlmAuth, self).retry_using_http_NTLM_auth(*args, **kwargs)
+
+
+class NtlmSessionCache(object):
+    """Sessions authenticated as AD users, kept for their next export. NTLM authenticates a connection rather than
+        a request, so an export over a connection already authenticated as its user skips the handshake.
+
+        A session is only used by one thread at a time, so a user exported for by several threads at once gets
+        several. Up to size idle sessions are kept, evicting those of the least recently used users first, and any
+        idle for longer than idle_timeout_s are closed, as Tableau Server will likely have dropped their connection"""
+
+    def __init__(self, size, idle_timeout_s, keepalive=True, verify=True):
+        self.size = size
+        self.idle_timeout_s = idle_timeout_s
+        self.keepalive = keepalive
+        self.verify = verify
+        self.idle = OrderedDict()  # (user_domain, user_sysname): list of (time last used, session), oldest first
+        self.idle_count = 0
+        self.lock = threading.Lock()
+
+    def create_session(self, user_domain, user_sysname):
+        session = create_session(self.keepalive, self.verify)
+        session.auth = CountingHttpNtlmAuth(user_domain + '\\' + user_sysname, '')
+        return session
+
+    def acquire(self, user_domain, user_sysname):
+        """Take an idle session authenticated as the user, or create one if there isn't one"""
+        key = (user_domain, user_sysname)
+        with self.lock:
+            self.discard_expired()
+            sessions = self.idle.get(key)
+            session = None
+            if sessions:
+                session = sessions.pop()[1]
+                self.idle_count -= 1
+                if not sessions:
+                    del self.idle[key]
+
+        if session:
+            stats.increment('http.ntlm.hits')
+            return session
+        stats.increment('http.ntlm.misses')
+        return self.create_session(user_domain, user_sysname)
+
+    def release(self, user_domain, user_sysname, session):
+        key = (user_domain, user_sysname)
+        evicted = []
+        with self.lock:
+            self.idle.setdefault(key, []).append((time.time(), session))
+            self.idle.move_to_end(key)
+            self.idle_count += 1
+            while self.idle_count > self.size:
+                # evict the least recently used user's sessions
+                oldest_key, sessions = self.idle.popitem(last=False)
+                self.idle_count -= len(sessions)
+                evicted.extend([session for last_used, session in sessions])
+
+        for session in evicted:
+            stats.increment('http.ntlm.evicted')
+            session.close()
+
+    def discard_expired(self):
+        """Close sessions idle for longer than idle_timeout_s. Must be called holding self.lock"""
+        cutoff = time.time() - self.idle_timeout_s
+        for key, sessions in list(self.idle.items()):
+            while sessions and sessions[0][0] < cutoff:
+                sessions.pop(0)[1].close()
+                self.idle_count -= 1
+                stats.increment('http.ntlm.expired')
+            if not sessions:
+                del self.idle[key]
+
+    def request(self, user_domain, user_sysname, method, url, **kwargs):
+        """Make a request as an AD user, counting it in http.requests like SessionPool.request"""
+        session = self.acquire(user_domain, user_sysname)
+        try:
+            stats.increment('http.requests')
+            return session.request(method, url, **kwargs)
+        finally:
+            self.release(user_domain, user_sysname, session)
+
+
+def ntlm_request(user_domain, user_sysname, method, url, **kwargs):
+    """Make a request as an AD user over a connection authenticated as them: one from ntlm_sessions if enabled, or
+        else a new one, closed afterwards. Never a connection from session_pool, which may already be authenticated
+        as someone else"""
+    if ntlm_sessions:
+        return ntlm_sessions.request(user_domain, user_sysname, method, url, **kwargs)
+
+    session = create_session(session_pool.keepalive, session_pool.verify)
+    session.auth = CountingHttpNtlmAuth(user_domain + '\\' + user_sysname, '')
+    try:
+        stats.increment('http.requests')
+        return session.request(method, url, **kwargs)
+    finally:
+        session.close()
+
+
+def get_verify(certcheck, certfile):
+    """The verify setting for requests to Tableau Server: the CA bundle to check its certificate against,
+        or False not to check it"""
+    if certcheck:
+        log.logger.debug('Validating certs using certfile {}'.format(certfile))
+        return certfile or requests.utils.DEFAULT_CA_BUNDLE_PATH
+
+    log.logger.debug('NOT Validating certs')
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)  # disable warnings for unverified certs
+    return False
+
+
 # Generate a trusted ticket
 def get_trusted_ticket(server, sitename, username, encrypt, certcheck=True, certfile=None, userdomain=None, clientip=None, tries=1):
     
@@ -50,39 +288,25 @@ def get_trusted_ticket(server, sitename, username, encrypt, certcheck=True, cert
     if sitename != '':
         postdata['target_site'] = sitename
 
-    data = urllib.parse.urlencode(postdata).encode("utf-8")
     requestdetails = 'Server: {}, Site: {}, Username: {}, Url: {}, Postdata: {}.'.format(
                             server,
                             sitename,
                             username,
                             trustedurl,
-                            data)
+                            postdata)
     log.logger.debug('Generating trusted ticket. Request details: {}'.format(requestdetails))
 
     ticket = 0
     while attempts < tries:
+        started_at = time.time()
         try:
             attempts += 1
 
-            # If we're using SSL, and config says to validate the certificate, then do so
-            if encrypt and certcheck:
-                if not certfile:
-                    certfile = requests.utils.DEFAULT_CA_BUNDLE_PATH
-                log.logger.debug('using SSL and verifying cert using certfile {}'.format(certfile))
-                request = urllib.request.Request(trustedurl, data)
-                context = ssl.create_default_context(cafile=certfile)
-                response = urllib.request.urlopen(request, context=context)
-            else:
-                # We're either not using SSL, or just not validating the certificate
-                if encrypt:
-                    log.logger.debug('using SSL and NOT verifying cert')
-                else:
-                    log.logger.debug('NOT using SSL and NOT verifying cert')
-                context = ssl._create_unverified_context()
-                request = urllib.request.Request(trustedurl, data)
-                response = urllib.request.urlopen(request, context=context)
-
-            ticket = response.read().decode()
+            # certificate checking (certcheck and certfile) is set up once, for every session in session_pool
+            response = session_pool.request('POST', trustedurl, data=postdata)
+            response.raise_for_status()
+
+            ticket = response.content.decode()
             log.logger.debug('Got ticket: {}'.format(ticket))
 
             if ticket == '-1' or not ticket:
@@ -90,15 +314,15 @@ def get_trusted_ticket(server, sitename, username, encrypt, certcheck=True, cert
                 log.logger.error(errormessage)
                 raise UserWarning(errormessage)
 
-        except urllib.error.HTTPError as e:
-            errormessage = html.escape('HTTPError generating trusted ticket: {}  Request details: {}'.format(str(e.reason), requestdetails))
+        except requests.exceptions.HTTPError as e:
+            errormessage = html.escape('HTTPError generating trusted ticket: {}  Request details: {}'.format(str(e.response.reason), requestdetails))
             log.logger.error(errormessage)
             if attempts >= tries:
                 raise UserWarning(errormessage)
             else:
                 continue
-        except urllib.error.URLError as e:
-            errormessage = html.escape('URLError generating trusted ticket: {}  Request details: {}'.format(str(e.reason), requestdetails))
+        except requests.exceptions.RequestException as e:
+            errormessage = html.escape('RequestException generating trusted ticket: {}  Request details: {}'.format(str(e), requestdetails))
             log.logger.error(errormessage)
             if attempts >= tries:
                 raise UserWarning(errormessage)
@@ -115,11 +339,171 @@ def get_trusted_ticket(server, sitename, username, encrypt, certcheck=True, cert
                 raise UserWarning(errormessage)
             else:
                 continue
+        finally:
+            # reported separately from export times, to show how much of each export is spent getting its ticket
+            stats.record_time('ticket', time.time() - started_at)
 
         # no need for further retries
         return ticket
 
 
+def mint_ticket(site_name, user_sysname, user_domain):
+    """Get a trusted ticket for a user on a site, using the server settings from the config"""
+    if config.configs['trusted.useclientip']:
+        clientip = config.configs['trusted.clientip']
+    else:
+        clientip = None
+    return get_trusted_ticket(config.configs['server'], site_name, user_sysname, config.configs['server.ssl'],
+                              config.configs['server.certcheck'], config.configs['server.certfile'], user_domain,
+                              clientip)
+
+
+class TicketPrefetcher(object):
+    """Keeps up to pool_size trusted tickets ready for each user, domain and site that has recently asked for one,
+        minted by a background thread, so exports don't have to wait on /trusted for their ticket.
+
+        Tickets can only be redeemed once, and expire on Tableau Server after a few minutes, so any ticket older
+        than max_age_s is thrown away unused. Users stop being prefetched for once they haven't asked for a ticket
+        in max_age_s either"""
+
+    def __init__(self, pool_size, max_age_s):
+        self.pool_size = pool_size
+        self.max_age_s = max_age_s
+        self.tickets = {}  # (site_name, user_sysname, user_domain): deque of (time minted, ticket), oldest first
+        self.last_asked = {}  # (site_name, user_sysname, user_domain): time a ticket was last asked for
+        self.condition = threading.Condition()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='ticket_prefetcher')
+        thread.daemon = True
+        thread.start()
+
+    def get(self, site_name, user_sysname, user_domain):
+        """Returns a ready ticket for the user no older than max_age_s, or None if there isn't one yet. Its age is only
+            checked now, so call this once the ticket is about to be redeemed, not before waiting on anything"""
+        key = (site_name, user_sysname, user_domain)
+        with self.condition:
+            self.last_asked[key] = time.time()
+            tickets = self.discard_expired(key)
+            ticket = tickets.popleft()[1] if tickets else None
+            self.condition.notify()  # there's room for another ticket now
+
+        if ticket:
+            stats.increment('ticket.prefetch.hits')
+        else:
+            stats.increment('ticket.prefetch.misses')
+        return ticket
+
+    def discard_expired(self, key):
+        """Drop tickets for key that are too old to use. Must be called holding self.condition"""
+        tickets = self.tickets.setdefault(key, deque())
+        cutoff = time.time() - self.max_age_s
+        while tickets and tickets[0][0] < cutoff:
+            tickets.popleft()
+            stats.increment('ticket.prefetch.expired')
+        return tickets
+
+    def get_wanted(self):
+        """The key most in need of a ticket, or None. Must be called holding self.condition"""
+        cutoff = time.time() - self.max_age_s
+        wanted = None
+        for key, last_asked in list(self.last_asked.items()):
+            if last_asked < cutoff:
+                # not asked for lately, so stop keeping tickets for it
+                del self.last_asked[key]
+                self.tickets.pop(key, None)
+                continue
+            count = len(self.discard_expired(key))
+            if count < self.pool_size and (wanted is None or count < len(self.tickets[wanted])):
+                wanted = key
+        return wanted
+
+    def run(self):
+        while True:
+            with self.condition:
+                key = self.get_wanted()
+                while key is None:
+                    # wake up in time to replace tickets as they expire
+                    self.condition.wait(self.max_age_s / 2.0)
+                    key = self.get_wanted()
+
+            try:
+                ticket = mint_ticket(*key)
+            except Exception as e:
+                log.logger.warning('Unable to prefetch a trusted ticket for user {} on site {}: {}'.format(
+                    key[1], key[0], e))
+                with self.condition:
+                    # leave it to exports to get their own tickets until it's asked for again
+                    self.last_asked.pop(key, None)
+                continue
+
+            with self.condition:
+                if key in self.last_asked:
+                    self.tickets.setdefault(key, deque()).append((time.time(), ticket))
+
+
+def limited_request(method, url, site_name, workbook_name, send=None, **kwargs):
+    """Make an export request, once there's room under the limits on concurrent exports, with send if given or a
+        pooled session if not. Takes the most specific limit first, so we don't hold up other sites while waiting on
+        a busy workbook. url may be a function returning the URL, called only once there's room, for URLs holding
+        something that expires while waiting, like a trusted ticket"""
+    send = send or session_pool.request
+    response = None
+    overloaded = False
+    workbook_key = (site_name, workbook_name)
+    workbook_limiter.acquire(workbook_key)
+    site_limiter.acquire(site_name)
+    export_limiter.acquire()
+    started_at = time.time()
+    try:
+        if callable(url):
+            url = url()
+            started_at = time.time()  # the export itself starts now
+        response = send(method, url, **kwargs)
+        overloaded = response.status_code >= 500
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        overloaded = True
+        raise
+    finally:
+        latency_s = time.time() - started_at
+        export_limiter.release(latency_s, overloaded)
+        site_limiter.release(site_name)
+        workbook_limiter.release(workbook_key)
+        stats.record_time('export', latency_s)
+        if overloaded:
+            stats.increment('export.overloaded')
+    return response
+
+
+def write_export(response, format, viewurlsuffix):
+    """Write an exported view to a new file in temp.dir, returning its path"""
+
+    # Create the temporary file, datestring is down to microsecond to prevent dups since
+    # we are excluding any extraurl parameters for space & security reasons
+    # (users might obfuscate results by hiding URL parameters)
+    datestring = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    filename = datestring + '_' + threading.current_thread().name + '_' + viewurlsuffix.replace('/', '-') + '.' + format
+    filepath = config.configs['temp.dir'] + filename
+
+    log.logger.info('Attempting to write to: {}'.format(filepath))
+
+    if format == Format.CSV:
+        f = open(filepath, 'wb')
+        filebytes = response.content
+        realstr = filebytes.decode(encoding='utf-8')
+        lateststr = realstr.replace('\r\n', '\n')
+        finalbinary = lateststr.encode()
+        f.write(finalbinary) # remove extra carriage returns
+    else:
+        f = open(filepath, 'wb')
+        for block in response.iter_content(1024):
+            if not block:
+                break
+            f.write(block)
+    f.close()
+    return filepath
+
+
 # Export a view to a file in the specified format based on a trusted ticket
 def export_view(view_url_suffix, site_name, timeout_s, data_retrieval_tries, force_refresh, format,
                 viz_png_width, viz_png_height, user_sysname, user_domain):
@@ -136,7 +520,6 @@ def export_view(view_url_suffix, site_name, timeout_s, data_retrieval_tries, for
     encrypt = config.configs['server.ssl']
     certcheck = config.configs['server.certcheck']
     certfile = config.configs['server.certfile']
-    tempdir = config.configs['temp.dir']
     if config.configs['trusted.useclientip']:
         clientip = config.configs['trusted.clientip']
     else:
@@ -181,71 +564,42 @@ def export_view(view_url_suffix, site_name, timeout_s, data_retrieval_tries, for
     if force_refresh:
         displayurl = displayurl + '&:refresh=y'   # show admin/users that we forced a force_refresh
 
+    last_export.retries = 0
     while attempts < data_retrieval_tries:
         try:
             attempts += 1
+            last_export.retries = attempts - 1
+
+            def get_url():
+                # called once the export has room to run, so its ticket can't expire while it waits its turn.
+                #   Use a trusted ticket that's ready and waiting if we can
+                ticket = None
+                if ticket_prefetcher:
+                    ticket = ticket_prefetcher.get(site_name, user_sysname, user_domain)
+                if not ticket:
+                    ticket = get_trusted_ticket(server, site_name, user_sysname, encrypt, certcheck, certfile, user_domain, clientip)
 
-            # get a trusted ticket
-            ticket = get_trusted_ticket(server, site_name, user_sysname, encrypt, certcheck, certfile, user_domain, clientip)
-			
-            # build final URL
-            url = protocol + '://' + server + '/trusted/' + ticket + sitepart + '/views/' + viewurlsuffix + extraurlparameter + formatparam
+                # build final URL
+                url = protocol + '://' + server + '/trusted/' + ticket + sitepart + '/views/' + viewurlsuffix + extraurlparameter + formatparam
 
-            if force_refresh:
-                url = url + '&:refresh=y'   # force a force_refresh of the data--we don't want alerts based on cached (stale) data
+                if force_refresh:
+                    url = url + '&:refresh=y'   # force a force_refresh of the data--we don't want alerts based on cached (stale) data
 
-            log.logger.debug('Getting vizdata from: {}'.format(url))
+                log.logger.debug('Getting vizdata from: {}'.format(url))
+                return url
 
-            # Make the GET call to obtain the data
-            response = None
+            workbook_name = viewurlsuffix.split('/')[0]
             if user_domain:
-                # Tableau Server is using AD auth (is this even needed? May need to remove later)
-                if certcheck:
-                    log.logger.debug('Validating cert for this request using certfile {}'.format(certfile))
-                    if not certfile:
-                        certfile = requests.utils.DEFAULT_CA_BUNDLE_PATH
-                    response = requests.get(url, auth=HttpNtlmAuth(user_domain + '\\' + user_sysname, ''), verify=certfile, timeout=timeout_s)
-                else:
-                    log.logger.debug('NOT Validating cert for this request')
-                    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)  # disable warnings for unverified certs
-                    response = requests.get(url, auth=HttpNtlmAuth(user_domain + '\\' + user_sysname, ''), verify=False, timeout=timeout_s)
+                # Tableau Server is using AD auth, so use a connection authenticated as the user
+                send = functools.partial(ntlm_request, user_domain, user_sysname)
+                response = limited_request('GET', get_url, site_name, workbook_name, send, timeout=timeout_s)
             else:
                 # Server is using local auth
-                if certcheck:
-                    log.logger.debug('Validating cert for this request using certfile {}'.format(certfile))
-                    if not certfile:
-                        certfile = requests.utils.DEFAULT_CA_BUNDLE_PATH
-                    response = requests.get(url, auth=(user_sysname, ''), verify=certfile, timeout=timeout_s)
-                else:
-                    log.logger.debug('NOT Validating cert for this request')
-                    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)  # disable warnings for unverified certs
-                    response = requests.get(url, auth=(user_sysname, ''), verify=False, timeout=timeout_s)
+                response = limited_request('GET', get_url, site_name, workbook_name, auth=(user_sysname, ''),
+                                           timeout=timeout_s)
             response.raise_for_status()
 
-            # Create the temporary file, datestring is down to microsecond to prevent dups since
-            # we are excluding any extraurl parameters for space & security reasons
-            # (users might obfuscate results by hiding URL parameters)
-            datestring = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-            filename = datestring + '_' + threading.current_thread().name + '_' + viewurlsuffix.replace('/', '-') + '.' + format
-            filepath = tempdir + filename
-
-            log.logger.info('Attempting to write to: {}'.format(filepath))
-
-            if format == Format.CSV:
-                f = open(filepath, 'wb')
-                filebytes = response.content
-                realstr = filebytes.decode(encoding='utf-8')
-                lateststr = realstr.replace('\r\n', '\n')
-                finalbinary = lateststr.encode()
-                f.write(finalbinary) # remove extra carriage returns
-            else:
-                f = open(filepath, 'wb')
-                for block in response.iter_content(1024):
-                    if not block:
-                        break
-                    f.write(block)
-            f.close()
-            return filepath
+            return write_export(response, format, viewurlsuffix)
         except requests.exceptions.Timeout as e:
             errormessage = html.escape('Timeout error. Could not retrieve vizdata from url {} within {} seconds, after {} tries'.format(displayurl, timeout_s, attempts))
             log.logger.error(errormessage)
@@ -281,7 +635,7 @@ def export_view(view_url_suffix, site_name, timeout_s, data_retrieval_tries, for
             else:
                 continue
         except IOError as e:
-            errormessage = html.escape('Unable to write the file {} for url {}, error: {}'.format(filepath, displayurl, e))
+            errormessage = html.escape('Unable to write the file for url {}, error: {}'.format(displayurl, e))
             log.logger.error(errormessage)
             if attempts >= data_retrieval_tries:
                 raise UserWarning(errormessage)
@@ -0,0 +1,253 @@
+#! python
+# -*- coding: utf-8 -*-
+# Exports views through the Tableau REST API, as an alternative to getting a trusted ticket for every export.
+#   Signs in once for each site and user, and reuses the session until Tableau Server says it has expired.
+#   Selected with export.backend: rest
+
+import html
+import re
+import threading
+import urllib.parse
+
+import requests
+
+# import local modules
+from . import config
+from . import log
+from . import stats
+from . import tabhttp
+
+# the REST API endpoint that exports a view in each format (tabhttp.Format)
+FORMAT_ENDPOINTS = {'csv': 'data', 'png': 'image', 'pdf': 'pdf'}
+
+
+class RestSession(object):
+    """A signed in REST API session for one user on one site"""
+
+    def __init__(self, token, site_id, user_id):
+        self.token = token
+        self.site_id = site_id
+        self.user_id = user_id
+
+
+class RestSessions(object):
+    """Signed in REST API sessions, shared by every export. server.user signs in to each site with rest.password,
+        then that session is used to look up the subscriber and sign in again as them, so each export only sees what
+        its subscriber is allowed to see"""
+
+    def __init__(self):
+        self.sessions = {}  # (site_name, user_sysname, user_domain): RestSession, None for the configured user
+        self.user_ids = {}  # (site_name, user_sysname, user_domain): user id
+        self.view_ids = {}  # (site_name, workbook/view): view id
+        self.key_locks = {}  # session key: lock held while signing in, so each session is only signed in once
+        self.lock = threading.Lock()
+
+    def get_api_url(self, path):
+        if config.configs['server.ssl']:
+            protocol = 'https'
+        else:
+            protocol = 'http'
+        return '{}://{}/api/{}{}'.format(protocol, config.configs['server'], config.configs['rest.api_version'], path)
+
+    def sign_in(self, site_name, user_id, timeout_s):
+        credentials = {'site': {'contentUrl': site_name},
+                       'name': config.configs['server.user'],
+                       'password': config.configs['rest.password']}
+        if user_id:
+            credentials['user'] = {'id': user_id}
+
+        log.logger.debug('Signing in to the REST API on site {}, user id {}'.format(site_name, user_id))
+        response = tabhttp.session_pool.request('POST', self.get_api_url('/auth/signin'),
+                                                json={'credentials': credentials},
+                                                headers={'Accept': 'application/json'},
+                                                timeout=timeout_s)
+        response.raise_for_status()
+        stats.increment('rest.signins')
+
+        signed_in = response.json()['credentials']
+        return RestSession(signed_in['token'], signed_in['site']['id'], signed_in['user']['id'])
+
+    def get(self, site_name, user_sysname, user_domain, timeout_s):
+        """The session for a user on a site, signing in if there isn't one"""
+        if user_sysname == config.configs['server.user']:
+            key = (site_name, None, None)  # no need to impersonate
+        else:
+            key = (site_name, user_sysname, user_domain)
+
+        with self.lock:
+            session = self.sessions.get(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        if session:
+            return session
+
+        with key_lock:
+            with self.lock:
+                session = self.sessions.get(key)
+            if session:
+                return session  # another thread signed in while we waited
+
+            user_id = None
+            if key[1] is not None:
+                user_id = self.get_user_id(site_name, user_sysname, user_domain, timeout_s)
+            session = self.sign_in(site_name, user_id, timeout_s)
+            with self.lock:
+                self.sessions[key] = session
+            return session
+
+    def invalidate(self, session):
+        """Forget a session that Tableau Server no longer accepts"""
+        with self.lock:
+            for key, cached in list(self.sessions.items()):
+                if cached is session:
+                    del self.sessions[key]
+
+    def request(self, method, path, site_name, user_sysname, user_domain, timeout_s, workbook_name=None, **kwargs):
+        """Make a REST API request as a user, signing in again if their session has expired. path may include
+            {site_id}. Exports (with a workbook_name) are made under the limits on concurrent exports"""
+        for attempt in range(2):
+            session = self.get(site_name, user_sysname, user_domain, timeout_s)
+            url = self.get_api_url(path.format(site_id=session.site_id))
+            headers = {'X-Tableau-Auth': session.token, 'Accept': 'application/json'}
+            if workbook_name is None:
+                response = tabhttp.session_pool.request(method, url, headers=headers, timeout=timeout_s, **kwargs)
+            else:
+                response = tabhttp.limited_request(method, url, site_name, workbook_name, headers=headers,
+                                                   timeout=timeout_s, **kwargs)
+            if response.status_code != 401:
+                return response
+
+            log.logger.debug('REST API session for user {} on site {} has expired'.format(user_sysname, site_name))
+            stats.increment('rest.expired')
+            self.invalidate(session)
+        return response
+
+    def get_user_id(self, site_name, user_sysname, user_domain, timeout_s):
+        """Look up a user's id on a site, as the configured user"""
+        key = (site_name, user_sysname, user_domain)
+        with self.lock:
+            user_id = self.user_ids.get(key)
+        if user_id:
+            return user_id
+
+        response = self.request('GET', '/sites/{site_id}/users', site_name, config.configs['server.user'], None,
+                                timeout_s, params={'filter': 'name:eq:{}'.format(user_sysname)})
+        response.raise_for_status()
+        users = response.json().get('users', {}).get('user', [])
+        if user_domain:
+            users = [user for user in users if user.get('domain', {}).get('name', '').lower() == user_domain.lower()]
+        if not users:
+            raise UserWarning('User {} could not be found on site {}'.format(user_sysname, site_name))
+
+        with self.lock:
+            self.user_ids[key] = users[0]['id']
+        return users[0]['id']
+
+    def get_view_id(self, site_name, viewurlsuffix, timeout_s):
+        """Look up the id of a view, given its workbook/view url, as the configured user"""
+        key = (site_name, viewurlsuffix)
+        with self.lock:
+            view_id = self.view_ids.get(key)
+        if view_id:
+            return view_id
+
+        workbook_name, view_name = viewurlsuffix.split('/', 1)
+        response = self.request('GET', '/sites/{site_id}/views', site_name, config.configs['server.user'], None,
+                                timeout_s, params={'filter': 'viewUrlName:eq:{}'.format(view_name)})
+        response.raise_for_status()
+        content_url = '{}/sheets/{}'.format(workbook_name, view_name)
+        views = [view for view in response.json().get('views', {}).get('view', [])
+                 if view.get('contentUrl') == content_url]
+        if not views:
+            raise UserWarning('View {} could not be found on site {}'.format(viewurlsuffix, site_name))
+
+        with self.lock:
+            self.view_ids[key] = views[0]['id']
+        return views[0]['id']
+
+
+# sessions shared by every export
+sessions = RestSessions()
+
+
+def get_export_params(extraurlparameter, format, force_refresh, viz_png_width, viz_png_height):
+    """Translate the URL parameters of a view reference into REST API export parameters. Field filters become
+        vf_ parameters, and :size becomes the image width and height"""
+    params = {}
+    width, height = viz_png_width, viz_png_height
+    for name, value in urllib.parse.parse_qsl(extraurlparameter, keep_blank_values=True):
+        if name == ':size':
+            width, height = value.split(',', 1)
+        elif name.startswith(':'):
+            log.logger.debug('URL parameter {} is not supported by the REST API, ignoring it'.format(name))
+        else:
+            params['vf_' + name] = value
+
+    if format == tabhttp.Format.PNG:
+        params['vizWidth'] = width
+        params['vizHeight'] = height
+        params['resolution'] = 'high'
+
+    if force_refresh:
+        params['maxAge'] = 1  # minutes; the shortest time the REST API will cache for
+    return params
+
+
+def export_view(view_url_suffix, site_name, timeout_s, data_retrieval_tries, force_refresh, format,
+                viz_png_width, viz_png_height, user_sysname, user_domain):
+    """Export a view to a file in temp.dir through the REST API, as the subscriber, returning the path to the file.
+        Takes the same arguments as tabhttp.export_view"""
+
+    site_name = str(site_name).replace('Default', '')
+
+    if user_domain == 'local':  # leave it as None if Server uses local authentication
+        user_domain = None
+
+    if format not in FORMAT_ENDPOINTS:
+        raise UserWarning('Exporting to {} is not supported with export.backend {}'.format(
+            format, config.EXPORT_BACKEND_REST))
+
+    # viewurlsuffix may be of form workbook/view or workbook/view?param1=value1&param2=value2
+    search = re.search('(.*?)\?(.*)', view_url_suffix)
+    if search:
+        viewurlsuffix = search.group(1)
+        extraurlparameter = search.group(2)
+    else:
+        viewurlsuffix = view_url_suffix
+        extraurlparameter = ''
+    params = get_export_params(extraurlparameter, format, force_refresh, viz_png_width, viz_png_height)
+
+    # for logging and error reporting
+    displayurl = 'view {} on site {} ({})'.format(viewurlsuffix, site_name, urllib.parse.urlencode(params))
+
+    attempts = 0
+    tabhttp.last_export.retries = 0
+    while True:
+        attempts += 1
+        tabhttp.last_export.retries = attempts - 1
+        try:
+            view_id = sessions.get_view_id(site_name, viewurlsuffix, timeout_s)
+            log.logger.debug('Getting {} of {} through the REST API'.format(format, displayurl))
+            path = '/sites/{{site_id}}/views/{}/{}'.format(view_id, FORMAT_ENDPOINTS[format])
+            response = sessions.request('GET', path, site_name, user_sysname, user_domain, timeout_s,
+                                        workbook_name=viewurlsuffix.split('/')[0], params=params)
+            response.raise_for_status()
+            return tabhttp.write_export(response, format, viewurlsuffix)
+        except requests.exceptions.Timeout as e:
+            errormessage = html.escape('Timeout error. Could not export {} within {} seconds, after {} tries'.format(
+                displayurl, timeout_s, attempts))
+        except requests.exceptions.HTTPError as e:
+            errormessage = html.escape('HTTP error exporting {}. Code: {} Reason: {}'.format(
+                displayurl, e.response.status_code, e.response.reason))
+        except requests.exceptions.RequestException as e:
+            errormessage = html.escape('Request Exception exporting {}. Error: {}'.format(displayurl, e))
+        except UserWarning as e:
+            # the view or user doesn't exist, so trying again won't help
+            errormessage = html.escape('Unable to export {}: {}'.format(displayurl, e.args[0]))
+            log.logger.error(errormessage)
+            raise UserWarning(errormessage)
+        except IOError as e:
+            errormessage = html.escape('Unable to write the file for {}, error: {}'.format(displayurl, e))
+
+        log.logger.error(errormessage)
+        if attempts >= data_retrieval_tries:
+            raise UserWarning(errormessage)
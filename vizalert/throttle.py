@@ -0,0 +1,91 @@
+#! python
+# -*- coding: utf-8 -*-
+# Limits on how much work VizAlerts puts on Tableau Server at once
+
+import threading
+import time
+
+# import local modules
+from . import log
+from . import stats
+
+# the limit is multiplied by this when the server shows signs of overload
+BACKOFF_FACTOR = 0.5
+
+
+class AdaptiveLimiter(object):
+    """Limits concurrent requests with additive increase / multiplicative decrease (AIMD).
+
+        Every request that completes in under latency_target_s without an overload error raises the limit by
+        1/limit, so it grows by about one per round of requests. A slow request, timeout or 5xx error halves it.
+        Requests already in flight when the limit drops will see the same overload, so it is only cut once per
+        latency_target_s. The limit never goes below floor or above ceiling"""
+
+    def __init__(self, name, floor, ceiling, latency_target_s):
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.latency_target_s = latency_target_s
+        self.limit = float(ceiling)
+        self.in_use = 0
+        self.last_backoff_at = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until there's room under the limit for another request"""
+        started_at = time.time()
+        with self.condition:
+            while self.in_use >= int(self.limit):
+                self.condition.wait()
+            self.in_use += 1
+        stats.record_time('{}.wait'.format(self.name), time.time() - started_at)
+
+    def release(self, latency_s, overloaded=False):
+        """Record the outcome of a request, adjusting the limit to suit"""
+        with self.condition:
+            self.in_use -= 1
+            previous_limit = int(self.limit)
+            now = time.time()
+
+            if overloaded or latency_s > self.latency_target_s:
+                if now - self.last_backoff_at >= self.latency_target_s:
+                    self.limit = max(float(self.floor), self.limit * BACKOFF_FACTOR)
+                    self.last_backoff_at = now
+            else:
+                self.limit = min(float(self.ceiling), self.limit + 1 / self.limit)
+
+            current_limit = int(self.limit)
+            self.condition.notify_all()
+
+        stats.set_value('{}.limit'.format(self.name), current_limit)
+        if current_limit != previous_limit:
+            log.logger.info('{} concurrency limit changed from {} to {} (latest request took {:.1f}s{})'.format(
+                self.name, previous_limit, current_limit, latency_s, ', overloaded' if overloaded else ''))
+
+
+class KeyedLimiter(object):
+    """A fixed limit on concurrent requests for each key, e.g. each site. Requests over the limit wait their turn"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(self.limit)
+            semaphore = self.semaphores[key]
+
+        started_at = time.time()
+        if not semaphore.acquire(blocking=False):
+            log.logger.debug('Waiting for one of the {} requests already running for {} {} to finish'.format(
+                self.limit, self.name, key))
+            semaphore.acquire()
+        stats.record_time('{}.wait'.format(self.name), time.time() - started_at)
+
+    def release(self, key):
+        with self.lock:
+            semaphore = self.semaphores[key]
+        semaphore.release()
@@ -0,0 +1,242 @@
+#! python
+# -*- coding: utf-8 -*-
+# Trigger data read from the CSV exported for a VizAlert, held in memory or, for very large CSVs, streamed from disk
+
+import csv
+import heapq
+import itertools
+import pickle
+import sys
+import tempfile
+
+from collections.abc import Mapping
+
+
+def sort_key(values):
+    """A key for sorting tuples of field values, which may include None for the fields missing from a short row.
+        None sorts before every string, even the empty string, so it never has to be compared with one"""
+    return tuple([(value is not None, value or '') for value in values])
+
+
+class TriggerData(object):
+    """The header and rows of a trigger CSV, read in a single pass and shared by every processing stage.
+
+        Values are held column by column, each value interned so the many repeats of an address, subject or flag
+        share a single string. Rows are produced as lightweight views over the columns, only when asked for"""
+
+    def __init__(self, fieldnames=None):
+        self.fieldnames = list(fieldnames or [])
+        self.field_index = dict((fieldname, index) for index, fieldname in enumerate(self.fieldnames))
+        self.columns = [[] for fieldname in self.fieldnames]
+        self.rowcount = 0
+        self.exceeded_max_rows = False  # set if reading stopped early because there were too many rows
+        self.streamed = False
+
+    def __len__(self):
+        return self.rowcount
+
+    def __iter__(self):
+        for index in range(self.rowcount):
+            yield RowView(self, index)
+
+    def append(self, values):
+        """Add a row of values, in fieldnames order. Short rows are padded with None, as csv.DictReader does"""
+        for column, value in zip(self.columns, values):
+            column.append(sys.intern(value))
+        for column in self.columns[len(values):]:
+            column.append(None)
+        self.rowcount += 1
+
+    def column(self, fieldname):
+        """All values of a field, in row order"""
+        return self.columns[self.field_index[fieldname]]
+
+    def row(self, index):
+        return RowView(self, index)
+
+    def rows_at(self, indices):
+        """Views of the rows at the given indices, in that order"""
+        return [RowView(self, index) for index in indices]
+
+    def indices_where(self, fieldname, value):
+        """Indices of the rows where a field has a given value"""
+        return [index for index, cell in enumerate(self.column(fieldname)) if cell == value]
+
+    def distinct_indices(self, indices, fieldnames):
+        """The indices of the first row with each distinct combination of values in fieldnames, in their
+            original order"""
+        columns = [self.column(fieldname) for fieldname in fieldnames]
+        seen = set()
+        distinct = []
+        for index in indices:
+            values = tuple([column[index] for column in columns])
+            if values not in seen:
+                seen.add(values)
+                distinct.append(index)
+        return distinct
+
+    def sorted_indices(self, indices, fieldnames):
+        """Row indices sorted by the values in fieldnames, the first field being the most significant. The sort is
+            stable, so rows with the same values stay in their current order"""
+        if not fieldnames:
+            return list(indices)
+        columns = [self.column(fieldname) for fieldname in fieldnames]
+        return sorted(indices, key=lambda index: sort_key([column[index] for column in columns]))
+
+
+class RowView(Mapping):
+    """A read-only, dict-like view of one row of TriggerData"""
+
+    __slots__ = ('trigger_data', 'index')
+
+    def __init__(self, trigger_data, index):
+        self.trigger_data = trigger_data
+        self.index = index
+
+    def __getitem__(self, fieldname):
+        return self.trigger_data.columns[self.trigger_data.field_index[fieldname]][self.index]
+
+    def __contains__(self, fieldname):
+        return fieldname in self.trigger_data.field_index
+
+    def __iter__(self):
+        return iter(self.trigger_data.fieldnames)
+
+    def __len__(self):
+        return len(self.trigger_data.fieldnames)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class StreamedTriggerData(object):
+    """Trigger data too large to hold in memory. Each pass over it reads the CSV again, a row at a time"""
+
+    def __init__(self, path, fieldnames, rowcount, exceeded_max_rows=False):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.rowcount = rowcount
+        self.exceeded_max_rows = exceeded_max_rows
+        self.streamed = True
+
+    def __len__(self):
+        return self.rowcount
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def read_csv(path, max_rows=None, streaming_rows=0):
+    """Read a trigger CSV into a TriggerData, closing the file before returning. Stops reading once there are more
+        than max_rows rows, setting exceeded_max_rows.
+
+        If streaming_rows isn't 0 and there turn out to be more rows than that, the rest of the file is only counted,
+        and a StreamedTriggerData is returned instead"""
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        trigger_data = TriggerData(next(reader, []))
+        rowcount = 0
+        exceeded_max_rows = False
+
+        for values in reader:
+            if not values:
+                continue  # blank lines aren't rows, as with csv.DictReader
+            if max_rows is not None and rowcount > max_rows:
+                exceeded_max_rows = True
+                break
+            if streaming_rows and rowcount == streaming_rows:
+                trigger_data.columns = None  # too big to keep; from here on just count the rows
+            if trigger_data.columns is not None:
+                trigger_data.append(values)
+            rowcount += 1
+
+    if trigger_data.columns is None:
+        return StreamedTriggerData(path, trigger_data.fieldnames, rowcount, exceeded_max_rows)
+
+    trigger_data.exceeded_max_rows = exceeded_max_rows
+    return trigger_data
+
+
+def group_rows(rows, key=None):
+    """Yields lists of consecutive rows sharing the same key(row), so rows sorted on the key are grouped in a single
+        pass, holding only one group in memory at a time. With no key, each row is a group of its own"""
+    if key is None:
+        for row in rows:
+            yield [row]
+        return
+
+    for group_key, group in itertools.groupby(rows, key):
+        yield list(group)
+
+
+def external_sort(items, buffer_size, tempdir=None, key=None):
+    """Sorts items of any size with bounded memory. Up to buffer_size items at a time are sorted in memory and
+        written to a temporary file, then the files are merged. items must be picklable"""
+    runs = []
+    buffer = []
+    try:
+        for item in items:
+            buffer.append(item)
+            if len(buffer) >= buffer_size:
+                runs.append(write_run(buffer, tempdir, key))
+                buffer = []
+
+        if not runs:
+            # it all fit in memory
+            buffer.sort(key=key)
+            for item in buffer:
+                yield item
+            return
+
+        if buffer:
+            runs.append(write_run(buffer, tempdir, key))
+            buffer = []
+        for item in heapq.merge(*[read_run(run) for run in runs], key=key):
+            yield item
+    finally:
+        for run in runs:
+            run.close()
+
+
+def write_run(buffer, tempdir, key):
+    """Sort a buffer of items and write them to a temporary file, which is deleted once closed"""
+    buffer.sort(key=key)
+    run = tempfile.TemporaryFile(dir=tempdir)
+    for item in buffer:
+        pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def stream_unique_rows(trigger_data, flag_fieldname, fieldnames, sort_fieldnames, buffer_size, tempdir=None):
+    """Yields the distinct rows of trigger data with the action flag set, as dicts of fieldnames, sorted by
+        sort_fieldnames then by their original order, as get_unique_vizdata does in memory. Two external sorts are
+        used: one on every value, to bring duplicates together and keep the first of each, then one on the sort
+        fields. Memory use is bounded by buffer_size, however many rows there are"""
+    positions = [fieldnames.index(fieldname) for fieldname in sort_fieldnames]
+
+    # missing values stay None, as they do in memory, and are sorted with sort_key
+    flagged = ((tuple([row[fieldname] for fieldname in fieldnames]), rownum)
+               for rownum, row in enumerate(trigger_data) if row[flag_fieldname] == '1')
+
+    def distinct():
+        previous = None
+        for values, rownum in external_sort(flagged, buffer_size, tempdir,
+                                            key=lambda item: (sort_key(item[0]), item[1])):
+            if values != previous:
+                previous = values
+                yield tuple([values[position] for position in positions]), rownum, values
+
+    for sort_values, rownum, values in external_sort(distinct(), buffer_size, tempdir,
+                                                      key=lambda item: (sort_key(item[0]), item[1])):
+        yield dict(list(zip(fieldnames, values)))
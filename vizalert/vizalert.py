@@ -11,17 +11,21 @@ import time
 from PyPDF2 import PdfReader, PdfMerger
 from collections import OrderedDict
 from os.path import abspath, basename, expanduser
-from operator import itemgetter
 import posixpath
 import uuid
 from queue import Queue
 
 # import local modules
+from . import cache
 from . import config
 from . import log
 from . import tabhttp
+from . import tabrest
 from . import emailaction
 from . import smsaction
+from . import patterns
+from . import stats
+from . import triggerdata
 
 # reserved strings for Advanced Alerts embedding
 IMAGE_PLACEHOLDER = 'VIZ_IMAGE()'
@@ -116,8 +120,11 @@ class UnicodeDictReader(csv.DictReader):
         self.reader = UnicodeCsvReader(f, encoding=encoding, **kwds)
 
 
-class ActionField(object):
-    """Represents a mapping of a field found in a trigger CSV to an action property"""
+class ActionFieldSpec(object):
+    """Describes a field that may be found in a trigger CSV, mapping to an action property. These are shared by all
+        VizAlerts, so must not be changed once created"""
+
+    __slots__ = ('name', 'action_type', 'is_required', 'is_action_flag', 'pattern', 'regex', 'default_value')
 
     def __init__(self, name, action_type, is_required, is_action_flag, pattern, default_value=None):
         self.name = name
@@ -125,12 +132,91 @@ class ActionField(object):
         self.is_required = is_required  # "if performing this action_type, is this field required to do it?"
         self.is_action_flag = is_action_flag
         self.pattern = pattern
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.default_value = default_value  # used for all alerts, unless the alert sets its own
+
+
+# all possible alert fields, keyed by action field name
+# General
+# consolidated and sort have backwards-compatible options for v1.x
+ACTION_FIELD_SPECS = OrderedDict((spec.name, spec) for spec in [
+    ActionFieldSpec(GENERAL_SORTORDER_FIELDKEY, GENERAL_ACTION_TYPE, False, False, '.*Consolidated.Sort|.*Sort.Order'),
+    ActionFieldSpec(CONSOLIDATE_LINES_FIELDKEY, GENERAL_ACTION_TYPE, False, False,
+                    '.*Consolidate.Lines|.*Email.Consolidate'),
+
+    # Email Action fields
+    ActionFieldSpec(EMAIL_ACTION_FIELDKEY, EMAIL_ACTION_TYPE, True, True, ' ?Email.Action'),
+    ActionFieldSpec(EMAIL_SUBJECT_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.Subject'),
+    ActionFieldSpec(EMAIL_TO_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.To'),
+    ActionFieldSpec(EMAIL_FROM_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.From'),
+    ActionFieldSpec(EMAIL_CC_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.CC'),
+    ActionFieldSpec(EMAIL_BCC_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.BCC'),
+    ActionFieldSpec(EMAIL_BODY_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.Body', 'VIZ_IMAGE(|vizlink)'),
+    ActionFieldSpec(EMAIL_HEADER_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Header'),
+    ActionFieldSpec(EMAIL_FOOTER_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Footer'),
+    ActionFieldSpec(EMAIL_ATTACHMENT_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Attachment'),
+
+    # SMS Action fields
+    ActionFieldSpec(SMS_ACTION_FIELDKEY, SMS_ACTION_TYPE, True, True, ' ?SMS.Action'),
+    ActionFieldSpec(SMS_TO_FIELDKEY, SMS_ACTION_TYPE, True, False, ' ?SMS.To'),
+    ActionFieldSpec(SMS_MESSAGE_FIELDKEY, SMS_ACTION_TYPE, True, False, ' ?SMS.Message'),
+    ActionFieldSpec(SMS_HEADER_FIELDKEY, SMS_ACTION_TYPE, False, False, ' ?SMS.Header'),
+    ActionFieldSpec(SMS_FOOTER_FIELDKEY, SMS_ACTION_TYPE, False, False, ' ?SMS.Footer')])
+
+# number of distinct trigger CSV headers whose action field matches are remembered
+FIELD_MATCHES_CACHE_SIZE = 1000
+
+# action field matches for the trigger CSV headers seen most recently. Many alerts share the same header layout
+#   tuple of field names: {action field name: list of matching field names}
+field_matches_cache = cache.LRUCache('field_matches', FIELD_MATCHES_CACHE_SIZE)
+
+
+def get_field_matches(fieldnames):
+    """Returns the fields in a trigger CSV header that match each action field"""
+    header = tuple(fieldnames)
+    return field_matches_cache.get(header, lambda: match_fields(header))
+
+
+def match_fields(header):
+    field_matches = {}
+    for key, spec in list(ACTION_FIELD_SPECS.items()):
+        field_matches[key] = [field for field in header if spec.regex.match(field)]
+    return field_matches
+
+
+class ActionField(object):
+    """The mapping of one action field to a field in a particular VizAlert's trigger CSV"""
+
+    __slots__ = ('spec', 'field_name', 'default_value', 'match_list', 'error_list')
+
+    def __init__(self, spec, default_value=None):
+        self.spec = spec
         self.field_name = None  # no field name until we validate
-        self.default_value = default_value  # if a field is required information, but was NOT used in the viz, 
-                                            #    then use default values we populate from the user data, if possible
+
+        # if a field is required information, but was NOT used in the viz,
+        #    then use default values we populate from the user data, if possible
+        self.default_value = default_value
+        if default_value is None:
+            self.default_value = spec.default_value
         self.match_list = []
         self.error_list = []
 
+    @property
+    def name(self):
+        return self.spec.name
+
+    @property
+    def action_type(self):
+        return self.spec.action_type
+
+    @property
+    def is_required(self):
+        return self.spec.is_required
+
+    @property
+    def is_action_flag(self):
+        return self.spec.is_action_flag
+
     def get_user_facing_fieldname(self):
         field_name = '{} {}'
         if self.is_required:
@@ -209,6 +295,7 @@ class Task(object):
     def execute_task(self):
 
         self.task_started_at = datetime.datetime.now()
+        self.task_thread_id = threading.current_thread().name
 
         log.logger.debug('starting task execution for task {}'.format(self.task_uuid))
 
@@ -217,7 +304,7 @@ class Task(object):
 
                 log.logger.debug('Task is type email, sending now')
 
-                emailaction.send_email(self.task_instance)
+                self.task_output_size_b = emailaction.send_email(self.task_instance)
 
                 log.logger.debug('Task completed')
 
@@ -226,6 +313,7 @@ class Task(object):
                 log.logger.debug('Task is type SMS, sending now')
 
                 smsaction.send_sms(self.task_instance)
+                self.task_output_size_b = len(self.task_instance.msgbody.encode('utf-8'))
             else:
                 raise UserWarning('Task Type "{}" is invalid'.format(self.task_type))
 
@@ -272,48 +360,6 @@ class ContentReference:
 """
 
 
-class TaskWorker(threading.Thread):
-    """Class to enable multi-threaded processing of Tasks within an Alert"""
-
-    def __init__(self, thread_name, task_queue):
-        threading.Thread.__init__(self, name=thread_name)
-        self.queue = task_queue
-        self.thread_name = thread_name
-
-    def run(self):
-        # loop infinitely, breaking when the queue is out of work (should add a timeout!)
-        while 1 == 1:
-            if self.queue.qsize() == 0:
-                return
-            else:
-                # Get the work from the queue and expand the tuple
-                task = self.queue.get()
-
-                log.logger.debug('Thread {} is processing task_id {}, from subscription_id {}, view_id {}, '
-                                 'site_name {}, customized_view_id {}, '
-                                 'view_name {}'.format(
-                                    self.thread_name,
-                                    task.task_uuid,
-                                    task.alert.subscription_id,
-                                    task.alert.view_id,
-                                    task.alert.site_name,
-                                    task.alert.customized_view_id,
-                                    task.alert.view_name))
-
-                # process the alert
-                try:
-                    task.execute_task()
-                except Exception as e:
-                    errormessage = 'Unable to process task {} from alert {}, error: {}'.format(
-                                                                                        task.task_uuid,
-                                                                                        task.alert.view_name,
-                                                                                        e.args[0])
-                    log.logger.error(errormessage)
-                    task.alert.error_list.append(errormessage)
-                    task.alert.alert_failure()
-                    continue
-
-
 class VizAlert(object):
     """Standard class representing a VizAlert"""
 
@@ -334,8 +380,6 @@ class VizAlert(object):
         self.viz_png_height = 1500
         self.viz_png_width = 1500
         self.timeout_s = 60
-        self.task_thread_count = 1
-        self.task_thread_names = []
 
         # email action config
         self.action_enabled_email = 0
@@ -345,6 +389,7 @@ class VizAlert(object):
         # sms action config
         self.action_enabled_sms = 0
         self.allowed_recipient_numbers = ''
+        self.patterns = patterns.PatternRegistry()  # compiles the allowed_* patterns, usually shared by all alerts
         self.from_number = ''
         self.phone_country_code = ''
 
@@ -376,60 +421,29 @@ class VizAlert(object):
 
         # alert state information
         self.trigger_data_file = ''
-        self.trigger_data = []
+        self.trigger_data = triggerdata.TriggerData()
         self.trigger_data_rowcount = 0
         self.unique_trigger_data = []
         self.action_field_dict = {}
-        self.task_queue = Queue()  # the tasks to execute for this alert
-        self.task_threads = []  # the names of all the threads spun up to process tasks generated by this alert
+        self.vizcompleterefs = dict()  # rendered content references, keyed by the reference string
+        self.task_queue = Queue()  # the tasks to execute for this alert. The pipeline delivers them as they're queued
+        self.abandoned = False  # set when a processing stage gives up waiting on this alert
         self.error_list = []  # list of errors encountered processing the vizalert
 
-        # add all possible alert fields to the new VizAlert instance (should this live somewhere else?)
-
-        # General
-        # consolidated and sort have backwards-compatible options for v1.x
-        self.action_field_dict[GENERAL_SORTORDER_FIELDKEY] = \
-            ActionField(GENERAL_SORTORDER_FIELDKEY, GENERAL_ACTION_TYPE, False, False,
-                        '.*Consolidated.Sort|.*Sort.Order')
-        self.action_field_dict[CONSOLIDATE_LINES_FIELDKEY] = \
-            ActionField(CONSOLIDATE_LINES_FIELDKEY, GENERAL_ACTION_TYPE, False, False,
-                        '.*Consolidate.Lines|.*Email.Consolidate')
-
-        # Email Action fields
-        self.action_field_dict[EMAIL_ACTION_FIELDKEY] = \
-            ActionField(EMAIL_ACTION_FIELDKEY, EMAIL_ACTION_TYPE, True, True, ' ?Email.Action')
-        self.action_field_dict[EMAIL_SUBJECT_FIELDKEY] = \
-            ActionField(EMAIL_SUBJECT_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.Subject',
-                        'Alert triggered for {}'.format(self.view_name))
-        self.action_field_dict[EMAIL_TO_FIELDKEY] = \
-            ActionField(EMAIL_TO_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.To', self.subscriber_email)
-        self.action_field_dict[EMAIL_FROM_FIELDKEY] = \
-            ActionField(EMAIL_FROM_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.From',
-                        config.configs['smtp.address.from'])
-        self.action_field_dict[EMAIL_CC_FIELDKEY] = \
-            ActionField(EMAIL_CC_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.CC')
-        self.action_field_dict[EMAIL_BCC_FIELDKEY] = \
-            ActionField(EMAIL_BCC_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.BCC')
-        self.action_field_dict[EMAIL_BODY_FIELDKEY] = \
-            ActionField(EMAIL_BODY_FIELDKEY, EMAIL_ACTION_TYPE, True, False, ' ?Email.Body', 'VIZ_IMAGE(|vizlink)')
-        self.action_field_dict[EMAIL_HEADER_FIELDKEY] = \
-            ActionField(EMAIL_HEADER_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Header')
-        self.action_field_dict[EMAIL_FOOTER_FIELDKEY] = \
-            ActionField(EMAIL_FOOTER_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Footer')
-        self.action_field_dict[EMAIL_ATTACHMENT_FIELDKEY] = \
-            ActionField(EMAIL_ATTACHMENT_FIELDKEY, EMAIL_ACTION_TYPE, False, False, ' ?Email.Attachment')
-
-        # SMS Action fields
-        self.action_field_dict[SMS_ACTION_FIELDKEY] = \
-            ActionField(SMS_ACTION_FIELDKEY, SMS_ACTION_TYPE, True, True, ' ?SMS.Action')
-        self.action_field_dict[SMS_TO_FIELDKEY] = \
-            ActionField(SMS_TO_FIELDKEY, SMS_ACTION_TYPE, True, False, ' ?SMS.To')
-        self.action_field_dict[SMS_MESSAGE_FIELDKEY] = \
-            ActionField(SMS_MESSAGE_FIELDKEY, SMS_ACTION_TYPE, True, False, ' ?SMS.Message')
-        self.action_field_dict[SMS_HEADER_FIELDKEY] = \
-            ActionField(SMS_HEADER_FIELDKEY, SMS_ACTION_TYPE, False, False, ' ?SMS.Header')
-        self.action_field_dict[SMS_FOOTER_FIELDKEY] = \
-            ActionField(SMS_FOOTER_FIELDKEY, SMS_ACTION_TYPE, False, False, ' ?SMS.Footer')
+        # execution information, kept in the execution history
+        self.tasks = []  # every task queued for this alert
+        self.processing_started_at = None
+        self.processing_finished_at = None
+        self.stage_timings = {}  # processing stage name: seconds spent in it
+        self.trigger_data_size_b = 0
+        self.export_retries = 0  # retries needed by all exports for this alert
+
+        # this alert's mapping of each possible action field, with defaults populated from the alert where needed
+        for key, spec in list(ACTION_FIELD_SPECS.items()):
+            self.action_field_dict[key] = ActionField(spec)
+        self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].default_value = 'Alert triggered for {}'.format(self.view_name)
+        self.action_field_dict[EMAIL_TO_FIELDKEY].default_value = self.subscriber_email
+        self.action_field_dict[EMAIL_FROM_FIELDKEY].default_value = config.configs['smtp.address.from']
 
     def get_action_flag_field(self, action_type):
         """Return the appropriate action field representing an action flag based on the type
@@ -489,13 +503,28 @@ class VizAlert(object):
 
         return footer
 
+    def export_view(self, *args):
+        """Export a view with the configured export.backend, counting any retries it needed against this alert"""
+        tabhttp.last_export.retries = 0  # so a backend that fails before setting it doesn't count the last export's
+        try:
+            if config.configs['export.backend'] == config.EXPORT_BACKEND_REST:
+                return tabrest.export_view(*args)
+            return tabhttp.export_view(*args)
+        finally:
+            self.export_retries += getattr(tabhttp.last_export, 'retries', 0)
+
+    def queue_task(self, task):
+        """Queue a Task for delivery, keeping track of it for the execution history"""
+        self.tasks.append(task)
+        self.task_queue.put(task)
+
     def download_trigger_data(self):
         """ Exports the CSV data for a VizAlert and reads it into a list of dicts
         Returns a filepath to the CSV """
 
         # export the CSV to a local file
         try:
-            self.trigger_data_file = tabhttp.export_view(
+            self.trigger_data_file = self.export_view(
                 self.view_url_suffix,
                 self.site_name,
                 self.timeout_s,
@@ -506,36 +535,32 @@ class VizAlert(object):
                 self.viz_png_height,
                 self.subscriber_sysname,
                 self.subscriber_domain)
+            self.trigger_data_size_b = os.path.getsize(self.trigger_data_file)
 
             # read all rows into the trigger_data class member for later use
-            reader = self.read_trigger_data()
-
-            rowcount = 0
+            self.read_trigger_data()
 
-            for row in reader:
-                if rowcount > self.viz_data_maxrows:
-                    errormessage = 'Maximum rows of {} exceeded.'.format(self.viz_data_maxrows)
-                    self.error_list.append(errormessage)
-                    log.logger.error(errormessage)
-                    break
+            if self.trigger_data.exceeded_max_rows:
+                errormessage = 'Maximum rows of {} exceeded.'.format(self.viz_data_maxrows)
+                self.error_list.append(errormessage)
+                log.logger.error(errormessage)
 
-                # read data in anyway
-                self.trigger_data.append(row)
-                rowcount += 1
             # set the rowcount value in the alert itself
-            self.trigger_data_rowcount = rowcount
+            self.trigger_data_rowcount = len(self.trigger_data)
         except Exception as e:
             log.logger.error(e)
             self.error_list.append(e.args[0])
             return
 
     def read_trigger_data(self):
-        """ Returns a CSV reader to read the trigger data file downloaded for the alert
-            Requests for the data itself should use the trigger_data list member to avoid multiple reads """
+        """ Reads the trigger data file downloaded for the alert into the trigger_data member, in a single pass.
+            Everything that needs the data itself should use trigger_data, rather than reading the file again """
         try:
-            f = open(self.trigger_data_file, 'r', encoding="utf-8")
-            return csv.DictReader(f)
-
+            self.trigger_data = triggerdata.read_csv(
+                self.trigger_data_file, self.viz_data_maxrows, config.configs['data.streaming_rows'])
+            if self.trigger_data.streamed:
+                log.logger.info('Trigger data has {} rows, more than the {} held in memory. Streaming it from {}'.format(
+                    len(self.trigger_data), config.configs['data.streaming_rows'], self.trigger_data_file))
         except Exception as e:
             log.logger.error('Error accessing {} while getting processing alert {}: {}'.format(
                 self.trigger_data_file,
@@ -554,11 +579,10 @@ class VizAlert(object):
 
         try:
             # go through all possible fields and find matches
-            for key in self.action_field_dict:
-                for field in self.read_trigger_data().fieldnames:
-                    if re.match(self.action_field_dict[key].pattern, field, re.IGNORECASE):
-                        log.logger.debug('found field match! : {}'.format(field))
-                        self.action_field_dict[key].match_list.append(field)  # add the match we found
+            for key, matches in list(get_field_matches(self.trigger_data.fieldnames).items()):
+                for field in matches:
+                    log.logger.debug('found field match! : {}'.format(field))
+                    self.action_field_dict[key].match_list.append(field)  # add the match we found
 
             log.logger.debug('searching for action fields')
 
@@ -697,12 +721,17 @@ class VizAlert(object):
 
         trigger_data_errors = []
 
+        # compile the admin's allow-list patterns
+        allowed_from_pattern = self.patterns.get(self.allowed_from_address, re.IGNORECASE)
+        allowed_recipient_pattern = self.patterns.get(self.allowed_recipient_addresses, re.IGNORECASE)
+        allowed_number_pattern = self.patterns.get(self.allowed_recipient_numbers)
+
         # validate the simple alert scenario
         if self.alert_type == SIMPLE_ALERT:
             log.logger.debug('Validating as a simple alert')
 
             # check for invalid email domains--just in case the user fudges their email in Tableau Server
-            subscriberemailerror = emailaction.address_is_invalid(self.subscriber_email, self.allowed_recipient_addresses)
+            subscriberemailerror = emailaction.address_is_invalid(self.subscriber_email, allowed_recipient_pattern)
             if subscriberemailerror:
                 errormessage = 'VizAlerts was unable to process this alert, because it was ' \
                                'unable to send email to address {}: {}'.format(
@@ -722,8 +751,8 @@ class VizAlert(object):
                 log.logger.debug('Validating email addresses')
                 addresserrors = emailaction.validate_addresses(
                                                             self.trigger_data,
-                                                            self.allowed_from_address,
-                                                            self.allowed_recipient_addresses,
+                                                            allowed_from_pattern,
+                                                            allowed_recipient_pattern,
                                                             self.action_field_dict[EMAIL_ACTION_FIELDKEY],
                                                             self.action_field_dict[EMAIL_TO_FIELDKEY],
                                                             self.action_field_dict[EMAIL_FROM_FIELDKEY],
@@ -742,7 +771,7 @@ class VizAlert(object):
                 numbererrors = smsaction.validate_smsnumbers(
                                                             self.trigger_data,
                                                             self.action_field_dict[SMS_TO_FIELDKEY].field_name,
-                                                            self.allowed_recipient_numbers,
+                                                            allowed_number_pattern,
                                                             self.phone_country_code)
                 if numbererrors:
                     errormessage = 'Invalid SMS numbers found: {}'.format(numbererrors)
@@ -766,12 +795,11 @@ class VizAlert(object):
         # return the errors we found validating the trigger data
         return trigger_data_errors
 
-    def execute_alert(self):
-        """Simple function to effectively run the entire VizAlert process:
+    def fetch_trigger_data(self):
+        """First stage of processing a VizAlert:
+            Check that the subscriber is allowed to run the alert
             Get the CSV data from the alert trigger
-            Parse and validate the fields
-            Identify and download all content references
-            Perform all actions as instructed by the alert  """
+            Returns True if there is trigger data to parse, False if there is nothing more to do"""
 
         # do a bit of pre-validation first
         # check for unlicensed user
@@ -784,14 +812,14 @@ class VizAlert(object):
                 log.logger.error(errormessage)
                 self.error_list.append(errormessage)
                 self.alert_failure()
-                return
+                return False
             else:
                 # they're not the owner, so this is a simple alert. just ignore them and log that we did.
                 errormessage = 'Ignoring subscription_id {}: User {} is unlicensed.'.format(
                     self.subscription_id, self.subscriber_sysname)
                 log.logger.error(errormessage)
                 self.error_list.append(errormessage)
-                return
+                return False
 
         # if this is a test alert, and they're not the owner, tell them what's up
         if self.is_test and self.subscriber_sysname != self.owner_sysname:
@@ -799,7 +827,7 @@ class VizAlert(object):
             log.logger.error(errormessage)
             self.error_list.append(errormessage)
             self.alert_failure()
-            return
+            return False
 
         # get the CSV data from the alert trigger
         log.logger.debug('Starting to download trigger data')
@@ -809,94 +837,85 @@ class VizAlert(object):
         # were there any problems? if so, bail
         if len(self.error_list) > 0:
             self.alert_failure()
-            return
+            return False
 
-        if self.trigger_data_rowcount == 0:
+        if self.trigger_data_rowcount == 0 or not self.trigger_data:
             log.logger.info('Nothing to do! No rows in trigger data from file {}'.format(self.trigger_data_file))
-        else:
-            log.logger.debug('Got trigger data, now parsing fields')
-
-            # parse and validate the fields
-            if self.trigger_data and len(self.error_list) == 0:
-                field_errors = self.parse_action_fields()
-
-                # were there any problems? if so, bail
-                if len(field_errors) > 0 or len(self.error_list) > 0:
-                    self.alert_failure()
-                    return
-
-                log.logger.debug('Validating trigger data')
-
-                trigger_data_errors = []
-                trigger_data_errors = self.validate_trigger_data()
-
-                if len(trigger_data_errors) > 0 or len(self.error_list) > 0:
-                    self.alert_failure()
-                    return
+            return False
 
-                log.logger.debug('Performing alert actions')
+        return True
 
-                # identify and download all content references
-                # perform all actions as instructed by the alert
-                #  These two are in the same call right now, but should probably be separated
-                self.perform_actions()
+    def parse_trigger_data(self):
+        """Second stage of processing a VizAlert:
+            Parse and validate the fields and data in the trigger CSV
+            Returns True if the alert actions can be performed"""
 
-                log.logger.debug('Processing {} alert tasks for alert {}'.format(
-                    self.task_queue.qsize(),
-                    self.alert_uuid))
+        log.logger.debug('Got trigger data, now parsing fields')
 
-                try:
-                    # spin up threads to process tasks
-                    for index in range(self.task_thread_count):
+        field_errors = self.parse_action_fields()
 
-                        log.logger.debug('Spinning up task threads')
+        # were there any problems? if so, bail
+        if len(field_errors) > 0 or len(self.error_list) > 0:
+            self.alert_failure()
+            return False
 
-                        # get a unique thread name for the alert
-                        thread_name = '{}{}{}'.format(
-                            self.alert_uuid,
-                            '_',
-                            str(index))
+        log.logger.debug('Validating trigger data')
 
-                        log.logger.debug('New thread name will be {}'.format(thread_name))
+        trigger_data_errors = self.validate_trigger_data()
 
-                        task_worker = TaskWorker(thread_name, self.task_queue)
+        if len(trigger_data_errors) > 0 or len(self.error_list) > 0:
+            self.alert_failure()
+            return False
 
-                        log.logger.debug('Starting task thread with name: {}'.format(thread_name))
+        return True
 
-                        self.task_thread_names.append(thread_name)
-                        task_worker.start()
+    def render_content_refs(self):
+        """Third stage of processing a VizAlert:
+            Identify and export all content references to temp files, storing them in vizcompleterefs"""
 
-                    # loop until work is done
-                    while 1 == 1:
-                            # test for completed task threads
-                            completed_task_threads = set(self.task_thread_names) - \
-                                                     set([thread.name for thread in threading.enumerate()])
+        # run the simple alert
+        if self.alert_type == SIMPLE_ALERT:
+            try:
+                log.logger.debug('Rendering simple alert image')
 
-                            log.logger.debug('All threads: {}'.format(threading.enumerate()))
+                # export the viz to a PNG file
+                imagepath = self.export_view(
+                    self.view_url_suffix,
+                    self.site_name,
+                    self.timeout_s,
+                    self.data_retrieval_tries,
+                    self.force_refresh,
+                    tabhttp.Format.PNG,
+                    self.viz_png_width,
+                    self.viz_png_height,
+                    self.subscriber_sysname,
+                    self.subscriber_domain)
 
-                            # if the set of completed threads matches all the task threads we spun up,
-                            #   that means we're done
-                            if completed_task_threads == set(self.task_thread_names):
-                                log.logger.debug('Task threads have completed for alert {}. Returning.'.format(
-                                    self.alert_uuid))
-                                return
-                            task_sleep_time = 3  # REVISIT THIS
-                            time.sleep(task_sleep_time)
-                            log.logger.debug('Task threads still in progress for alert {}. Sleeping {} seconds'.format(
-                                self.alert_uuid, task_sleep_time))
-                except Exception as e:
-                    log.logger.error('Encountered error processing alert tasks for alert {}: {} '.format(
-                        self.alert_uuid,
-                        e.args[0]))
-                # REVISIT
-                # check for any outstanding errors
+                self.vizcompleterefs[IMAGE_PLACEHOLDER] = {
+                    'vizref': IMAGE_PLACEHOLDER,
+                    'formatstring': 'PNG',
+                    'view_url_suffix': self.view_url_suffix,
+                    'imagepath': imagepath}
+            except Exception as e:
+                errormessage = 'Alert was triggered, but encountered a failure rendering data/image:<br> {}'.format(
+                    e.args[0])
+                log.logger.error(errormessage)
+                raise UserWarning(errormessage)
 
-            else:
-                self.alert_failure()
-                return
+        # run the advanced alert
+        elif self.alert_type == ADVANCED_ALERT:
+            try:
+                self.vizcompleterefs = self.find_viz_refs(self.trigger_data)
+            except Exception as e:
+                errormessage = 'Alert was triggered, but encountered a failure getting data/image references' \
+                               ':<br /> {}'.format(e.args[0])
+                log.logger.error(errormessage)
+                raise UserWarning(errormessage)
 
     def perform_actions(self):
-        """Execute all the instructions as directed by the trigger data"""
+        """Fourth stage of processing a VizAlert:
+            Build the emails and SMS messages directed by the trigger data, using the rendered content references,
+            and queue them as Tasks in task_queue for delivery"""
 
         log.logger.debug('Performing alert actions now')
 
@@ -915,71 +934,45 @@ class VizAlert(object):
             # VIZ_*([optional custom view w/optional custom URL parameters]|[optional VizAlerts parameters])
             # stored as a dict of dicts, the key is the content reference
 
-            vizcompleterefs = dict()
+            vizcompleterefs = self.vizcompleterefs
 
             # run the simple alert
             if self.alert_type == SIMPLE_ALERT:
-                try:
-                    log.logger.debug('Processing as a simple alert')
-
-                    # export the viz to a PNG file
-                    imagepath = tabhttp.export_view(
-                        self.view_url_suffix,
-                        self.site_name,
-                        self.timeout_s,
-                        self.data_retrieval_tries,
-                        self.force_refresh,
-                        tabhttp.Format.PNG,
-                        self.viz_png_width,
-                        self.viz_png_height,
-                        self.subscriber_sysname,
-                        self.subscriber_domain)
-
-                    # attachments are stored lists of dicts to handle Advanced Alerts
-                    inlineattachments = [{'imagepath': imagepath}]
-                    appendattachments = [{'imagepath': self.trigger_data_file}]
-
-                    # embed the viz image
-                    # inlineattachments = [csvpath, imagepath]
-                    log.logger.info('Sending simple alert email to user {}'.format(self.subscriber_email))
-                    body = '<a href="{}"><img src="cid:{}"></a>'.format(self.get_view_url(), basename(imagepath)) + \
-                           bodyfooter.format(self.subscriber_email, self.subscriber_sysname,
-                                             self.get_view_url(), self.view_name)
-                    subject = str('Alert triggered for {}'.format(self.view_name))
+                log.logger.debug('Processing as a simple alert')
 
-                    try:
-                        email_instance = emailaction.Email(
-                            config.configs['smtp.address.from'], self.subscriber_email, subject, body,
-                            None, None, inlineattachments, appendattachments)
+                imagepath = vizcompleterefs[IMAGE_PLACEHOLDER]['imagepath']
 
-                        # enqueue the task for later execution
-                        self.task_queue.put(Task(self, TaskType.SEND_EMAIL, email_instance))
-                    except Exception as e:
-                        errormessage = 'Could not send email, error: {}'.format(e.args[0])
-                        log.logger.error(errormessage)
-                        self.error_list.append(errormessage)
-                        self.alert_failure()
-                        return
-                    return
+                # attachments are stored lists of dicts to handle Advanced Alerts
+                inlineattachments = [{'imagepath': imagepath}]
+                appendattachments = [{'imagepath': self.trigger_data_file}]
+
+                # embed the viz image
+                # inlineattachments = [csvpath, imagepath]
+                log.logger.info('Sending simple alert email to user {}'.format(self.subscriber_email))
+                body = '<a href="{}"><img src="cid:{}"></a>'.format(self.get_view_url(), basename(imagepath)) + \
+                       bodyfooter.format(self.subscriber_email, self.subscriber_sysname,
+                                         self.get_view_url(), self.view_name)
+                subject = str('Alert triggered for {}'.format(self.view_name))
+
+                try:
+                    email_instance = emailaction.Email(
+                        config.configs['smtp.address.from'], self.subscriber_email, subject, body,
+                        None, None, inlineattachments, appendattachments)
+
+                    # enqueue the task for later execution
+                    self.queue_task(Task(self, TaskType.SEND_EMAIL, email_instance))
                 except Exception as e:
-                    errormessage = 'Alert was triggered, but encountered a failure rendering data/image:<br> {}'.format(
-                        e.args[0])
+                    errormessage = 'Could not send email, error: {}'.format(e.args[0])
                     log.logger.error(errormessage)
                     self.error_list.append(errormessage)
-                    raise UserWarning(errormessage)
+                    self.alert_failure()
+                    return
+                return
 
             # run the advanced alert
             elif self.alert_type == ADVANCED_ALERT:
                 log.logger.debug('Processing as an advanced alert')
 
-                try:
-                    vizcompleterefs = self.find_viz_refs(self.trigger_data)
-                except Exception as e:
-                    errormessage = 'Alert was triggered, but encountered a failure getting data/image references' \
-                                   ':<br /> {}'.format(e.args[0])
-                    log.logger.error(errormessage)
-                    raise UserWarning(errormessage)
-
                 # determine whether we're consolidating lines
                 consolidate_lines_fieldname = self.action_field_dict[CONSOLIDATE_LINES_FIELDKEY].field_name
 
@@ -989,380 +982,27 @@ class VizAlert(object):
 
                     # eliminate duplicate rows and ensure proper sorting
                     data = self.get_unique_vizdata(EMAIL_ACTION_TYPE)
-                    rowcount_unique = len(data)
-
-                    # get the field names we'll need
-                    email_action_fieldname = self.action_field_dict[EMAIL_ACTION_FIELDKEY].field_name
-                    email_to_fieldname = self.action_field_dict[EMAIL_TO_FIELDKEY].field_name
-                    email_from_fieldname = self.action_field_dict[EMAIL_FROM_FIELDKEY].field_name
-                    email_cc_fieldname = self.action_field_dict[EMAIL_CC_FIELDKEY].field_name
-                    email_bcc_fieldname = self.action_field_dict[EMAIL_BCC_FIELDKEY].field_name
-                    email_subject_fieldname = self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].field_name
-                    email_body_fieldname = self.action_field_dict[EMAIL_BODY_FIELDKEY].field_name
-                    email_header_fieldname = self.action_field_dict[EMAIL_HEADER_FIELDKEY].field_name
-
-                    # iterate through the rows and send emails accordingly
-                    consolidate_email_ctr = 0
-                    body = []  # the entire body of the email
-                    email_body_line = '' # the current line of the email body
-                    subject = ''
-                    email_to = ''
-                    email_from = ''
-                    inlineattachments = []
-                    appendattachments = []
-                    email_instance = None
-
-                    # Process each row of data
-                    for i, row in enumerate(data):
-
-                        # author wants to send an email
-                        #  use string value for maximum safety. all other values are ignored, currently
-                        if row[email_action_fieldname] == '1':
-                            # make sure we set the "from" address if the viz did not provide it
-                            email_from = self.action_field_dict[EMAIL_FROM_FIELDKEY].get_value_from_dict(row)
-                            log.logger.debug('email_from is {}'.format(email_from))
-
-                            # make sure we set the "to" address if the viz did not provide it
-                            email_to = self.action_field_dict[EMAIL_TO_FIELDKEY].get_value_from_dict(row)
-                            log.logger.debug('email_to is {}'.format(email_to))
-
-                            # make sure we set the subject field if the viz did not provide it
-                            subject = self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].get_value_from_dict(row)
-                            log.logger.debug('subject is {}'.format(subject))
-
-                            # make sure we set the body line if the viz did not provide it
-                            email_body_line = self.action_field_dict[EMAIL_BODY_FIELDKEY].get_value_from_dict(row)
-                            log.logger.debug('email_body_line is {}'.format(email_body_line))
-
-                            # get the other recipient addresses
-                            if email_cc_fieldname:
-                                email_cc = row[email_cc_fieldname]
-                            else:
-                                email_cc = None
-
-                            if email_bcc_fieldname:
-                                email_bcc = row[email_bcc_fieldname]
-                            else:
-                                email_bcc = None
-
-                            # Append header row, if provided -- but only if this is the first consolidation iteration
-                            #  (for non-consoidated setting, each row will always be the first iteration)
-                            if email_header_fieldname and consolidate_email_ctr == 0:
-                                log.logger.debug('Appending body header')
-                                body.append(row[email_header_fieldname])
-
-                            # If rows are being consolidated, consolidate all with same recipients & subject
-                            if consolidate_lines_fieldname:
-                                # could put a test in here for mixing consolidated and non-consolidated emails in
-                                #   the same trigger view, would also need to check the sort in get_unique_vizdata
-
-                                log.logger.debug(
-                                    'Consolidate value is true, row index is {}, rowcount is {}'.format(i, rowcount_unique))
-
-                                # test for end of iteration--if done, take what we have so far and send it
-                                if i + 1 == rowcount_unique:
-                                    log.logger.debug('Last email in set reached, sending consolidated email')
-                                    log.logger.info('Sending email to {}, CC {}, BCC {}, subject {}'.format(
-                                        email_to, email_cc, email_bcc, subject))
-
-                                    try:  # remove this later??
-                                        body, inlineattachments = self.append_body_and_inlineattachments(
-                                            body, inlineattachments, row, vizcompleterefs)
-                                        appendattachments = self.append_attachments(appendattachments, row, vizcompleterefs)
-
-                                        # send the email
-                                        email_instance = emailaction.Email(
-                                            email_from, email_to, subject, ''.join(body), email_cc,
-                                            email_bcc, inlineattachments, appendattachments)
-                                        log.logger.debug('This is the email to:{}'.format(email_instance.toaddrs))
-                                        log.logger.debug('This is the email from:{}'.format(email_instance.fromaddr))
-
-                                        # Enqueue the task for later execution
-                                        self.task_queue.put(Task(self, TaskType.SEND_EMAIL, email_instance))
-                                    except Exception as e:
-                                        errormessage = 'Failed to send the email. Exception:<br> {}'.format(e)
-                                        log.logger.error(errormessage)
-                                        self.error_list.append(errormessage)
-                                        raise UserWarning(errormessage)
-
-                                    # reset variables for next email
-                                    body = []
-                                    inlineattachments = []
-                                    consolidate_email_ctr = 0
-                                    appendattachments = []
-                                    email_instance = None
-                                else:
-                                    # This isn't the end, and we're consolidating rows, so test to see if the next row needs
-                                    # to be a new email
-
-                                    this_row_recipients = []
-                                    next_row_recipients = []
-
-                                    this_row_recipients.append(subject)
-                                    this_row_recipients.append(email_to)
-                                    this_row_recipients.append(email_from)
-
-                                    # check if we're sending an email at all in the next row
-                                    next_row_email_action = data[i + 1][email_action_fieldname]
-
-                                    if email_subject_fieldname:
-                                        next_row_recipients.append(data[i + 1][email_subject_fieldname])
-                                    else:
-                                        next_row_recipients.append(subject)
 
-                                    if email_to_fieldname:
-                                        next_row_recipients.append(data[i + 1][email_to_fieldname])
-                                    else:
-                                        next_row_recipients.append(email_to)
+                    # If rows are being consolidated, consolidate all with same recipients & subject
+                    #   (the sort in get_unique_vizdata puts them next to each other)
+                    group_key = self.get_email_group_key if consolidate_lines_fieldname else None
 
-                                    if email_from_fieldname:
-                                        next_row_recipients.append(data[i + 1][email_from_fieldname])
-                                    else:
-                                        next_row_recipients.append(email_from)
-
-                                    if email_cc_fieldname:
-                                        this_row_recipients.append(email_cc)
-                                        next_row_recipients.append(data[i + 1][email_cc_fieldname])
-
-                                    if email_bcc_fieldname:
-                                        this_row_recipients.append(email_bcc)
-                                        next_row_recipients.append(data[i + 1][email_bcc_fieldname])
-
-                                    # Now compare the data from the rows
-                                    if this_row_recipients == next_row_recipients and next_row_email_action:
-                                        log.logger.debug('Next row matches recips and subject, appending body & attachments')
-                                        body.append(email_body_line)
-                                        if self.action_field_dict[EMAIL_ATTACHMENT_FIELDKEY].field_name and \
-                                                len(row[self.action_field_dict[EMAIL_ATTACHMENT_FIELDKEY].field_name]) > 0:
-                                            appendattachments = self.append_attachments(appendattachments, row, vizcompleterefs)
-                                        consolidate_email_ctr += 1
-                                    else:
-                                        log.logger.debug('Next row does not match recips and subject, sending consolidated email')
-                                        log.logger.info('Sending email to {}, CC {}, BCC {}, Subject {}'.format(
-                                            email_to,
-                                            email_cc,
-                                            email_bcc,
-                                            subject))
-
-                                        body, inlineattachments = self.append_body_and_inlineattachments(body, inlineattachments,
-                                                                                                    row, vizcompleterefs)
-                                        appendattachments = self.append_attachments(appendattachments, row, vizcompleterefs)
-
-                                        # send the email
-                                        try:
-                                            email_instance = emailaction.Email(
-                                                email_from, email_to, subject, ''.join(body), email_cc, email_bcc,
-                                                inlineattachments, appendattachments)
-
-                                            # Enqueue the task for later execution
-                                            self.task_queue.put(Task(self, TaskType.SEND_EMAIL, email_instance))
-                                        except Exception as e:
-                                            errormessage = 'Failed to send the email. Exception:<br> {}'.format(e)
-                                            log.logger.error(errormessage)
-                                            self.error_list.append(errormessage)
-                                            raise UserWarning(errormessage)
-
-                                        body = []
-                                        consolidate_email_ctr = 0
-                                        inlineattachments = []
-                                        appendattachments = []
-                                        email_instance = None
-                            else:
-                                # emails are not being consolidated, so send the email
-                                log.logger.info('Sending email to {}, CC {}, BCC {}, Subject {}'.format(
-                                    email_to,
-                                    email_cc,
-                                    email_bcc,
-                                    subject))
-
-                                body, inlineattachments = self.append_body_and_inlineattachments(body, inlineattachments, row,
-                                                                                            vizcompleterefs)
-                                appendattachments = self.append_attachments(appendattachments, row, vizcompleterefs)
-
-                                try:
-                                    email_instance = emailaction.Email(
-                                        email_from,
-                                        email_to,
-                                        subject,
-                                        ''.join(body),
-                                        email_cc,
-                                        email_bcc,
-                                        inlineattachments,
-                                        appendattachments)
-
-                                    # Enqueue the task for later execution
-                                    self.task_queue.put(Task(self, TaskType.SEND_EMAIL, email_instance))
-                                except Exception as e:
-                                    errormessage = 'Failed to send the email. Exception:<br> {}'.format(e)
-                                    log.logger.error(errormessage)
-                                    self.error_list.append(errormessage)
-                                    raise UserWarning(errormessage)
-
-                                body = []
-                                consolidate_email_ctr = 0
-                                inlineattachments = []
-                                appendattachments = []
-                                email_instance = None
-                        # we're not performing any actions this round.
-                        #   Make sure we reset our variables again
-                        else:
-                            # reset variables for next email
-                            body = []
-                            inlineattachments = []
-                            consolidate_email_ctr = 0
-                            appendattachments = []
-                            email_instance = None
+                    for rows in triggerdata.group_rows(data, group_key):
+                        self.queue_email(rows, vizcompleterefs)
 
                 # process sms messages
                 if self.action_field_dict[SMS_ACTION_FIELDKEY].field_name:
 
                     # eliminate duplicate rows and ensure proper sorting
                     data = self.get_unique_vizdata(SMS_ACTION_TYPE)
-                    rowcount_unique = len(data)
-
-                    # get the field names we'll need
-                    sms_action_fieldname = self.action_field_dict[SMS_ACTION_FIELDKEY].field_name
-                    sms_to_fieldname = self.action_field_dict[SMS_TO_FIELDKEY].field_name
-                    sms_message_fieldname = self.action_field_dict[SMS_MESSAGE_FIELDKEY].field_name
-                    sms_header_fieldname = self.action_field_dict[SMS_HEADER_FIELDKEY].field_name
-
-                    consolidate_sms_ctr = 0
-                    sms_message = []  # list to support future header, footer, and consolidate features
-
-                    # Process each row of data
-                    for i, row in enumerate(data):
-
-                        # author wants to send an SMS
-                        #  use string value for maximum safety. all other values are ignored, currently
-                        if row[sms_action_fieldname] == '1':
-                            sms_to = row[sms_to_fieldname]
-                            sms_from = self.from_number  # currently only supporting admin-set numbers
-
-                            # Append header row, if provided - only for the first consolidation iteration
-                            #   if lines aren't being consolidated, each row will always be the first iteration
-                            if sms_header_fieldname and consolidate_sms_ctr == 0:
-                                sms_message.append(row[sms_header_fieldname])
-
-                            # If rows are being consolidated, consolidate the message text where it's being sent
-                            #  to the same recipients
-                            if consolidate_lines_fieldname:
-                                # could put a test in here for mixing consolidated and non-consolidated emails in
-                                #   the same trigger view, would also need to check the sort in get_unique_vizdata
-
-                                log.logger.debug(
-                                    'Consolidate value is true, row index is {}, rowcount is {}'.format(i, rowcount_unique))
-
-                                # test for end of iteration--if done, take what we have so far and send it
-                                if i + 1 == rowcount_unique:
-
-                                    # finalize the message by adding any footers and replacing content references
-                                    sms_message = smsaction.sms_append_body(sms_message, vizcompleterefs, row, self)
-
-                                    log.logger.debug('Converting phone number list {} to E.164'.format(sms_to))
-
-                                    # make list of all SMS addresses - they already went through 1st validation
-                                    smsaddresses = smsaction.get_e164numbers(sms_to, self.phone_country_code)
-
-                                    log.logger.info('Sending SMS to {}, from {}, message: {}'.format(
-                                        smsaddresses,
-                                        sms_from,
-                                        ''.join(sms_message)))
-
-                                    # send the message(s) (multiple  for multiple phone numbers)
-                                    for smsaddress in smsaddresses:
-                                        try:
-                                            sms_instance = smsaction.SMS(sms_from, smsaddress, ''.join(sms_message))
-
-                                            # enqueue the sms to be sent
-                                            self.task_queue.put(Task(self, TaskType.SEND_SMS, sms_instance))
-                                        except Exception as e:
-                                            self.error_list.append(
-                                                'Could not send SMS, error: {}'.format(e.args[0]))
-                                            self.alert_failure()
-                                            return
-
-                                    # reset variables for next email
-                                    sms_message = []
-                                    consolidate_sms_ctr = 0
-                                else:
-                                    # This isn't the end, and we're consolidating rows, so test to see
-                                    # if the next row needs to be a new SMS
-
-                                    this_row_sms_recipients = []
-                                    next_row_sms_recipients = []
-
-                                    this_row_sms_recipients.append(row[sms_to_fieldname])
-
-                                    # check if we're sending an email at all in the next row
-                                    next_row_sms_action = data[i + 1][sms_action_fieldname]
-                                    next_row_sms_recipients.append(data[i + 1][sms_to_fieldname])
-
-                                    # Now compare the data from the rows
-                                    if this_row_sms_recipients == next_row_sms_recipients and next_row_sms_action:
-                                        log.logger.debug(
-                                            'Next row matches recips and subject, appending message')
-                                        sms_message.append(row[sms_message_fieldname])
-                                        consolidate_sms_ctr += 1
-                                    else:
-                                        log.logger.debug('Next row does not match sms_to values, sending consolidated sms')
-
-                                        # append the body and footer
-                                        sms_message = smsaction.sms_append_body(sms_message, vizcompleterefs, row, self)
-
-                                        # make list of all SMS addresses - they already went through 1st validation
-                                        smsaddresses = smsaction.get_e164numbers(sms_to, self.phone_country_code)
-
-                                        log.logger.info('Sending SMS to {}, from {}, message: {}'.format(
-                                            smsaddresses,
-                                            sms_from,
-                                            ''.join(sms_message)))
-
-                                        # send the message(s) (multiple for multiple phone numbers)
-                                        for smsaddress in smsaddresses:
-                                            try:
-                                                sms_instance = smsaction.SMS(sms_from, smsaddress, ''.join(sms_message))
-
-                                                # enqueue the sms to be sent
-                                                self.task_queue.put(Task(self, TaskType.SEND_SMS, sms_instance))
-                                            except Exception as e:
-                                                self.error_list.append(
-                                                    'Could not send SMS, error: {}'.format(e.args[0]))
-                                                self.alert_failure()
-                                                return
-
-                                        # reset the variables for the next message
-                                        sms_message = []
-                                        consolidate_sms_ctr = 0
-                            else:
-                                # we're not consolidating, so just send the SMS
-
-                                # append the body and footer
-                                sms_message = smsaction.sms_append_body(sms_message, vizcompleterefs, row, self)
-
-                                # make list of all SMS addresses - they already went through 1st validation
-                                smsaddresses = smsaction.get_e164numbers(sms_to, self.phone_country_code)
-
-                                log.logger.info('Sending SMS to {}, from {}, message: {}'.format(
-                                    smsaddresses,
-                                    sms_from,
-                                    ''.join(sms_message)))
-
-                                # send the message(s) (multiple for multiple phone numbers)
-                                for smsaddress in smsaddresses:
-                                    try:
-                                        sms_instance = smsaction.SMS(sms_from, smsaddress, ''.join(sms_message))
-
-                                        # enqueue the sms to be sent
-                                        self.task_queue.put(Task(self, TaskType.SEND_SMS, sms_instance))
-                                    except Exception as e:
-                                        self.error_list.append(
-                                            'Could not send SMS, error: {}'.format(e.args[0]))
-                                        self.alert_failure()
-                                        return
-
-                                # reset the variables for the next message
-                                sms_message = []
-                                consolidate_sms_ctr = 0
+
+                    # If rows are being consolidated, consolidate the message text where it's being sent
+                    #  to the same recipients
+                    group_key = self.get_sms_group_key if consolidate_lines_fieldname else None
+
+                    for rows in triggerdata.group_rows(data, group_key):
+                        if not self.queue_sms(rows, vizcompleterefs):
+                            return
 
             else:
                 errormessage = 'Could not determine alert type, due to a bug in VizAlerts. ' \
@@ -1371,6 +1011,128 @@ class VizAlert(object):
                 self.error_list.append(errormessage)
                 raise UserWarning(errormessage)
 
+    def get_email_group_key(self, row):
+        """The values that rows consolidated into a single email must share"""
+        key = [self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].get_value_from_dict(row),
+               self.action_field_dict[EMAIL_TO_FIELDKEY].get_value_from_dict(row),
+               self.action_field_dict[EMAIL_FROM_FIELDKEY].get_value_from_dict(row)]
+        for fieldkey in [EMAIL_CC_FIELDKEY, EMAIL_BCC_FIELDKEY]:
+            if self.action_field_dict[fieldkey].field_name:
+                key.append(row[self.action_field_dict[fieldkey].field_name])
+        return tuple(key)
+
+    def get_sms_group_key(self, row):
+        """The values that rows consolidated into a single SMS message must share"""
+        return row[self.action_field_dict[SMS_TO_FIELDKEY].field_name]
+
+    def queue_email(self, rows, vizcompleterefs):
+        """Build a single email from a group of rows, and queue it as a Task for delivery.
+            The header comes from the first row, a body line from each row, and the footer from the last"""
+        row = rows[-1]
+        email_header_fieldname = self.action_field_dict[EMAIL_HEADER_FIELDKEY].field_name
+        email_cc_fieldname = self.action_field_dict[EMAIL_CC_FIELDKEY].field_name
+        email_bcc_fieldname = self.action_field_dict[EMAIL_BCC_FIELDKEY].field_name
+
+        # make sure we set the "from", "to" and subject if the viz did not provide them
+        email_from = self.action_field_dict[EMAIL_FROM_FIELDKEY].get_value_from_dict(row)
+        email_to = self.action_field_dict[EMAIL_TO_FIELDKEY].get_value_from_dict(row)
+        subject = self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].get_value_from_dict(row)
+        log.logger.debug('email_from is {}, email_to is {}, subject is {}'.format(email_from, email_to, subject))
+
+        # get the other recipient addresses
+        email_cc = row[email_cc_fieldname] if email_cc_fieldname else None
+        email_bcc = row[email_bcc_fieldname] if email_bcc_fieldname else None
+
+        body = []  # the entire body of the email
+        inlineattachments = []
+        appendattachments = []
+
+        # Append header row, if provided
+        if email_header_fieldname:
+            log.logger.debug('Appending body header')
+            body.append(rows[0][email_header_fieldname])
+
+        if len(rows) > 1:
+            log.logger.debug('Consolidating {} rows into one email'.format(len(rows)))
+        for consolidated_row in rows[:-1]:
+            body.append(self.action_field_dict[EMAIL_BODY_FIELDKEY].get_value_from_dict(consolidated_row))
+            appendattachments = self.append_attachments(appendattachments, consolidated_row, vizcompleterefs)
+
+        log.logger.info('Sending email to {}, CC {}, BCC {}, Subject {}'.format(
+            email_to,
+            email_cc,
+            email_bcc,
+            subject))
+
+        body, inlineattachments = self.append_body_and_inlineattachments(body, inlineattachments, row,
+                                                                         vizcompleterefs)
+        appendattachments = self.append_attachments(appendattachments, row, vizcompleterefs)
+
+        try:
+            email_instance = emailaction.Email(
+                email_from,
+                email_to,
+                subject,
+                ''.join(body),
+                email_cc,
+                email_bcc,
+                inlineattachments,
+                appendattachments)
+
+            # Enqueue the task for later execution
+            self.queue_task(Task(self, TaskType.SEND_EMAIL, email_instance))
+        except Exception as e:
+            errormessage = 'Failed to send the email. Exception:<br> {}'.format(e)
+            log.logger.error(errormessage)
+            self.error_list.append(errormessage)
+            raise UserWarning(errormessage)
+
+    def queue_sms(self, rows, vizcompleterefs):
+        """Build an SMS message from a group of rows, and queue it as a Task for delivery to each of its numbers.
+            Returns False if the alert failed"""
+        row = rows[-1]
+        sms_header_fieldname = self.action_field_dict[SMS_HEADER_FIELDKEY].field_name
+        sms_message_fieldname = self.action_field_dict[SMS_MESSAGE_FIELDKEY].field_name
+        sms_to = row[self.action_field_dict[SMS_TO_FIELDKEY].field_name]
+        sms_from = self.from_number  # currently only supporting admin-set numbers
+
+        sms_message = []  # list to support future header, footer, and consolidate features
+
+        # Append header row, if provided
+        if sms_header_fieldname:
+            sms_message.append(rows[0][sms_header_fieldname])
+
+        if len(rows) > 1:
+            log.logger.debug('Consolidating {} rows into one SMS'.format(len(rows)))
+        for consolidated_row in rows[:-1]:
+            sms_message.append(consolidated_row[sms_message_fieldname])
+
+        # finalize the message by adding any footers and replacing content references
+        sms_message = smsaction.sms_append_body(sms_message, vizcompleterefs, row, self)
+
+        # make list of all SMS addresses - they already went through 1st validation
+        log.logger.debug('Converting phone number list {} to E.164'.format(sms_to))
+        smsaddresses = smsaction.get_e164numbers(sms_to, self.phone_country_code)
+
+        log.logger.info('Sending SMS to {}, from {}, message: {}'.format(
+            smsaddresses,
+            sms_from,
+            ''.join(sms_message)))
+
+        # send the message(s) (multiple for multiple phone numbers)
+        for smsaddress in smsaddresses:
+            try:
+                sms_instance = smsaction.SMS(sms_from, smsaddress, ''.join(sms_message))
+
+                # enqueue the sms to be sent
+                self.queue_task(Task(self, TaskType.SEND_SMS, sms_instance))
+            except Exception as e:
+                self.error_list.append(
+                    'Could not send SMS, error: {}'.format(e.args[0]))
+                self.alert_failure()
+                return False
+        return True
+
     def find_viz_refs(self, data):
         """ Given the data this searches through the body, header, footer, and attachment for all references to vizzes to be downloaded, downloads only the distinct vizzes (to avoid duplicating downloads).
 
@@ -1588,7 +1350,7 @@ class VizAlert(object):
 
                 view_url_suffix = vizdistinctrefs[vizref]['view_url_suffix']
                 # export/render the viz to a file, store path to the download as value with vizref as key
-                vizdistinctrefs[vizref]['imagepath'] = tabhttp.export_view(
+                vizdistinctrefs[vizref]['imagepath'] = self.export_view(
                     view_url_suffix,
                     self.site_name,  # content references must live on the same site as the alert itself
                     self.timeout_s,
@@ -1617,99 +1379,80 @@ class VizAlert(object):
         return vizcompleterefs
 
     def get_unique_vizdata(self, action_type):
-        """Returns a unique list of all relevant action records in data. Also sorts data in proper order."""
-
-        preplist = []  # list of dicts containing only keys of concern for de-duplication from data
-        uniquelist = []  # unique-ified list of dicts
+        """Returns a unique list of all relevant action records in data. Also sorts data in proper order.
+            The filtering, de-duplication and sorting work on the trigger data's columns, and the rows returned
+            are views onto them. Streamed trigger data is sorted on disk, and its rows returned by an iterator"""
 
         log.logger.debug('Start of get_unique_vizdata')
 
-        # copy in only relevant fields from each record, specific to the action_type passed in.
+        # only the relevant fields, specific to the action_type passed in, are considered.
         #   Non-VizAlerts fields will be ignored
-        for item in self.trigger_data:
-            newitem = dict()
-
-            for action_field in self.action_field_dict:
-                # Each action field we're looking for must:
-                #  Be of the correct type (email, sms, whatever else--or a generic type)
-                #  Have a field match in the actual trigger data
-                #  Have passed validation
-                if (self.action_field_dict[action_field].action_type == action_type or 
-                     self.action_field_dict[action_field].action_type == GENERAL_ACTION_TYPE) \
-                        and self.action_field_dict[action_field].has_match() \
-                        and not self.action_field_dict[action_field].has_errors():
-                    newitem[self.action_field_dict[action_field].field_name] = \
-                        item[self.action_field_dict[action_field].field_name]
-
-            # add the new trimmed row to our list, filtering out inactionable fields
-            if action_type == EMAIL_ACTION_TYPE:
-                email_action_fieldname = self.action_field_dict[EMAIL_ACTION_FIELDKEY].field_name
-                if item[email_action_fieldname] == '1':
-                    preplist.append(newitem)
-
-            if action_type == SMS_ACTION_TYPE:
-                sms_action_fieldname = self.action_field_dict[SMS_ACTION_FIELDKEY].field_name
-                if item[sms_action_fieldname] == '1':
-                    preplist.append(newitem)
-
-        log.logger.debug('Removing duplicates')
-
-        # remove duplicates, preserving original ordering
-        # proposed solution from http://stackoverflow.com/questions/9427163/remove-duplicate-dict-in-list-in-python
-
-        seen = set()
-        for dictitem in preplist:
-            t = tuple(sorted(dictitem.items()))
-            if t not in seen:
-                seen.add(t)
-                uniquelist.append(dictitem)
-
-        log.logger.debug('Sorting unique rows')
-
-        # the data must now be sorted for use in Advanced Alerts with email consolidation
+        fieldnames = []
+        for action_field in list(self.action_field_dict.values()):
+            # Each action field we're looking for must:
+            #  Be of the correct type (email, sms, whatever else--or a generic type)
+            #  Have a field match in the actual trigger data
+            #  Have passed validation
+            if (action_field.action_type == action_type or action_field.action_type == GENERAL_ACTION_TYPE) \
+                    and action_field.has_match() \
+                    and not action_field.has_errors() \
+                    and action_field.field_name not in fieldnames:
+                fieldnames.append(action_field.field_name)
+
+        # filter out inactionable rows
+        if action_type == EMAIL_ACTION_TYPE:
+            action_fieldname = self.action_field_dict[EMAIL_ACTION_FIELDKEY].field_name
+        else:
+            action_fieldname = self.action_field_dict[SMS_ACTION_FIELDKEY].field_name
 
-        # sort order is used first because the downloaded trigger csv can be re-ordered during
-        #  the download process from the original csv
-        if self.action_field_dict[GENERAL_SORTORDER_FIELDKEY].field_name:
-            uniquelist = sorted(
-                uniquelist, key=itemgetter(self.action_field_dict[GENERAL_SORTORDER_FIELDKEY].field_name))
-            log.logger.debug('Sorting by {}'.format(self.action_field_dict[GENERAL_SORTORDER_FIELDKEY].field_name))
+        # the data must now be sorted for use in Advanced Alerts with email consolidation.
+        #   Fields earlier in sort_fieldkeys are more significant
+        sort_fieldkeys = []
 
         # special case for Email Actions, where the Consolidate Lines flag is used
         if action_type == EMAIL_ACTION_TYPE:
             if self.action_field_dict[EMAIL_ACTION_FIELDKEY].field_name \
                     and self.action_field_dict[CONSOLIDATE_LINES_FIELDKEY].field_name:
-                if self.action_field_dict[EMAIL_BCC_FIELDKEY].field_name:
-                    log.logger.debug('Sorting by BCC field {}'.format(self.action_field_dict[EMAIL_BCC_FIELDKEY].field_name))
-                    uniquelist = sorted(uniquelist, key=itemgetter(self.action_field_dict[EMAIL_BCC_FIELDKEY].field_name))
-                if self.action_field_dict[EMAIL_CC_FIELDKEY].field_name:
-                    log.logger.debug('Sorting by CC field {}'.format(self.action_field_dict[EMAIL_CC_FIELDKEY].field_name))
-                    uniquelist = sorted(uniquelist, key=itemgetter(self.action_field_dict[EMAIL_CC_FIELDKEY].field_name))
-                if self.action_field_dict[EMAIL_FROM_FIELDKEY].field_name:
-                    log.logger.debug('Sorting by From field {}'.format(self.action_field_dict[EMAIL_FROM_FIELDKEY].field_name))
-                    uniquelist = sorted(uniquelist, key=itemgetter(self.action_field_dict[EMAIL_FROM_FIELDKEY].field_name))
-                if self.action_field_dict[EMAIL_TO_FIELDKEY].field_name:
-                    log.logger.debug('Sorting by To field {}'.format(self.action_field_dict[EMAIL_TO_FIELDKEY].field_name))
-                    uniquelist = sorted(uniquelist, key=itemgetter(self.action_field_dict[EMAIL_TO_FIELDKEY].field_name))
-                if self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].field_name:
-                    log.logger.debug('Sorting by Subject field {}'.format(self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].field_name))
-                    uniquelist = sorted(uniquelist, key=itemgetter(
-                        self.action_field_dict[EMAIL_SUBJECT_FIELDKEY].field_name))
+                sort_fieldkeys.extend([EMAIL_SUBJECT_FIELDKEY, EMAIL_TO_FIELDKEY, EMAIL_FROM_FIELDKEY,
+                                       EMAIL_CC_FIELDKEY, EMAIL_BCC_FIELDKEY])
 
         # special case for SMS Actions, where the Consolidate Lines flag is used
         if action_type == SMS_ACTION_TYPE:
             if self.action_field_dict[SMS_ACTION_FIELDKEY].field_name \
                     and self.action_field_dict[CONSOLIDATE_LINES_FIELDKEY].field_name:
-                log.logger.debug('Sorting by To')
-                if self.action_field_dict[SMS_TO_FIELDKEY].field_name:
-                    uniquelist = sorted(uniquelist, key=itemgetter(self.action_field_dict[SMS_TO_FIELDKEY].field_name))
+                sort_fieldkeys.append(SMS_TO_FIELDKEY)
 
             # Alert authors currently can't specify the SMS From Number
-        
+
+        # sort order comes last, ordering rows within each consolidated group. It's needed because the downloaded
+        #  trigger csv can be re-ordered during the download process from the original csv
+        sort_fieldkeys.append(GENERAL_SORTORDER_FIELDKEY)
+
+        sort_fieldnames = [self.action_field_dict[key].field_name for key in sort_fieldkeys
+                           if self.action_field_dict[key].field_name]
+
+        if self.trigger_data.streamed:
+            # too many rows to hold in memory, so de-duplicate and sort them on disk, returning them one at a time
+            log.logger.debug('Removing duplicates and sorting by {} on disk'.format(sort_fieldnames))
+            return triggerdata.stream_unique_rows(
+                self.trigger_data, action_fieldname, fieldnames, sort_fieldnames,
+                config.configs['data.sort_buffer_rows'], config.configs['temp.dir'])
+
+        indices = self.trigger_data.indices_where(action_fieldname, '1')
+
+        log.logger.debug('Removing duplicates')
+
+        # remove duplicates, preserving original ordering
+        indices = self.trigger_data.distinct_indices(indices, fieldnames)
+
+        if sort_fieldnames:
+            log.logger.debug('Sorting by {}'.format(sort_fieldnames))
+            indices = self.trigger_data.sorted_indices(indices, sort_fieldnames)
+
         log.logger.debug('Done sorting, returning the list')
 
         # return the list
-        return uniquelist
+        return self.trigger_data.rows_at(indices)
 
     def append_attachments(self, appendattachments, row, vizcompleterefs):
         """generic function for adding appended (non-inline) attachments"""
@@ -13,63 +13,36 @@ import os
 import traceback
 import datetime
 import time
-import fileinput
-import codecs
 import re
-from queue import Queue
 import threading
-from operator import attrgetter
 import argparse
+import signal
+import multiprocessing
 
 # local modules
 import vizalert
 from vizalert import tabhttp
+from vizalert import tabrest
 from vizalert import config
 from vizalert import log
 from vizalert import emailaction
 from vizalert import smsaction
 from vizalert import vizalert
-
-# name of the file used for maintaining subscriptions state in schedule.state.dir
+from vizalert import patterns
+from vizalert import pipeline
+from vizalert import cluster
+from vizalert import history
+from vizalert import state
+from vizalert import stats
+from vizalert import throttle
+
+# names of the files used for maintaining subscriptions state in schedule.state.dir
 SCHEDULE_STATE_FILENAME = 'vizalerts.state'
+SCHEDULE_STATE_DB_FILENAME = 'vizalerts_state.db'
 
-
-class VizAlertWorker(threading.Thread):
-    def __init__(self, threadname, alert_queue):
-        threading.Thread.__init__(self, name=threadname)
-        self.queue = alert_queue
-        self.threadname = threadname
-
-    def run(self):
-        # loop infinitely, breaking when the queue is out of work (should add a timeout!)
-        while 1 == 1:
-            if self.queue.qsize() == 0:
-                return
-            else:
-                # Get the work from the queue and expand the tuple
-                alert = self.queue.get()
-
-                log.logger.debug('Thread {} is processing subscription_id {}, view_id {}, '
-                                 'site_name {}, customized_view_id {}, '
-                                 'view_name {}'.format(
-                                    self.threadname,
-                                    alert.subscription_id,
-                                    alert.view_id,
-                                    alert.site_name,
-                                    alert.customized_view_id,
-                                    alert.view_name))
-
-                # process the alert
-                try:
-                    alert.execute_alert()
-                except Exception as e:
-                    errormessage = 'Unable to process alert {} as {}, error: {}'.format(alert.view_name,
-                                                                                         tabhttp.Format.CSV,
-                                                                                         e.args[0])
-                    log.logger.error(errormessage)
-                    alert.error_list.append(errormessage)
-                    alert.alert_failure()
-                    continue
+# names of the files for one node of several, which each keep state for only their own subscriptions
+SCHEDULE_STATE_NODE_FILENAME = 'vizalerts_node{}.state'
+SCHEDULE_STATE_DB_NODE_FILENAME = 'vizalerts_node{}_state.db'
 
 
 def main():
@@ -78,6 +51,8 @@ def main():
         # parse command-line arguments
         parser = argparse.ArgumentParser(description='Execute the VizAlerts process.')
         parser.add_argument('-c', '--configpath', help='Path to .yml configuration file')
+        parser.add_argument('-d', '--daemon', action='store_true',
+                            help='Keep running, checking alerts every daemon.interval_seconds until stopped')
         args = parser.parse_args()
 
         # validate and load configs from yaml file
@@ -97,37 +72,6 @@ def main():
     # we have our logger, so start writing
     log.logger.info('VizAlerts v{} is starting'.format(__version__))
 
-    # cleanup old temp files
-    try:
-        cleanup_dir(config.configs['temp.dir'], config.configs['temp.dir.file_retention_seconds'])
-    except OSError as e:
-        # Send mail to the admin informing them of the problem, but don't quit
-        errormessage = 'OSError: Unable to cleanup temp directory {}, error: {}'.format(config.configs['temp.dir'], e)
-        log.logger.error(errormessage)
-        email_instance = emailaction.Email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
-        emailaction.send_email(email_instance)
-    except Exception as e:
-        errormessage = 'Unable to cleanup temp directory {}, error: {}'.format(config.configs['temp.dir'], e)
-        log.logger.error(errormessage)
-        email_instance = emailaction.Email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
-        emailaction.send_email(email_instance)
-
-    # cleanup old log files
-    try:
-        cleanup_dir(config.configs['log.dir'], config.configs['log.dir.file_retention_seconds'])
-    except OSError as e:
-        # Send mail to the admin informing them of the problem, but don't quit
-        errormessage = 'OSError: Unable to cleanup log directory {}, error: {}'.format(config.configs['log.dir'], e)
-        log.logger.error(errormessage)
-        emailaction.send_email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
-    except Exception as e:
-        errormessage = 'Unable to cleanup log directory {}, error: {}'.format(config.configs['log.dir'], e)
-        log.logger.error(errormessage)
-        emailaction.send_email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
-
-    # test ability to connect to Tableau Server and obtain a trusted ticket
-    trusted_ticket_test()
-
     # if SMS Actions are enabled, attempt to obtain an sms client
     if config.configs['smsaction.enable']:
         try:
@@ -138,6 +82,105 @@ def main():
             log.logger.error(errormessage)
             quit_script(errormessage)
 
+    # limit how many exports run on Tableau Server at once, backing off if it's struggling,
+    #   and how many run at once for any one site or workbook
+    tabhttp.export_limiter = throttle.AdaptiveLimiter(
+        'export',
+        config.configs['export.concurrency.floor'],
+        config.configs['export.concurrency.ceiling'],
+        config.configs['export.latency_target_seconds'])
+    tabhttp.site_limiter = throttle.KeyedLimiter('export.site', config.configs['export.site_limit'])
+    tabhttp.workbook_limiter = throttle.KeyedLimiter('export.workbook', config.configs['export.workbook_limit'])
+
+    # share keep-alive connections to Tableau Server between exports
+    tabhttp.session_pool = tabhttp.SessionPool(
+        config.configs['http.pool_size'],
+        config.configs['http.keepalive'],
+        tabhttp.get_verify(config.configs['server.certcheck'], config.configs['server.certfile']))
+
+    # if enabled, keep sessions authenticated as AD users for their next export
+    if config.configs['http.ntlm.cache_size'] > 0:
+        tabhttp.ntlm_sessions = tabhttp.NtlmSessionCache(
+            config.configs['http.ntlm.cache_size'],
+            config.configs['http.ntlm.idle_timeout_seconds'],
+            config.configs['http.keepalive'],
+            tabhttp.session_pool.verify)
+
+    # if enabled, keep SMTP connections open for the next message
+    if config.configs['smtp.pool_size'] > 0:
+        emailaction.smtp_pool = emailaction.SmtpPool(
+            config.configs['smtp.pool_size'],
+            config.configs['smtp.idle_timeout_seconds'])
+
+    # test ability to connect to Tableau Server and obtain a trusted ticket, or sign in to the REST API
+    if config.configs['export.backend'] == config.EXPORT_BACKEND_REST:
+        rest_signin_test()
+    else:
+        trusted_ticket_test()
+
+    # if enabled, keep trusted tickets ready for exports
+    if config.configs['trusted.prefetch.pool_size'] > 0:
+        tabhttp.ticket_prefetcher = tabhttp.TicketPrefetcher(
+            config.configs['trusted.prefetch.pool_size'],
+            config.configs['trusted.prefetch.max_age_seconds'])
+        tabhttp.ticket_prefetcher.start()
+
+    # if enabled, start worker processes for CPU-bound work
+    if config.configs['processes'] > 0:
+        pipeline.start_process_pool(config.configs['processes'])
+
+    try:
+        if args.daemon:
+            run_daemon()
+        else:
+            run_cycle()
+    finally:
+        pipeline.stop_process_pool()
+        if emailaction.smtp_pool:
+            emailaction.smtp_pool.close()
+
+
+def run_daemon():
+    """Run alert cycles every daemon.interval_seconds until a SIGTERM or SIGINT is received.
+        Config, logging, imported modules, the SMS client, and open HTTP and SMTP connections are kept between cycles."""
+
+    interval_s = config.configs['daemon.interval_seconds']
+    stop_requested = threading.Event()
+
+    def request_stop(signum, frame):
+        log.logger.info('Received signal {}, stopping once the current cycle completes'.format(signum))
+        stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    log.logger.info('Running as a daemon, checking alerts every {} seconds'.format(interval_s))
+
+    while not stop_requested.is_set():
+        cycle_started_at = time.time()
+        try:
+            run_cycle()
+        except SystemExit:
+            # quit_script has already notified the admin, so just try again next cycle
+            log.logger.error('Alert cycle was aborted, retrying in the next cycle')
+        except Exception as e:
+            log.logger.exception('Unhandled exception in alert cycle: {}'.format(e))
+
+        # wait out the rest of the interval, waking immediately if we're asked to stop
+        wait_s = interval_s - (time.time() - cycle_started_at)
+        if wait_s > 0:
+            stop_requested.wait(wait_s)
+
+    log.logger.info('VizAlerts daemon has stopped')
+
+
+def run_cycle():
+    """Check all scheduled alerts once, and process any that need to run"""
+
+    # cleanup old temp and log files
+    cleanup_dir_or_notify(config.configs['temp.dir'], config.configs['temp.dir.file_retention_seconds'], 'temp')
+    cleanup_dir_or_notify(config.configs['log.dir'], config.configs['log.dir.file_retention_seconds'], 'log')
+
     # get the alerts to process
     try:
         alerts = get_alerts()
@@ -148,29 +191,44 @@ def main():
         quit_script(errormessage)
 
     if alerts:
-        """Iterate through the list of applicable alerts, and process each"""
-
-        alert_queue = Queue()
-        for alert in sorted(alerts, key=attrgetter('priority')):
-            log.logger.debug('Queueing subscription id {} for processing'.format(alert.subscription_id))
-            alert_queue.put(alert)
-
-        # create all worker threads
-        for index in range(config.configs['threads']):
-            threadname = index + 1  # start thread names at 1
-            worker = VizAlertWorker(threadname, alert_queue)
-            log.logger.debug('Starting thread with name: {}'.format(threadname))
-            worker.start()
-
-        # loop until work is done
-        while 1 == 1:
-            if threading.active_count() == 1:
-                log.logger.info('Worker threads have completed. Exiting')
-                return
-            time.sleep(10)
-            log.logger.info('Waiting on {} worker threads. Currently active threads:: {}'.format(
-                threading.active_count() - 1,
-                threading.enumerate()))
+        """Run the list of applicable alerts through each processing stage"""
+
+        alert_pipeline = pipeline.AlertPipeline(
+            config.configs['threads'],
+            config.configs['render.threads'],
+            config.configs['deliver.threads'],
+            config.configs['pipeline.queue_size'],
+            config.configs['pipeline.deadline_seconds'])
+
+        # the execution history tells the scheduler how long each alert is likely to take
+        historyfile = config.get_state_path(history.HISTORY_FILENAME, history.HISTORY_NODE_FILENAME)
+        try:
+            execution_history = history.ExecutionHistory(
+                historyfile, config.configs['scheduler.default_duration_seconds'],
+                config.get_state_path(history.DURATIONS_FILENAME, history.DURATIONS_NODE_FILENAME))
+            execution_history.load()
+        except Exception as e:
+            log.logger.error('Unable to open execution history {}, this run will not be recorded: {}'.format(
+                historyfile, e))
+            execution_history = history.ExecutionHistory(
+                ':memory:', config.configs['scheduler.default_duration_seconds'])
+
+        try:
+            alert_pipeline.run(alerts, execution_history, config.configs['scheduler.order'],
+                               config.configs['scheduler.site_weights'], config.configs['scheduler.owner_weights'])
+
+            try:
+                execution_history.record_runs(alerts, config.configs['history.retention_days'])
+            except Exception as e:
+                log.logger.error('Unable to record this run in the execution history {}: {}'.format(historyfile, e))
+        finally:
+            execution_history.close()
+
+        log.logger.info('Worker threads have completed. Exiting')
+
+    # report every cycle, even one with no alerts, so a daemon doesn't count an idle cycle's requests
+    #   against the next cycle that has alerts
+    stats.report()
 
 
 def trusted_ticket_test():
@@ -205,6 +263,19 @@ def trusted_ticket_test():
         quit_script(errormessage)
 
 
+def rest_signin_test():
+    """Test ability to sign in to the REST API of Tableau Server"""
+    log.logger.debug('testing REST API sign in: {}, {}'.format(config.configs['server'], config.configs['server.user']))
+    sitename = ''  # this is just a test, use the default site
+    try:
+        session = tabrest.sessions.get(sitename, config.configs['server.user'], config.configs['server.user.domain'], 60)
+        log.logger.debug('Signed in to the REST API as user id {}'.format(session.user_id))
+    except Exception as e:
+        errormessage = 'Unable to sign in to the REST API, error: {}'.format(e)
+        log.logger.error(errormessage)
+        quit_script(errormessage)
+
+
 def get_alerts():
     """Get the set of VizAlerts from Tableau Server to check during this execution"""
     # package up the data from the source viz
@@ -225,25 +296,26 @@ def get_alerts():
         source_viz.download_trigger_data()
         if len(source_viz.error_list) > 0:
             raise UserWarning(''.join(source_viz.error_list))
-        results = source_viz.read_trigger_data()
-        if len(source_viz.error_list) > 0:
-            raise UserWarning(''.join(source_viz.error_list))
+        results = source_viz.trigger_data
 
     except Exception as e:
         quit_script('Could not process source viz data from {} for the following reasons:<br/><br/>{}'.format(
 			config.configs['vizalerts.source.viz'],
             e.args[0]))
 
-    # test for regex invalidity
+    # test for regex invalidity, compiling each distinct pattern once for all the alerts to share
+    pattern_registry = patterns.PatternRegistry()
     try:
-        fieldlist = ('allowed_from_address','allowed_recipient_addresses','allowed_recipient_numbers')
+        fieldlist = (('allowed_from_address', re.IGNORECASE),
+                     ('allowed_recipient_addresses', re.IGNORECASE),
+                     ('allowed_recipient_numbers', 0))
         currentfield = ''
         currentfieldvalue = ''
         for line in results:
-            for field in fieldlist:
+            for field, flags in fieldlist:
                 currentfield = field
                 currentfieldvalue = line[field]
-                re.compile('{}'.format(currentfieldvalue))
+                pattern_registry.get(currentfieldvalue, flags)
     except Exception as e:
         quit_script('Could not process source viz data from {} for the following reason:<br/><br/>' \
 		    'Invalid regular expression found. Could not evaluate expression \'{}\' in the field {}. Raw error:<br/><br/>{}'.format(
@@ -252,30 +324,35 @@ def get_alerts():
                 currentfield,
                 e.args[0]))
 
+    # when several VizAlerts instances share the load, each only handles the subscriptions it owns
+    node_id = config.configs['cluster.node_id']
+    node_count = config.configs['cluster.node_count']
+    ring = None
+    if node_count > 1:
+        ring = cluster.HashRing(node_count)
+        log.logger.info('Processing subscriptions for node {} of {}'.format(node_id, node_count))
+
     # retrieve schedule data from the last run and compare to current
-    statefile = config.configs['schedule.state.dir'] + SCHEDULE_STATE_FILENAME
+    statefile = config.get_state_path(SCHEDULE_STATE_FILENAME, SCHEDULE_STATE_NODE_FILENAME)
+    statedbfile = config.get_state_path(SCHEDULE_STATE_DB_FILENAME, SCHEDULE_STATE_DB_NODE_FILENAME)
+    if config.configs['schedule.state.backend'] == state.BACKEND_TSV:
+        store_path = statefile
+    else:
+        store_path = statedbfile
 
     # list of all alerts we've retrieved from the server that may need to be run
     alerts = []
 
-    # list of alerts to write to the state file again
-    persistalerts = []
-
     # final list of views to execute alerts for
     execalerts = []
-    try:
-        if not os.path.exists(statefile):
-            f = codecs.open(statefile, encoding='utf-8', mode='w+')
-            f.close()
-    except IOError as e:
-        errormessage = 'Invalid schedule state file: {}'.format(e.args[0])
-        log.logger.error(errormessage)
-        quit_script(errormessage)
 
     # Create VizAlert instances for all the alerts we've retrieved
     try:
-        results = source_viz.read_trigger_data() # get the results again to start at the beginning
         for line in results:
+            # skip subscriptions owned by another node
+            if ring and ring.get_node(int(line['subscription_id'])) != node_id:
+                continue
+
             # build an alert instance for each line            
             alert = vizalert.VizAlert(line['view_url_suffix'],
                                       line['site_name'],
@@ -284,6 +361,8 @@ def get_alerts():
                                       line['subscriber_email'],
                                       line['view_name'])
 
+            alert.patterns = pattern_registry
+
             # Email actions
             alert.action_enabled_email = int(line['action_enabled_email'])
             alert.allowed_from_address = line['allowed_from_address']
@@ -313,7 +392,6 @@ def get_alerts():
             alert.viz_png_height = int(line['viz_png_height'])
             alert.viz_png_width = int(line['viz_png_width'])
             alert.timeout_s = int(line['timeout_s'])
-            alert.task_thread_count = int(line['task_threads'])
 
             # alert
             alert.alert_type = line['alert_type']
@@ -379,83 +457,45 @@ def get_alerts():
 
     # now determine which actually need to be run now
     try:
-        for line in fileinput.input([statefile]):
-            if not fileinput.isfirstline():
-                linedict = {}
-                linedict['site_name'] = line.split('\t')[0]
-                linedict['subscription_id'] = line.split('\t')[1]
-                linedict['view_id'] = line.split('\t')[2]
-                linedict['customized_view_id'] = line.split('\t')[3]
-                linedict['ran_last_at'] = line.split('\t')[4]
-                linedict['run_next_at'] = line.split('\t')[5]
-                linedict['schedule_id'] = line.split('\t')[6].rstrip()  # remove trailing line break
-                for alert in alerts:
-                    # subscription_id is our unique identifier
-                    if str(alert.subscription_id) == str(linedict['subscription_id']):
-
-                        # preserve the last time the alert was scheduled to run
-                        alert.ran_last_at = str(linedict['ran_last_at'])
-
-                        # if the run_next_at date is greater for this alert since last we checked, mark it to run now
-                        # the schedule condition ensures the alert doesn't run simply due to a schedule switch
-                        # (note that CHANGING a schedule will still trigger the alert check...to be fixed later
-                        if (
-                                (datetime.datetime.strptime(str(alert.run_next_at), "%Y-%m-%d %H:%M:%S") \
-                                         > datetime.datetime.strptime(str(linedict['run_next_at']),
-                                                                       "%Y-%m-%d %H:%M:%S") \
-                                         and str(alert.schedule_id) == str(linedict['schedule_id']))
-                                # test alerts are handled differently
-                                and not alert.is_test
-                        ):
-
-                                # For a test, run_next_at is anchored to the most recent comment, so use it as last run time
-                                if alert.is_test:
-                                    alert.ran_last_at = alert.run_next_at
-                                else:
-                                    alert.ran_last_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-
-                                seconds_since_last_run = \
-                                    abs((
-                                            datetime.datetime.strptime(str(linedict['ran_last_at']),
-                                                                       "%Y-%m-%d %H:%M:%S") -
-                                            datetime.datetime.utcnow()
-                                        ).total_seconds())
-
-                                execalerts.append(alert)
-
-                        # else use the ran_last_at field, and write it to the state file? I dunno.
-
-                        # add the alert to the list to write back to our state file
-                        persistalerts.append(alert)
-
-        # add NEW subscriptions that weren't in our state file
-        # this is ugly I, know...sorry. someday I'll be better at Python.
-        persist_sub_ids = []
-        for alert in persistalerts:
-            persist_sub_ids.append(alert.subscription_id)
-        for alert in alerts:
-            if alert.subscription_id not in persist_sub_ids:
+        store = state.get_store(config.configs['schedule.state.backend'], statedbfile, statefile)
+        try:
+            previous_records = store.load()
+
+            # the state of every current subscription, to replace what was stored
+            records = {}
+            for alert in alerts:
+                # subscription_id is our unique identifier
+                previous_record = previous_records.get(alert.subscription_id)
+                if previous_record:
+                    # preserve the last time the alert was scheduled to run
+                    alert.ran_last_at = previous_record['ran_last_at']
+
+                    # if the run_next_at date is greater for this alert since last we checked, mark it to run now
+                    # the schedule condition ensures the alert doesn't run simply due to a schedule switch
+                    # (note that CHANGING a schedule will still trigger the alert check...to be fixed later
+                    if (
+                            (datetime.datetime.strptime(str(alert.run_next_at), "%Y-%m-%d %H:%M:%S") \
+                                     > datetime.datetime.strptime(previous_record['run_next_at'],
+                                                                   "%Y-%m-%d %H:%M:%S") \
+                                     and str(alert.schedule_id) == previous_record['schedule_id'])
+                            # test alerts are handled differently
+                            and not alert.is_test
+                    ):
+                        alert.ran_last_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                        execalerts.append(alert)
+
                 # if this is a test alert, and we haven't seen it before, run that puppy now!
-                if alert.is_test:
+                elif alert.is_test:
                     execalerts.append(alert)
-                persistalerts.append(alert)
-
-        # write the next run times to file
-        with codecs.open(statefile, encoding='utf-8', mode='w') as fw:
-            fw.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format("site_name", "subscription_id", "view_id",
-                                                           "customized_view_id", "ran_last_at", "run_next_at",
-                                                           "schedule_id"))
-            for alert in persistalerts:
-                fw.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(alert.site_name, alert.subscription_id,
-                                                               alert.view_id, alert.customized_view_id,
-                                                               alert.ran_last_at, alert.run_next_at,
-                                                               alert.schedule_id))
-    except IOError as e:
-        errormessage = 'IOError accessing {} while getting views to process: {}'.format(e.filename, e.args[0])
-        log.logger.error(errormessage)
-        quit_script(errormessage)
+
+                records[alert.subscription_id] = state.get_record(alert)
+
+            # write the next run times back
+            store.save(records)
+        finally:
+            store.close()
     except Exception as e:
-        errormessage = 'Error accessing {} while getting views to process: {}'.format(statefile, e)
+        errormessage = 'Error accessing {} while getting views to process: {}'.format(store_path, e)
         log.logger.error(errormessage)
         quit_script(errormessage)
 
@@ -471,6 +511,21 @@ def quit_script(message):
         log.logger.error('Unknown error-sending exception alert email: {}'.format(e.args[0]))
     sys.exit(1)
 
+def cleanup_dir_or_notify(path, expiry_s, dirtype):
+    """Cleans up expired files in a directory, emailing the admin (but not quitting) if that fails"""
+    try:
+        cleanup_dir(path, expiry_s)
+    except OSError as e:
+        errormessage = 'OSError: Unable to cleanup {} directory {}, error: {}'.format(dirtype, path, e)
+        log.logger.error(errormessage)
+        email_instance = emailaction.Email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
+        emailaction.send_email(email_instance)
+    except Exception as e:
+        errormessage = 'Unable to cleanup {} directory {}, error: {}'.format(dirtype, path, e)
+        log.logger.error(errormessage)
+        email_instance = emailaction.Email(config.configs['smtp.address.from'], config.configs['smtp.address.to'], config.configs['smtp.subject'], errormessage)
+        emailaction.send_email(email_instance)
+
 def cleanup_dir(path, expiry_s):
     """Deletes all files in the provided path with modified time greater than expiry_s"""
     files = os.listdir(path)
@@ -481,6 +536,7 @@ def cleanup_dir(path, expiry_s):
             os.remove(file)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # needed for worker processes in the frozen Windows executable
     exitcode = 0
     try:
         main()